@@ -0,0 +1,154 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Per-event latency of filing GitHub issues against a local stub server,
+with a new connection and YAML per event and with kept alive connections
+and JSON.
+
+Run from the repository root::
+
+    python benchmarks/github.py
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import os
+import sys
+import threading
+import timeit
+import urllib2
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from django.conf import settings
+
+settings.configure(
+    INSTALLED_APPS=('error_capture_middleware', ),
+    ERROR_CAPTURE_GITHUB_REPO='user/repo',
+    ERROR_CAPTURE_GITHUB_TOKEN='token',
+    ERROR_CAPTURE_GITHUB_LOGIN='login',
+)
+
+from error_capture_middleware.handlers.github import GitHubHandler
+
+NUMBER = 200
+YAML = ('issue:\n  number: 123\n  created_at: !timestamp\n'
+    '    at: 2010/01/01 00:00:00 -0800\n')
+JSON = '{"number": 123, "html_url": "https://github.com/user/repo/issues/123"}'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers like both GitHub APIs.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Send the whole response at once
+    wbufsize = -1
+
+    def do_POST(self):
+        """
+        Reads the request and answers with a created issue.
+        """
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/api/v2/yaml/'):
+            status, data = 200, YAML
+        else:
+            status, data = 201, JSON
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        """
+        Keeps the output clean.
+        """
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded stub server.
+    """
+
+    daemon_threads = True
+
+
+class LocalUrllib(object):
+    """
+    urllib2 which sends the old API calls to the stub server.
+    """
+
+    def urlopen(self, url, data, timeout):
+        """
+        Opens the url on the stub server.
+        """
+        return urllib2.urlopen(
+            url.replace('http://github.com', settings.ERROR_CAPTURE_GITHUB_API),
+            data, timeout)
+
+
+def legacy():
+    """
+    Opens a new connection and parses YAML for each event.
+    """
+    handler.create_legacy_issue('title', 'body', local_urllib)
+
+
+def pooled():
+    """
+    Reuses a kept alive connection and parses JSON for each event.
+    """
+    handler.create_issue('title', 'body')
+
+
+if __name__ == '__main__':
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        settings.ERROR_CAPTURE_GITHUB_API = 'http://127.0.0.1:%s' % (
+            server.server_address[1])
+        handler = GitHubHandler()
+        local_urllib = LocalUrllib()
+        for func in (legacy, pooled):
+            seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+            print '%-7s %8.1f usec/event' % (
+                func.__name__, seconds / NUMBER * 1000000)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,111 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Per-event template rendering cost with and without the template cache, and
+the cost of the 500 page rendered or prerendered.
+
+Run from the repository root::
+
+    python benchmarks/templates.py
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from django.conf import settings
+
+settings.configure(
+    INSTALLED_APPS=('error_capture_middleware', ),
+    TEMPLATE_DIRS=(os.path.join(
+        os.path.dirname(__file__), '..', 'example_project', 'templates'), ),
+    ERROR_CAPTURE_ADMINS=(),
+    ERROR_CAPTURE_EMAIL_FAIL_SILENTLY=True,
+)
+
+from django.template import Context, loader
+
+from error_capture_middleware.registry import HandlerRegistry
+
+NUMBER = 200
+NAMES = ('django_error_capture_middleware/email/subject.txt',
+    'django_error_capture_middleware/email/body.txt', '500.html')
+CONTEXT = Context({
+    'traceback': 'Traceback (most recent call last):\nValueError\n',
+    'exception': ValueError('benchmark'),
+    'fingerprint': 'a' * 40,
+    'occurrences': 1,
+})
+
+
+def uncached():
+    """
+    Loads and compiles every template for each event.
+    """
+    for name in NAMES:
+        loader.get_template(name).render(CONTEXT)
+
+
+def cached():
+    """
+    Renders from the templates compiled by the registry.
+    """
+    for name in NAMES:
+        templates.get(name).render(CONTEXT)
+
+
+def error_page():
+    """
+    Renders the 500 page from the compiled template.
+    """
+    templates.get('500.html').render(CONTEXT)
+
+
+def static_page():
+    """
+    Fills the id into the prerendered 500 page.
+    """
+    templates.get_static('500.html').render('a' * 40)
+
+
+if __name__ == '__main__':
+    templates = HandlerRegistry(
+        ('error_capture_middleware.handlers.email.EmailHandler', )).templates
+    templates.prerender('500.html')
+    for func in (uncached, cached, error_page, static_page):
+        seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+        print '%-11s %8.1f usec/event' % (
+            func.__name__, seconds / NUMBER * 1000000)
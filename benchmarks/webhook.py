@@ -0,0 +1,135 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Throughput of the webhook handler's batcher against a local stub collector
+for a few batch sizes. A batch size of 1 is one request per event.
+
+Run from the repository root::
+
+    python benchmarks/webhook.py
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import os
+import sys
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from django.conf import settings
+
+settings.configure(INSTALLED_APPS=('error_capture_middleware', ))
+
+from error_capture_middleware.handlers.webhook import WebhookBatcher
+
+EVENTS = 2000
+BATCH_SIZES = (1, 10, 100)
+EVENT = {
+    'id': '01ARZ3NDEKTSV4RRFFQ69G5FAV',
+    'fingerprint': 'a' * 40,
+    'timestamp': 1262304000.0,
+    'sample_weight': 1,
+    'exception': "ValueError('benchmark',)",
+    'traceback': ['Traceback (most recent call last):\n'] + [
+        '  File "/srv/app/views.py", line %s, in view\n'
+        '    return handler(request)\n' % x for x in range(20)] + [
+        'ValueError: benchmark\n'],
+    'META': {'PATH_INFO': '/path/', 'REQUEST_METHOD': 'GET',
+        'HTTP_USER_AGENT': 'Mozilla/5.0', 'REMOTE_ADDR': '127.0.0.1'},
+    'GET': {'page': ['2']},
+    'POST': {},
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Accepts every batch.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Send the whole response at once
+    wbufsize = -1
+
+    def do_POST(self):
+        """
+        Reads the batch and answers with a 200.
+        """
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        """
+        Keeps the output clean.
+        """
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded stub server.
+    """
+
+    daemon_threads = True
+
+
+def run(url, batch_size):
+    """
+    Buffers and sends EVENTS events, returning the events per second.
+
+    :Parameters:
+       - `url`: url of the stub collector
+       - `batch_size`: most events in a batch
+    """
+    batcher = WebhookBatcher(url, batch_size, max_buffer=EVENTS)
+    start = time.time()
+    for x in xrange(EVENTS):
+        batcher.add(EVENT)
+    batcher.flush()
+    return EVENTS / (time.time() - start)
+
+
+if __name__ == '__main__':
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%s/events' % server.server_address[1]
+    for batch_size in BATCH_SIZES:
+        print 'batch_size %-4s %8.0f events/sec' % (
+            batch_size, max([run(url, batch_size) for x in range(3)]))
@@ -35,23 +35,36 @@ Error caprture middleware and default application.
 __docformat__ = 'restructuredtext'
 
 
-try:
-    from hashlib import sha1
-except ImportError, e:
-    import sha as sha1
-
+import logging
 import platform
 import Queue
-import socket
 import sys
+import time
 
 from django import http
 from django.conf import settings
-from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponseServerError
 from django.views import debug
-from django.template import Context, loader
+from django.template import Context
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+from error_capture_middleware.aggregate import get_commenter
+from error_capture_middleware.breaker import CircuitOpen, get_breaker
+from error_capture_middleware.dedupe import DuplicateCache
+from error_capture_middleware.filters import ExceptionFilter
+from error_capture_middleware.fingerprint import Fingerprinter
+from error_capture_middleware.ratelimit import RateLimiter
+from error_capture_middleware.registry import (HandlerRegistry,
+    get_template_cache)
+from error_capture_middleware.sampling import Sampler
+from error_capture_middleware.event import ErrorEvent
+from error_capture_middleware.spool import get_spool
+from error_capture_middleware.workers import get_dispatcher, get_pool
 
 # Imports based on version
 if platform.python_version() >= '9.6.0':
@@ -63,6 +76,8 @@ else:
     thread_cls = threading.Thread
     queue_mod = __import__('Queue')
 
+logger = logging.getLogger('error_capture_middleware')
+
 
 def exception_wrapper(func):
     """
@@ -79,12 +94,88 @@ def exception_wrapper(func):
     return wrapper
 
 
+def breaker_wrapper(breaker, func):
+    """
+    Wraps a method so that it is called through a circuit breaker.
+    """
+
+    def wrapper(*args, **kwargs):
+        return breaker.call(func, *args, **kwargs)
+
+    return wrapper
+
+
 class ErrorCaptureMiddleware(object):
     """
     Middleware to capture exceptins and create a ticket/bug for it.
     """
     traceback = __import__('traceback')
 
+    def __init__(self):
+        """
+        Creates an instance of this class and compiles the configuration.
+        """
+        self.configure()
+        setting_changed.connect(self._setting_changed)
+
+    def configure(self):
+        """
+        Compiles everything the middleware needs out of the settings so
+        none of it has to happen while handling an exception.
+        """
+        self.registry = HandlerRegistry()
+        self.exception_filter = ExceptionFilter()
+        self.fingerprinter = Fingerprinter()
+        # Only the new cache's sweeper is needed
+        if getattr(self, 'duplicates', None) is not None:
+            self.duplicates.stop(5)
+        self.duplicates = DuplicateCache()
+        self.rate_limiter = RateLimiter.from_settings()
+        self.sampler = Sampler.from_settings()
+        # Start the workers now so worker processes aren't forked from a
+        # request thread and its held locks
+        if settings.ERROR_CAPTURE_ENABLE_MULTPROCESS:
+            get_dispatcher()
+        # Start delivering anything left in the spool
+        get_spool()
+
+    def _setting_changed(self, setting, **kwargs):
+        """
+        Rebuilds the compiled configuration when one of our settings
+        changes.
+
+        :Parameters:
+           - `setting`: name of the setting which changed
+           - `kwargs`: other signal arguments
+        """
+        if setting.startswith('ERROR_CAPTURE_'):
+            self.configure()
+
+    def count_occurrence(self, fingerprint):
+        """
+        Tells the handlers which count occurrences about one which was not
+        dispatched.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+        """
+        for handler_cls in self.registry.counting:
+            handler_cls.count_occurrence(fingerprint)
+
+    def static_response(self, fingerprint):
+        """
+        Returns the prerendered 500 page for an occurrence which is not
+        dispatched or None if ERROR_CAPTURE_STATIC_500 is off.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception, shown as the
+             reference since no event is created
+        """
+        if self.registry.static_page is None or settings.DEBUG:
+            return None
+        return HttpResponseServerError(
+            self.registry.static_page.render(fingerprint))
+
     def process_exception(self, request, exception):
         """
         Process the exception.
@@ -97,59 +188,73 @@ class ErrorCaptureMiddleware(object):
         if isinstance(exception, http.Http404):
             raise exception
 
-        # Snag the trace content since we will use it from here forward
-        trace_content = self.traceback.format_exc()
-
-        # If the type is blacklisted ...
-        if getattr(settings, 'ERROR_CAPTURE_TRACE_CLASS_BLACKLIST', None):
-            for ex in settings.ERROR_CAPTURE_TRACE_CLASS_BLACKLIST:
-                if ex == type(exception):
-                    raise exception
-        # If we match the traceback content in a regular expression ...
-        # Note that we import re in this scope so we only import if used
-        elif getattr(settings, 'ERROR_CAPTURE_TRACE_CONTENT_BLACKLIST', None):
-            import re
-            for rx in settings.ERROR_CAPTURE_TRACE_CONTENT_BLACKLIST:
-                try:
-                    re.search(rx, trace_content).groups()
-                    raise exception
-                except AttributeError:
-                    # didn't match
-                    pass
+        # Only format the trace if the content blacklist needs it
+        trace_content = None
+        if self.exception_filter.needs_content:
+            trace_content = self.traceback.format_exc()
+
+        # If the type or traceback content is blacklisted ...
+        if self.exception_filter.is_blacklisted(exception, trace_content):
+            raise exception
 
         # If we get to this point, we will be processing the exception.
         exc_info = sys.exc_info()
         if settings.DEBUG and settings.ERROR_CAPTURE_NOOP_ON_DEBUG:
             return debug.technical_500_response(request, *exc_info)
 
-        # generate a hash for this exception
-        hash = sha1()
-        hash.update(trace_content)
-        exc_hash = hash.hexdigest()
-
-        # check the cache to see if we have already handled it
-        if cache.get(exc_hash) is not None:
-            return
-
-        cache.set(exc_hash, self.traceback.format_exc(),
-                int(settings.ERROR_CAPTURE_IGNORE_DUPE_SEC))
-
-        handler_count = len(settings.ERROR_CAPTURE_HANDLERS)
+        # generate a fingerprint for this exception
+        exc_hash = self.fingerprinter(exception, exc_info[2])
+
+        # Occurrences not sampled are only counted
+        weight = self.sampler.sample(exc_hash)
+        if not weight:
+            self.count_occurrence(exc_hash)
+            return self.static_response(exc_hash)
+
+        # Over the rate limits it is only counted
+        if not self.rate_limiter.allow(
+                self.rate_limiter.key_for(exception, exc_hash)):
+            self.count_occurrence(exc_hash)
+            return self.static_response(exc_hash)
+
+        # Only the first occurrence in a window goes to the handlers, the
+        # others are counted.
+        dispatch, occurrences = self.duplicates.record(exc_hash)
+        if not dispatch:
+            self.count_occurrence(exc_hash)
+            return self.static_response(exc_hash)
+
+        # Everything handlers need is worked out once, when first used,
+        # only the frame locals are copied now
+        event = ErrorEvent(request, exception, exc_info, exc_hash,
+            occurrences, sample_weight=weight)
+        event.snapshot()
+
+        handlers = self.registry.handlers
+        spool = get_spool()
+        if spool is not None and len(handlers) > 1:
+            # Everything but the last handler is delivered from the spool,
+            # or dispatched as usual if the spool can't take it now
+            try:
+                spool.put(handlers[:-1], event)
+                handlers = handlers[-1:]
+            except Exception:
+                logger.exception('Unable to spool event %s' % event.id)
+
+        handler_count = len(handlers)
         count = 0
-        for handler in settings.ERROR_CAPTURE_HANDLERS:
-            module = '.'.join(handler.split('.')[:-1])
-            cls = handler.split('.')[-1]
-            handler_obj = getattr(__import__(module, fromlist=[True]), cls)
+        for handler_cls in handlers:
             count += 1
-            func = handler_obj()
             if (settings.ERROR_CAPTURE_ENABLE_MULTPROCESS
                 and count < handler_count):
-                a_process = thread_cls(
-                    target=func, args=(request, exception, exc_info))
-                #a_process.daemon = True
-                a_process.start()
+                # Don't queue work which is bound to be refused
+                if get_breaker(handler_cls).is_open():
+                    continue
+                get_dispatcher().dispatch(
+                    handler_cls, request, exception, exc_info, event)
             else:
-                result = func(request, exception, sys.exc_info())
+                result = handler_cls()(
+                    request, exception, sys.exc_info(), event)
             # If it is the last item, then it will be what we return.
             if count >= handler_count:
                 return result
@@ -160,22 +265,84 @@ class ErrorCaptureHandler(object):
     Parent class for creating a handler.
     """
 
-    __slots__ = ['traceback', 'required_settings', 'context']
+    __slots__ = ['traceback', 'required_settings', 'context', 'foreground',
+        'event', 'deadline']
 
     traceback = __import__('traceback')
     required_settings = []
+    # Set to True to get count_occurrence calls
+    counts_occurrences = False
+    # Templates used by the handler by short name, compiled at startup
+    templates = {}
+    # Template rendered for the user when not in DEBUG
+    error_template = '500.html'
+    # Circuit breaker settings, None to use the ERROR_CAPTURE_ settings
+    timeout = None
+    breaker_failures = None
+    breaker_reset = None
 
     def __init__(self):
         """
         Creates an instance of this class.
         """
-        for required_setting in self.required_settings:
-            if not hasattr(settings, required_setting):
-                raise ImproperlyConfigured('You must define the following ' +
-                    'in your settings' +
-                    ', '.join(self.required_settings)[:-2])
+        self.check_settings()
         # Create an empty context for use later.
         self.context = Context()
+        # Background calls run inline when set
+        self.foreground = False
+        # The ErrorEvent being handled
+        self.event = None
+        # When get_data stops waiting for background calls
+        self.deadline = None
+
+    @classmethod
+    def check_settings(cls):
+        """
+        Raises ImproperlyConfigured if a required setting is missing.
+        """
+        for required_setting in cls.required_settings:
+            if not hasattr(settings, required_setting):
+                raise ImproperlyConfigured('You must define the following ' +
+                    'in your settings: ' +
+                    ', '.join(cls.required_settings))
+
+    @classmethod
+    def call_timeout(cls):
+        """
+        Returns the seconds a remote call of the handler may take, which
+        transports use as their socket timeout.
+        """
+        return cls.timeout or getattr(
+            settings, 'ERROR_CAPTURE_HANDLER_TIMEOUT', 30)
+
+    @classmethod
+    def count_occurrence(cls, fingerprint):
+        """
+        Called for occurrences which were suppressed or rate limited when
+        counts_occurrences is True.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+        """
+        pass
+
+    def get_template(self, name):
+        """
+        Returns a compiled template.
+
+        :Parameters:
+           - `name`: short name from templates or a template name
+        """
+        return get_template_cache().get(self.templates.get(name, name))
+
+    def render(self, name):
+        """
+        Renders a template with the handler's context.
+
+        :Parameters:
+           - `name`: short name from templates or a template name
+        """
+        return self.get_template(name).render(self.context)
 
     def handle(self, request, exception, tb):
         """
@@ -193,21 +360,29 @@ class ErrorCaptureHandler(object):
         """
         Provides a simple interface for doing background processing.
         An object providing a get method is returned along with the
-        process or thread object.
+        worker pool the callback was submitted to (or the callback
+        result when running in the foreground). The callback goes through
+        the handler's circuit breaker, and CircuitOpen is raised right away
+        while the breaker is open.
 
         :Parameters:
            - `callback`: callable to execute
            - `args`: non-keyword arguments to pass to callback
            - `kwargs`: keyword arguments to pass to callback
         """
+        breaker = get_breaker(self.__class__)
+        if breaker.is_open():
+            raise CircuitOpen('Circuit open for %s' % self.__class__.__name__)
         a_queue = queue_mod.Queue()
+        kwargs = dict(kwargs, queue=a_queue)
+        callback = breaker_wrapper(breaker, callback)
+        if self.foreground:
+            # Let failures raise so the caller can retry
+            return a_queue, callback(*args, **kwargs)
         callback_wrapped = exception_wrapper(callback)
-        kwargs.update({'queue': a_queue})
         if settings.ERROR_CAPTURE_ENABLE_MULTPROCESS:
-            a_process = thread_cls(
-                target=callback_wrapped, args=args, kwargs=kwargs)
-            a_process.daemon = True
-            a_process.start()
+            a_process = get_pool()
+            a_process.submit(callback_wrapped, *args, **kwargs)
         else:
             a_process = callback_wrapped(*args, **kwargs)
         return a_queue, a_process
@@ -215,20 +390,97 @@ class ErrorCaptureHandler(object):
     def get_data(self, queue):
         """
         Gets the data from a queue or raises the proper exception if
-        one exists.
+        one exists. Waits for it until the response budget is used up.
 
         :Parameters:
            - `queue`: queue instance to use
         """
+        timeout = 0
+        if self.deadline is not None:
+            timeout = self.deadline - time.time()
         try:
-            data = queue.get_nowait()
+            if timeout > 0:
+                data = queue.get(timeout=timeout)
+            else:
+                data = queue.get_nowait()
         except Queue.Empty:
             return None
-        if issubclass(Exception, data.__class__):
+        if isinstance(data, Exception):
             raise data
         return data
 
-    def __call__(self, request, exception, exc_info):
+    def remote_ticket(self, queue, remote_id, url=None):
+        """
+        Reports the ticket created in a remote system from a background
+        call. It is returned by get_data if the response is still waiting
+        and is linked to the event id either way.
+
+        :Parameters:
+           - `queue`: queue passed to the background call
+           - `remote_id`: id of the remote ticket
+           - `url`: link to the remote ticket
+        """
+        queue.put_nowait((remote_id, url))
+        if self.event is None:
+            return
+        from error_capture_middleware.models import RemoteLink
+        try:
+            RemoteLink.objects.create(event_id=self.event.id,
+                handler=self.__class__.__name__, remote_id=remote_id,
+                url=url or '')
+        except Exception:
+            # The ticket exists so this must not make the delivery retry
+            logger.exception('Unable to link %s to event %s' % (
+                remote_id, self.event.id))
+
+    def circuit_open(self, event):
+        """
+        Called instead of the handler's work while its circuit breaker is
+        open. The event is spooled if there is a spool which takes it,
+        otherwise dropped.
+
+        :Parameters:
+           - `event`: ErrorEvent being handled
+        """
+        spool = get_spool()
+        if spool is not None:
+            try:
+                spool.put([self.__class__], event)
+            except Exception:
+                logger.exception('Circuit open and unable to spool, dropped '
+                    'event %s for %s' % (event.id, self.__class__.__name__))
+        else:
+            logger.debug('Circuit open, dropped event %s for %s' % (
+                event.id, self.__class__.__name__))
+
+    def use_event(self, event):
+        """
+        Sets the event being handled and adds it to the context. The
+        event's data is shared between handlers so a new dict is pushed
+        for anything the handler sets itself.
+
+        :Parameters:
+           - `event`: ErrorEvent being handled
+        """
+        self.event = event
+        self.context.update(event.context_data)
+        self.context.push()
+
+    def deliver(self, event):
+        """
+        Handles a detached event, for instance one loaded from the spool.
+        Background calls run in the foreground so failures raise and the
+        delivery can be retried.
+
+        :Parameters:
+           - `event`: ErrorEvent being handled
+        """
+        self.foreground = True
+        self.use_event(event)
+        return self.handle(
+            event.get_request(), event.get_exception(), event.traceback)
+
+    def __call__(self, request, exception, exc_info, event=None):
         """
         Actually gets called from the middleware and takes care of
         adding in the traceback information.
@@ -237,15 +489,19 @@ class ErrorCaptureHandler(object):
            - `request`: request causing the exception
            - `exception`: actual exception raised
            - `exc_info`: info from sys.exc_info
+           - `event`: ErrorEvent shared by all handlers
         """
-        tb = self.traceback.format_exception(*exc_info)
-        data = {'traceback': tb}
-        data.update(request.META)
-        data["GET"] = request.GET
-        data["POST"] = request.POST
-        data["SERVER_HOSTNAME"] = socket.gethostname()
-        self.context.update(data)
-        r = self.handle(request, exception, tb)
+        if event is None:
+            event = ErrorEvent(request, exception, exc_info)
+        budget = getattr(settings, 'ERROR_CAPTURE_RESPONSE_BUDGET_MS', 0)
+        if budget:
+            self.deadline = time.time() + budget / 1000.0
+        self.use_event(event)
+        try:
+            r = self.handle(request, exception, event.traceback)
+        except CircuitOpen:
+            r = None
+            self.circuit_open(event)
 
         if settings.DEBUG:
             from django.http import HttpResponse
@@ -253,5 +509,98 @@ class ErrorCaptureHandler(object):
                 return r
             return debug.technical_500_response(request, *exc_info)
 
-        return HttpResponseServerError(
-            loader.get_template('500.html').render(self.context))
+        page = get_template_cache().get_static(self.error_template)
+        if page is not None:
+            return HttpResponseServerError(page.render(self.event.id))
+        return HttpResponseServerError(self.render(self.error_template))
+
+
+class RemoteIssueHandler(ErrorCaptureHandler):
+    """
+    Parent class for handlers creating issues in a remote system. The
+    issue created for a fingerprint is indexed in RemoteIssue and repeats
+    of the fingerprint, including suppressed ones, are batched into a
+    comment on it instead of creating new issues.
+    """
+
+    counts_occurrences = True
+
+    @classmethod
+    def count_occurrence(cls, fingerprint):
+        """
+        Counts a suppressed occurrence in the next comment on the issue.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+        """
+        get_commenter().add(cls, fingerprint)
+
+    def repeat_issue(self):
+        """
+        Counts the event in the next comment on the indexed issue of its
+        fingerprint and puts the issue in the context. Returns False if
+        there is no indexed issue and one needs to be created.
+        """
+        fingerprint = self.context.get('fingerprint')
+        if not fingerprint:
+            return False
+        from error_capture_middleware.models import RemoteIssue
+        try:
+            issue = RemoteIssue.objects.get(
+                handler=self.__class__.__name__, fingerprint=fingerprint)
+        except RemoteIssue.DoesNotExist:
+            return False
+        # Only this occurrence, the ones sampled out were counted by
+        # count_occurrence already
+        get_commenter().add(self.__class__, fingerprint)
+        self.context['id'], self.context['bug_url'] = (
+            issue.remote_id, issue.url)
+        return True
+
+    def remote_ticket(self, queue, remote_id, url=None):
+        """
+        Reports the ticket created in a remote system from a background
+        call and indexes it for the fingerprint.
+
+        :Parameters:
+           - `queue`: queue passed to the background call
+           - `remote_id`: id of the remote ticket
+           - `url`: link to the remote ticket
+        """
+        super(RemoteIssueHandler, self).remote_ticket(queue, remote_id, url)
+        fingerprint = self.context.get('fingerprint')
+        if not fingerprint:
+            return
+        from error_capture_middleware.models import RemoteIssue
+        try:
+            # Another worker may have indexed one meanwhile, keep the first
+            RemoteIssue.objects.get_or_create(
+                handler=self.__class__.__name__, fingerprint=fingerprint,
+                defaults={'remote_id': str(remote_id), 'url': url or ''})
+        except Exception:
+            logger.exception('Unable to index %s for %s' % (
+                remote_id, fingerprint))
+
+    def render_comment(self, issue, count, last_seen):
+        """
+        Renders the comment for repeats of an issue as plain unicode,
+        which clients like xmlrpclib can send.
+
+        :Parameters:
+           - `issue`: RemoteIssue being commented on
+           - `count`: number of repeats since the last comment
+           - `last_seen`: datetime of the last repeat
+        """
+        return unicode(self.get_template('comment').render(Context({
+            'issue': issue, 'count': count, 'last_seen': last_seen})))
+
+    def comment_issue(self, issue, count, last_seen):
+        """
+        Comments the repeats on the remote issue. Must be overridden.
+
+        :Parameters:
+           - `issue`: RemoteIssue being commented on
+           - `count`: number of repeats since the last comment
+           - `last_seen`: datetime of the last repeat
+        """
+        raise NotImplementedError('comment_issue must be overridden')
@@ -36,15 +36,36 @@ __docformat__ = 'restructuredtext'
 
 
 from django.contrib import admin
-from error_capture_middleware.models import Error
+from error_capture_middleware.models import Error, RemoteIssue, RemoteLink
 
 
 class ErrorAdmin(admin.ModelAdmin):
     """
     Admin binding for Error to include Notes.
     """
-    list_display = ('id', 'traceback', 'resolved', 'timestamp')
+    list_display = ('id', 'traceback', 'resolved', 'timestamp', 'occurrences',
+        'last_seen')
+
+
+class RemoteLinkAdmin(admin.ModelAdmin):
+    """
+    Admin binding for RemoteLink.
+    """
+    list_display = ('event_id', 'handler', 'remote_id', 'url', 'timestamp')
+    search_fields = ('event_id', 'remote_id')
+
+
+class RemoteIssueAdmin(admin.ModelAdmin):
+    """
+    Admin binding for RemoteIssue. Deleting a row makes the next
+    occurrence create a new issue.
+    """
+    list_display = ('handler', 'remote_id', 'url', 'occurrences',
+        'last_seen')
+    search_fields = ('fingerprint', 'remote_id')
 
 
 # Register admin
 admin.site.register(Error, ErrorAdmin)
+admin.site.register(RemoteLink, RemoteLinkAdmin)
+admin.site.register(RemoteIssue, RemoteIssueAdmin)
@@ -0,0 +1,299 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Batched occurrence counting for the Error model and for remote issues.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+
+logger = logging.getLogger('error_capture_middleware')
+
+# Django 1.6 replaced commit_on_success with atomic
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+
+class OccurrenceFlusher(object):
+    """
+    Collects occurrence counts per fingerprint in memory and periodically
+    applies them to the unresolved Error rows as F() increments in a
+    single transaction.
+    """
+
+    def __init__(self, interval=10):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `interval`: seconds between flushes of the background thread
+        """
+        self.interval = interval
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def add(self, fingerprint, count=1, when=None):
+        """
+        Records occurrences of a fingerprint.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+           - `count`: number of occurrences
+           - `when`: datetime of the last occurrence, defaults to now
+        """
+        if when is None:
+            when = timezone.now()
+        self._lock.acquire()
+        try:
+            pending, last_seen = self._counts.get(fingerprint, (0, when))
+            self._counts[fingerprint] = (pending + count, max(when, last_seen))
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        Applies the collected counts. Returns the number of fingerprints
+        flushed.
+        """
+        self._lock.acquire()
+        try:
+            counts, self._counts = self._counts, {}
+        finally:
+            self._lock.release()
+        if not counts:
+            return 0
+        from error_capture_middleware.models import Error
+        with atomic():
+            for fingerprint, (count, last_seen) in counts.items():
+                Error.objects.filter(
+                    fingerprint=fingerprint, resolved=False).update(
+                    occurrences=F('occurrences') + count,
+                    last_seen=last_seen)
+        return len(counts)
+
+    def _run(self):
+        """
+        Flusher thread loop.
+        """
+        while not self._stopped.isSet():
+            self._stopped.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error capture occurrence flush failed')
+            finally:
+                # Don't keep an idle connection open in this thread
+                connection.close()
+
+    def start(self):
+        """
+        Starts the flusher thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='error-capture-occurrences')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the flusher thread after a last flush.
+
+        :Parameters:
+           - `timeout`: most seconds to wait for the flusher
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def get_flusher():
+    """
+    Returns the shared OccurrenceFlusher with its thread running.
+    """
+    global _flusher
+    if _flusher is None:
+        _flusher_lock.acquire()
+        try:
+            if _flusher is None:
+                flusher = OccurrenceFlusher(getattr(
+                    settings, 'ERROR_CAPTURE_OCCURRENCE_FLUSH_SEC', 10))
+                flusher.start()
+                atexit.register(flusher.stop, 5)
+                _flusher = flusher
+        finally:
+            _flusher_lock.release()
+    return _flusher
+
+
+class RepeatCommenter(object):
+    """
+    Collects repeats of fingerprints which already have a remote issue and
+    periodically bumps the RemoteIssue counts and adds one comment per
+    issue for all of the repeats since the last flush.
+    """
+
+    def __init__(self, interval=60):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `interval`: seconds between flushes of the background thread
+        """
+        self.interval = interval
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def add(self, handler_cls, fingerprint, count=1, when=None):
+        """
+        Records repeats of a fingerprint for a handler.
+
+        :Parameters:
+           - `handler_cls`: RemoteIssueHandler subclass
+           - `fingerprint`: fingerprint of the exception
+           - `count`: number of occurrences
+           - `when`: datetime of the last occurrence, defaults to now
+        """
+        if when is None:
+            when = timezone.now()
+        key = (handler_cls, fingerprint)
+        self._lock.acquire()
+        try:
+            pending, last_seen = self._counts.get(key, (0, when))
+            self._counts[key] = (pending + count, max(when, last_seen))
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """
+        Applies the collected repeats. Returns the number of issues
+        commented on.
+        """
+        self._lock.acquire()
+        try:
+            counts, self._counts = self._counts, {}
+        finally:
+            self._lock.release()
+        from error_capture_middleware.breaker import get_breaker
+        from error_capture_middleware.models import RemoteIssue
+        commented = 0
+        for (handler_cls, fingerprint), (count, last_seen) in counts.items():
+            issues = RemoteIssue.objects.filter(
+                handler=handler_cls.__name__, fingerprint=fingerprint)
+            # Not indexed yet, the issue is still being created. Keep the
+            # repeats for the next flush.
+            if not issues.update(occurrences=F('occurrences') + count,
+                    last_seen=last_seen):
+                self.add(handler_cls, fingerprint, count, last_seen)
+                continue
+            try:
+                get_breaker(handler_cls).call(handler_cls().comment_issue,
+                    issues.get(), count, last_seen)
+                commented += 1
+            except Exception:
+                logger.exception('Unable to comment on the %s issue for %s' % (
+                    handler_cls.__name__, fingerprint))
+        return commented
+
+    def _run(self):
+        """
+        Commenter thread loop.
+        """
+        while not self._stopped.isSet():
+            self._stopped.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error capture repeat comments failed')
+            finally:
+                # Don't keep an idle connection open in this thread
+                connection.close()
+
+    def start(self):
+        """
+        Starts the commenter thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='error-capture-repeats')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the commenter thread after a last flush.
+
+        :Parameters:
+           - `timeout`: most seconds to wait for the commenter
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+_commenter = None
+_commenter_lock = threading.Lock()
+
+
+def get_commenter():
+    """
+    Returns the shared RepeatCommenter with its thread running.
+    """
+    global _commenter
+    if _commenter is None:
+        _commenter_lock.acquire()
+        try:
+            if _commenter is None:
+                commenter = RepeatCommenter(getattr(
+                    settings, 'ERROR_CAPTURE_REMOTE_COMMENT_SEC', 60))
+                commenter.start()
+                atexit.register(commenter.stop, 5)
+                _commenter = commenter
+        finally:
+            _commenter_lock.release()
+    return _commenter
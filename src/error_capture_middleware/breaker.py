@@ -0,0 +1,249 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Circuit breakers for handlers.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of starting a call while a breaker is open.
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to a failing service. After failures consecutive failed
+    calls the breaker opens and refuses calls for reset seconds, then lets
+    one probe call through. The breaker closes again if the probe works and
+    reopens if it fails. Calls running longer than timeout count as failed
+    as soon as that is noticed, since threads can't be interrupted.
+    """
+
+    def __init__(self, failures=5, reset=60, timeout=30):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `failures`: consecutive failures which open the breaker
+           - `reset`: seconds the breaker stays open before a probe
+           - `timeout`: seconds after which a call counts as failed
+        """
+        self.failures = failures
+        self.reset = reset
+        self.timeout = timeout
+        self.state = CLOSED
+        self.failed = 0
+        self.opened = 0
+        self.refused = 0
+        self._running = {}
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _fail(self, now):
+        """
+        Counts a failure. Called with the lock held.
+
+        :Parameters:
+           - `now`: unix timestamp to treat as the current time
+        """
+        self.failed += 1
+        if self.state == HALF_OPEN or self.failed >= self.failures:
+            self.state = OPEN
+            self.opened = now
+            self._probing = False
+
+    def _reap(self, now):
+        """
+        Counts calls running past the timeout as failed. Called with the
+        lock held.
+
+        :Parameters:
+           - `now`: unix timestamp to treat as the current time
+        """
+        for token, started in self._running.items():
+            if now - started > self.timeout:
+                del self._running[token]
+                self._fail(now)
+
+    def is_open(self, now=None):
+        """
+        True if calls are refused without a probe being due.
+
+        :Parameters:
+           - `now`: unix timestamp to treat as the current time
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            self._reap(now)
+            if self.state == OPEN:
+                return now - self.opened < self.reset
+            return self.state == HALF_OPEN and self._probing
+        finally:
+            self._lock.release()
+
+    def start(self, now=None):
+        """
+        Starts a call and returns a token to pass to finish. Raises
+        CircuitOpen if the call is refused.
+
+        :Parameters:
+           - `now`: unix timestamp to treat as the current time
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            self._reap(now)
+            if self.state == OPEN and now - self.opened >= self.reset:
+                self.state = HALF_OPEN
+            if self.state == OPEN or (
+                    self.state == HALF_OPEN and self._probing):
+                self.refused += 1
+                raise CircuitOpen('Circuit open')
+            if self.state == HALF_OPEN:
+                self._probing = True
+            token = object()
+            self._running[token] = now
+            return token
+        finally:
+            self._lock.release()
+
+    def finish(self, token, ok, now=None):
+        """
+        Records how a started call went.
+
+        :Parameters:
+           - `token`: token from start
+           - `ok`: True if the call worked
+           - `now`: unix timestamp to treat as the current time
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            started = self._running.pop(token, None)
+            if started is None:
+                # Already counted as timed out
+                return
+            if not ok or now - started > self.timeout:
+                self._fail(now)
+            else:
+                self.state = CLOSED
+                self.failed = 0
+                self._probing = False
+        finally:
+            self._lock.release()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func through the breaker, raising CircuitOpen if refused.
+
+        :Parameters:
+           - `func`: callable to execute
+           - `args`: non-keyword arguments to pass to func
+           - `kwargs`: keyword arguments to pass to func
+        """
+        token = self.start()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            self.finish(token, False)
+            raise
+        self.finish(token, True)
+        return result
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(handler_cls):
+    """
+    Returns the CircuitBreaker of a handler class, creating it from the
+    handler and the settings on first use.
+
+    :Parameters:
+       - `handler_cls`: handler class
+    """
+    try:
+        return _breakers[handler_cls]
+    except KeyError:
+        pass
+    _breakers_lock.acquire()
+    try:
+        if handler_cls not in _breakers:
+            _breakers[handler_cls] = CircuitBreaker(
+                handler_cls.breaker_failures or getattr(
+                    settings, 'ERROR_CAPTURE_BREAKER_FAILURES', 5),
+                handler_cls.breaker_reset or getattr(
+                    settings, 'ERROR_CAPTURE_BREAKER_RESET_SEC', 60),
+                handler_cls.call_timeout())
+        return _breakers[handler_cls]
+    finally:
+        _breakers_lock.release()
+
+
+def _setting_changed(setting, **kwargs):
+    """
+    Drops the breakers when one of their settings changes.
+
+    :Parameters:
+       - `setting`: name of the setting which changed
+       - `kwargs`: other signal arguments
+    """
+    if (setting.startswith('ERROR_CAPTURE_BREAKER') or
+            setting == 'ERROR_CAPTURE_HANDLER_TIMEOUT'):
+        _breakers.clear()
+
+
+setting_changed.connect(_setting_changed)
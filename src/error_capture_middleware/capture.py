@@ -0,0 +1,498 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Bounded capture of request data for error events.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import datetime
+import decimal
+import fnmatch
+import re
+import threading
+import time
+import types
+
+try:
+    from reprlib import Repr
+except ImportError:
+    from repr import Repr
+
+from django.conf import settings
+from django.db.models import Manager, Model
+from django.db.models.query import QuerySet
+from django.http import HttpRequest
+from django.utils.datastructures import MultiValueDict
+from django.utils.encoding import force_text
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+
+# META keys captured by default, besides the HTTP_ headers
+META_KEYS = ('CONTENT_LENGTH', 'CONTENT_TYPE', 'PATH_INFO', 'QUERY_STRING',
+    'REMOTE_ADDR', 'REMOTE_HOST', 'REMOTE_USER', 'REQUEST_METHOD',
+    'SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT', 'SERVER_PROTOCOL')
+META_WHITELIST = META_KEYS + ('HTTP_*', )
+# Most bytes kept of each value
+MAX_VALUE_BYTES = 1024
+# Most values kept of each GET/POST key
+MAX_VALUES = 10
+# Largest request body which is parsed for POST if it was already read
+MAX_POST_BYTES = 64 * 1024
+# Most bytes of traceback and request data kept for one event
+MAX_EVENT_BYTES = 256 * 1024
+# Most characters of each local variable repr
+MAX_REPR_LENGTH = 200
+# Most levels of nested containers in a local variable repr
+MAX_REPR_DEPTH = 3
+# Most milliseconds spent on local variable reprs for one event
+FRAME_LOCALS_BUDGET_MS = 10
+# Types whose builtin repr is cheap and can't run application code. Only
+# exact instances use it since subclasses may override __repr__, other
+# objects are shown like object.__repr__ does.
+SAFE_REPR_TYPES = frozenset([bool, int, long, float, complex, str, unicode,
+    type(None), datetime.date, datetime.datetime, datetime.time,
+    datetime.timedelta, decimal.Decimal, types.FunctionType,
+    types.BuiltinFunctionType, types.ModuleType])
+
+# Settings read by CapturePolicy
+SETTINGS = frozenset(['ERROR_CAPTURE_META_WHITELIST',
+    'ERROR_CAPTURE_META_BLACKLIST', 'ERROR_CAPTURE_MAX_VALUE_BYTES',
+    'ERROR_CAPTURE_MAX_VALUES', 'ERROR_CAPTURE_MAX_POST_BYTES',
+    'ERROR_CAPTURE_MAX_EVENT_BYTES', 'ERROR_CAPTURE_FRAME_LOCALS',
+    'ERROR_CAPTURE_FRAME_LOCALS_BUDGET_MS', 'ERROR_CAPTURE_MAX_REPR_LENGTH',
+    'ERROR_CAPTURE_MAX_REPR_DEPTH'])
+
+
+def _compile(patterns):
+    """
+    Joins shell style patterns into one regular expression or returns None
+    if there are none.
+
+    :Parameters:
+       - `patterns`: key names which may contain * and ?
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join(
+        ['(?:%s)' % fnmatch.translate(x) for x in patterns]))
+
+
+def _lists(query):
+    """
+    Returns the (key, list of values) pairs of a QueryDict or plain dict.
+
+    :Parameters:
+       - `query`: QueryDict or dict
+    """
+    if hasattr(query, 'lists'):
+        return query.lists()
+    return [(key, [value]) for key, value in query.items()]
+
+
+class LimitedRepr(Repr):
+    """
+    Repr with every kind of value capped at the same length. Only the
+    builtin reprs of SAFE_REPR_TYPES and containers are used, subclasses
+    included, since any other __repr__ may be slow or hit the database.
+    Requests are shown by path, querysets and managers by model, model
+    instances by primary key, exceptions by their arguments, methods by
+    their class and name and anything else like object.__repr__.
+    """
+
+    def __init__(self, max_length, max_depth):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `max_length`: most characters of a string or other value
+           - `max_depth`: most levels of nested containers
+        """
+        Repr.__init__(self)
+        self.maxstring = self.maxother = self.maxlong = max_length
+        self.maxlevel = max_depth
+
+    def repr1(self, x, level):
+        """
+        Returns the capped repr of a value, never raising.
+
+        :Parameters:
+           - `x`: value
+           - `level`: remaining depth
+        """
+        # type() since __class__ would set up lazy objects
+        cls = type(x)
+        if cls is types.InstanceType:
+            cls = x.__class__
+        try:
+            if issubclass(cls, HttpRequest):
+                return '<%s %s>' % (cls.__name__,
+                    getattr(x, 'path', '')[:self.maxstring])
+            if issubclass(cls, (QuerySet, Manager)):
+                return '<%s of %s>' % (cls.__name__, x.model.__name__)
+            if issubclass(cls, Model):
+                return '<%s pk=%s>' % (
+                    cls.__name__, self.repr1(x.pk, level - 1))
+            if issubclass(cls, BaseException):
+                return cls.__name__ + self.repr1(x.args, level - 1)
+            # The repr of a method would include the repr of its instance
+            if cls is types.MethodType:
+                return '<%s method %s.%s>' % (
+                    x.im_self is None and 'unbound' or 'bound',
+                    x.im_class.__name__, x.im_func.__name__)
+            # Metaclasses may override the repr of classes
+            if issubclass(cls, (type, types.ClassType)):
+                return "<class '%s.%s'>" % (x.__module__, x.__name__)
+            # Subclasses of the containers are shown like them
+            for base in (dict, list, tuple, set, frozenset):
+                if issubclass(cls, base):
+                    return getattr(self, 'repr_' + base.__name__)(x, level)
+            if cls in SAFE_REPR_TYPES:
+                return Repr.repr1(self, x, level)
+            # Subclasses use the builtin repr of their type, not their own
+            for base in getattr(cls, '__mro__', ()):
+                if base in SAFE_REPR_TYPES:
+                    return self.cap(base.__repr__(x))
+            return self.repr_instance(x, level)
+        except Exception:
+            return '<%s instance>' % cls.__name__
+
+    def cap(self, text):
+        """
+        Cuts the middle out of a repr longer than the other values may be.
+
+        :Parameters:
+           - `text`: repr to cap
+        """
+        if len(text) <= self.maxother:
+            return text
+        i = max(0, (self.maxother - 3) // 2)
+        j = max(0, self.maxother - 3 - i)
+        return text[:i] + '...' + text[len(text) - j:]
+
+    def repr_instance(self, x, level):
+        """
+        Returns the repr object.__repr__ would give, also for old style
+        instances.
+
+        :Parameters:
+           - `x`: value
+           - `level`: remaining depth
+        """
+        cls = type(x)
+        if cls is types.InstanceType:
+            cls = x.__class__
+        return '<%s.%s object at 0x%x>' % (cls.__module__, cls.__name__, id(x))
+
+
+class CapturePolicy(object):
+    """
+    Decides what request data an event keeps. META keys are filtered
+    through a whitelist and blacklist, every value is capped in bytes, and
+    the traceback and request data together are kept under a ceiling. POST
+    is only captured when it costs nothing: request bodies which were not
+    read are never read.
+    """
+
+    def __init__(self, meta_whitelist=None, meta_blacklist=None,
+                 max_value_bytes=None, max_values=None, max_post_bytes=None,
+                 max_event_bytes=None, frame_locals=None,
+                 frame_locals_budget=None, max_repr_length=None,
+                 max_repr_depth=None):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `meta_whitelist`: META keys to keep, * and ? match anything.
+             Defaults to ERROR_CAPTURE_META_WHITELIST or META_WHITELIST.
+           - `meta_blacklist`: META keys to drop even if whitelisted.
+             Defaults to ERROR_CAPTURE_META_BLACKLIST.
+           - `max_value_bytes`: most bytes kept of each value. Defaults to
+             ERROR_CAPTURE_MAX_VALUE_BYTES or MAX_VALUE_BYTES.
+           - `max_values`: most values kept of each GET/POST key. Defaults
+             to ERROR_CAPTURE_MAX_VALUES or MAX_VALUES.
+           - `max_post_bytes`: largest body parsed for POST. Defaults to
+             ERROR_CAPTURE_MAX_POST_BYTES or MAX_POST_BYTES.
+           - `max_event_bytes`: ceiling for the traceback and request data.
+             Defaults to ERROR_CAPTURE_MAX_EVENT_BYTES or MAX_EVENT_BYTES.
+           - `frame_locals`: number of innermost frames to keep the local
+             variables of. Defaults to ERROR_CAPTURE_FRAME_LOCALS or 0.
+           - `frame_locals_budget`: most milliseconds spent on the reprs of
+             local variables for one event. Defaults to
+             ERROR_CAPTURE_FRAME_LOCALS_BUDGET_MS or FRAME_LOCALS_BUDGET_MS.
+           - `max_repr_length`: most characters of each repr. Defaults to
+             ERROR_CAPTURE_MAX_REPR_LENGTH or MAX_REPR_LENGTH.
+           - `max_repr_depth`: most levels of nested containers shown.
+             Defaults to ERROR_CAPTURE_MAX_REPR_DEPTH or MAX_REPR_DEPTH.
+        """
+        if meta_whitelist is None:
+            meta_whitelist = getattr(
+                settings, 'ERROR_CAPTURE_META_WHITELIST', META_WHITELIST)
+        if meta_blacklist is None:
+            meta_blacklist = getattr(
+                settings, 'ERROR_CAPTURE_META_BLACKLIST', ())
+        if max_value_bytes is None:
+            max_value_bytes = getattr(
+                settings, 'ERROR_CAPTURE_MAX_VALUE_BYTES', MAX_VALUE_BYTES)
+        if max_values is None:
+            max_values = getattr(
+                settings, 'ERROR_CAPTURE_MAX_VALUES', MAX_VALUES)
+        if max_post_bytes is None:
+            max_post_bytes = getattr(
+                settings, 'ERROR_CAPTURE_MAX_POST_BYTES', MAX_POST_BYTES)
+        if max_event_bytes is None:
+            max_event_bytes = getattr(
+                settings, 'ERROR_CAPTURE_MAX_EVENT_BYTES', MAX_EVENT_BYTES)
+        if frame_locals is None:
+            frame_locals = getattr(settings, 'ERROR_CAPTURE_FRAME_LOCALS', 0)
+        if frame_locals_budget is None:
+            frame_locals_budget = getattr(settings,
+                'ERROR_CAPTURE_FRAME_LOCALS_BUDGET_MS', FRAME_LOCALS_BUDGET_MS)
+        if max_repr_length is None:
+            max_repr_length = getattr(
+                settings, 'ERROR_CAPTURE_MAX_REPR_LENGTH', MAX_REPR_LENGTH)
+        if max_repr_depth is None:
+            max_repr_depth = getattr(
+                settings, 'ERROR_CAPTURE_MAX_REPR_DEPTH', MAX_REPR_DEPTH)
+        self.whitelist_rx = _compile(meta_whitelist)
+        self.blacklist_rx = _compile(meta_blacklist)
+        self.max_value_bytes = max_value_bytes
+        self.max_values = max_values
+        self.max_post_bytes = max_post_bytes
+        self.max_event_bytes = max_event_bytes
+        self.frame_locals = frame_locals
+        self.frame_locals_budget = frame_locals_budget / 1000.0
+        self.repr = LimitedRepr(max_repr_length, max_repr_depth).repr
+
+    def keep_meta(self, key):
+        """
+        True if a META key is captured.
+
+        :Parameters:
+           - `key`: META key
+        """
+        if self.whitelist_rx is None or not self.whitelist_rx.match(key):
+            return False
+        return self.blacklist_rx is None or not self.blacklist_rx.match(key)
+
+    def cap(self, value):
+        """
+        Returns a value as text of at most max_value_bytes UTF-8 bytes.
+
+        :Parameters:
+           - `value`: value to cap
+        """
+        limit = self.max_value_bytes
+        if isinstance(value, str):
+            # Only decode what can be kept
+            value = value[:limit]
+        value = force_text(value, errors='replace')
+        # Nothing to do if it can't be over the limit even in UTF-8
+        if len(value) * 4 <= limit:
+            return value
+        encoded = value.encode('utf-8')
+        if len(encoded) <= limit:
+            return value
+        return encoded[:limit].decode('utf-8', 'ignore')
+
+    def cap_traceback(self, lines):
+        """
+        Returns the formatted traceback lines, keeping the first line and
+        as many of the last lines as fit in half of max_event_bytes.
+
+        :Parameters:
+           - `lines`: formatted traceback lines
+        """
+        limit = self.max_event_bytes // 2
+        if sum([len(x) for x in lines]) <= limit:
+            return lines
+        size = len(lines[0])
+        kept = []
+        for line in reversed(lines[1:]):
+            if size + len(line) > limit:
+                break
+            size += len(line)
+            kept.append(line)
+        if not kept:
+            # The exception line alone is too long
+            kept.append(lines[-1][:max(limit - size, 0)] + '\n')
+        kept.reverse()
+        return [lines[0], '  ... %d lines omitted ...\n' % (
+            len(lines) - len(kept) - 1)] + kept
+
+    def snapshot_locals(self, tb):
+        """
+        Returns (filename, line number, function, locals) for the innermost
+        frames of a traceback. The locals are shallow copies, so the frames
+        themselves are not kept.
+
+        :Parameters:
+           - `tb`: traceback object
+        """
+        if not self.frame_locals or tb is None:
+            return []
+        frames = []
+        while tb is not None:
+            frames.append(tb)
+            tb = tb.tb_next
+        snapshot = []
+        for tb in frames[-self.frame_locals:]:
+            frame = tb.tb_frame
+            snapshot.append((frame.f_code.co_filename, tb.tb_lineno,
+                frame.f_code.co_name, dict(frame.f_locals)))
+        return snapshot
+
+    def repr_locals(self, snapshot):
+        """
+        Returns JSON safe dictionaries of the frames of a snapshot with a
+        capped repr of each local variable. Once the time budget is used up
+        the remaining variables are left out.
+
+        :Parameters:
+           - `snapshot`: output of snapshot_locals
+        """
+        deadline = time.time() + self.frame_locals_budget
+        frames = []
+        for filename, lineno, function, local_vars in reversed(snapshot):
+            values = []
+            for name in sorted(local_vars):
+                if time.time() > deadline:
+                    values.append(['...', 'time budget used up'])
+                    break
+                values.append([name, self.repr(local_vars[name])])
+            # Innermost frame first so it gets the budget, shown last
+            frames.insert(0, {'filename': filename, 'lineno': lineno,
+                'function': function, 'locals': values})
+        return frames
+
+    def request_post(self, request):
+        """
+        Returns the POST data of a request if it can be had without reading
+        the body or parsing a large one, otherwise None.
+
+        :Parameters:
+           - `request`: request causing the exception
+        """
+        if not isinstance(request, HttpRequest):
+            return getattr(request, 'POST', None)
+        post = getattr(request, '_post', None)
+        if post is not None:
+            # Already parsed
+            return post
+        if request.method != 'POST' or not hasattr(request, '_body'):
+            return None
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if (content_type.startswith('multipart/') or
+                len(request._body) > self.max_post_bytes):
+            return None
+        return request.POST
+
+    def capture(self, request, used=0):
+        """
+        Returns (META, GET, POST) captured from a request. Values are taken
+        in that order until the ceiling is reached.
+
+        :Parameters:
+           - `request`: request causing the exception
+           - `used`: bytes of the event used already, like the traceback
+        """
+        remaining = self.max_event_bytes - used
+        meta = {}
+        for key, value in getattr(request, 'META', {}).items():
+            if not self.keep_meta(key):
+                continue
+            if isinstance(value, (int, long, float, bool)):
+                size = len(key) + 8
+            elif isinstance(value, basestring):
+                value = self.cap(value)
+                size = len(key) + len(value)
+            else:
+                # Streams, handlers and other objects
+                continue
+            if size > remaining:
+                continue
+            remaining -= size
+            meta[key] = value
+        queries = []
+        for query in (getattr(request, 'GET', None),
+                      self.request_post(request)):
+            captured = MultiValueDict()
+            for key, values in _lists(query or {}):
+                for value in values[:self.max_values]:
+                    value = self.cap(value)
+                    size = len(key) + len(value)
+                    if size > remaining:
+                        break
+                    remaining -= size
+                    captured.appendlist(key, value)
+            queries.append(captured)
+        return meta, queries[0], queries[1]
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_capture_policy():
+    """
+    Returns the shared CapturePolicy, creating it from the settings on
+    first use.
+    """
+    global _policy
+    if _policy is None:
+        _policy_lock.acquire()
+        try:
+            if _policy is None:
+                _policy = CapturePolicy()
+        finally:
+            _policy_lock.release()
+    return _policy
+
+
+def _setting_changed(setting, **kwargs):
+    """
+    Drops the shared policy when one of its settings changes.
+
+    :Parameters:
+       - `setting`: name of the setting which changed
+       - `kwargs`: other signal arguments
+    """
+    global _policy
+    if setting in SETTINGS:
+        _policy = None
+
+
+setting_changed.connect(_setting_changed)
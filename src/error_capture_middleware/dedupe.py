@@ -0,0 +1,490 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Duplicate exception suppression.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import atexit
+import logging
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from django.conf import settings
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:
+    from django.core.cache import get_cache
+
+
+logger = logging.getLogger('error_capture_middleware')
+
+
+class TTLCache(object):
+    """
+    Small, thread safe, in process LRU where every entry has its own
+    expiration time.
+    """
+
+    def __init__(self, max_size=1000, on_discard=None):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `max_size`: most entries to hold before dropping the least
+             recently used
+           - `on_discard`: optional callable taking (key, value) which is
+             called when an entry expires or is dropped
+        """
+        self.max_size = max_size
+        self.on_discard = on_discard
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _discarded(self, items):
+        """
+        Passes dropped entries to on_discard outside of the lock.
+
+        :Parameters:
+           - `items`: list of (key, value) pairs
+        """
+        if self.on_discard is not None:
+            for key, value in items:
+                self.on_discard(key, value)
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key if it is present and not expired.
+
+        :Parameters:
+           - `key`: key to look up
+           - `default`: returned when the key is missing or expired
+        """
+        self._lock.acquire()
+        try:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires > time.time():
+                # Reinsert so it becomes the most recently used
+                self._data[key] = (expires, value)
+                return value
+        finally:
+            self._lock.release()
+        self._discarded([(key, value)])
+        return default
+
+    def set(self, key, value, expires):
+        """
+        Stores a value until the expires timestamp.
+
+        :Parameters:
+           - `key`: key to store under
+           - `value`: value to store
+           - `expires`: unix timestamp the entry is valid until
+        """
+        dropped = []
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_size:
+                old_key, (old_expires, old_value) = self._data.popitem(
+                    last=False)
+                dropped.append((old_key, old_value))
+        finally:
+            self._lock.release()
+        self._discarded(dropped)
+
+    def expire(self, now=None):
+        """
+        Drops the expired entries and returns them as (key, value) pairs
+        instead of passing them to on_discard.
+
+        :Parameters:
+           - `now`: unix timestamp to expire at, defaults to now
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            expired = [(key, value) for key, (expires, value)
+                in self._data.items() if expires <= now]
+            for key, value in expired:
+                del self._data[key]
+        finally:
+            self._lock.release()
+        return expired
+
+    def items(self):
+        """
+        Returns a list of the (key, value) pairs which have not expired.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            return [(key, value) for key, (expires, value)
+                in self._data.items() if expires > now]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        """
+        Number of entries, including expired ones not yet dropped.
+        """
+        return len(self._data)
+
+
+class Occurrences(object):
+    """
+    How often a fingerprint was seen within one duplicate window.
+    """
+
+    __slots__ = ['fingerprint', 'count', 'first_seen', 'last_seen']
+
+    def __init__(self, fingerprint, count, first_seen, last_seen):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+           - `count`: number of occurrences, including the dispatched one
+           - `first_seen`: unix timestamp of the first occurrence
+           - `last_seen`: unix timestamp of the last occurrence
+        """
+        self.fingerprint = fingerprint
+        self.count = count
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+
+    def __repr__(self):
+        """
+        String representation of this object.
+        """
+        return '<Occurrences %s: %s>' % (self.fingerprint, self.count)
+
+
+def log_window(occurrences):
+    """
+    Default report of a closed duplicate window.
+
+    :Parameters:
+       - `occurrences`: Occurrences of the window
+    """
+    logger.info('%s occurred %s times in its duplicate window' % (
+        occurrences.fingerprint, occurrences.count))
+
+
+class _LocalWindow(object):
+    """
+    Process local state of an open duplicate window. Suppressed occurrences
+    are counted in pending until they are flushed to the shared cache.
+    owner is True in the process which opened the window.
+    """
+
+    __slots__ = ['pending', 'last_seen', 'flushed_at', 'owner']
+
+    def __init__(self, now, pending=0, owner=False):
+        self.pending = pending
+        self.last_seen = now
+        self.flushed_at = now
+        self.owner = owner
+
+
+class DuplicateCache(object):
+    """
+    Two tier record of recently handled fingerprints.
+
+    The first occurrence of a fingerprint opens a window with an atomic
+    cache add, so exactly one process dispatches it. Repeats within the
+    window are counted instead of dropped: in process first, then flushed
+    to a shared counter with incr. A background thread flushes the local
+    counts every flush_interval and closes the windows this process opened
+    once they expire, passing their Occurrences to on_close. If the next
+    window opens first the counts are handed back by record instead.
+    """
+
+    key_prefix = 'error-capture-'
+    # How long window statistics wait for the next window to collect them
+    stats_timeout = 86400
+
+    def __init__(self, timeout=None, local_size=None, cache_alias=None,
+                 flush_interval=1, on_close=log_window):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `timeout`: seconds to ignore duplicates. Defaults to
+             ERROR_CAPTURE_IGNORE_DUPE_SEC.
+           - `local_size`: entries to keep in process. Defaults to
+             ERROR_CAPTURE_DUPE_LOCAL_SIZE or 1000.
+           - `cache_alias`: Django cache to share between processes.
+             Defaults to ERROR_CAPTURE_DUPE_CACHE or 'default'.
+           - `flush_interval`: most seconds suppressed occurrences stay
+             local before being added to the shared counter
+           - `on_close`: callable taking the Occurrences of a window which
+             expired without a repeat opening the next one
+        """
+        if timeout is None:
+            timeout = settings.ERROR_CAPTURE_IGNORE_DUPE_SEC
+        if local_size is None:
+            local_size = getattr(
+                settings, 'ERROR_CAPTURE_DUPE_LOCAL_SIZE', 1000)
+        if cache_alias is None:
+            cache_alias = getattr(
+                settings, 'ERROR_CAPTURE_DUPE_CACHE', 'default')
+        self.timeout = int(timeout or 0)
+        self.flush_interval = flush_interval
+        self.on_close = on_close
+        self.local = TTLCache(local_size, on_discard=self._flush)
+        self.cache = get_cache(cache_alias)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def _keys(self, fingerprint):
+        """
+        Returns the window, count, first seen and last seen cache keys.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+        """
+        key = self.key_prefix + fingerprint
+        return key, key + '-count', key + '-first', key + '-last'
+
+    def record(self, fingerprint):
+        """
+        Records an occurrence of a fingerprint. Returns a (dispatch,
+        previous) tuple where dispatch is True if this occurrence opened a
+        new window and should go to the handlers. previous holds the
+        Occurrences of the last window for this fingerprint, if known.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+        """
+        if self.timeout <= 0:
+            return True, None
+        if self._thread is None:
+            self.start()
+        now = time.time()
+        window = self.local.get(fingerprint)
+        if window is not None:
+            self._lock.acquire()
+            try:
+                window.pending += 1
+                window.last_seen = now
+                flush = now - window.flushed_at >= self.flush_interval
+            finally:
+                self._lock.release()
+            if flush:
+                self._flush(fingerprint, window)
+            return False, None
+
+        key = self._keys(fingerprint)[0]
+        expires = now + self.timeout
+        if self.cache.add(key, expires, self.timeout):
+            previous = self._open(fingerprint, now)
+            self.local.set(fingerprint, _LocalWindow(now, owner=True), expires)
+            return True, previous
+        # Another process owns the window, count this one locally. The
+        # shared entry holds its expiration so the local copy does not
+        # outlive it.
+        expires = self.cache.get(key) or expires
+        self.local.set(fingerprint, _LocalWindow(now, 1), expires)
+        return False, None
+
+    def _open(self, fingerprint, now):
+        """
+        Starts the statistics of a new window and returns the Occurrences
+        of the previous one.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+           - `now`: unix timestamp of the occurrence
+        """
+        key, count_key, first_key, last_key = self._keys(fingerprint)
+        stats = self.cache.get_many([count_key, first_key, last_key])
+        self.cache.set_many(
+            {first_key: now, last_key: now}, self.stats_timeout)
+        count = self._take_count(count_key, stats)
+        if first_key not in stats:
+            return None
+        return Occurrences(fingerprint, count + 1, stats[first_key],
+            stats.get(last_key, stats[first_key]))
+
+    def _take_count(self, count_key, stats):
+        """
+        Returns the shared count read into stats and subtracts it from the
+        counter. Subtracting rather than resetting keeps increments which
+        arrive late for the next window.
+
+        :Parameters:
+           - `count_key`: cache key of the counter
+           - `stats`: values read from the cache
+        """
+        count = stats.get(count_key) or 0
+        if count:
+            try:
+                self.cache.decr(count_key, count)
+            except ValueError:
+                pass
+        return count
+
+    def _close(self, fingerprint):
+        """
+        Reports the Occurrences of an expired window to on_close and
+        returns them. Nothing is reported if the next window opened
+        already, it hands them back itself.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+        """
+        key, count_key, first_key, last_key = self._keys(fingerprint)
+        if self.cache.get(key) is not None:
+            return None
+        stats = self.cache.get_many([count_key, first_key, last_key])
+        if first_key not in stats:
+            return None
+        self.cache.delete_many([first_key, last_key])
+        count = self._take_count(count_key, stats)
+        occurrences = Occurrences(fingerprint, count + 1, stats[first_key],
+            stats.get(last_key, stats[first_key]))
+        if self.on_close is not None:
+            self.on_close(occurrences)
+        return occurrences
+
+    def _flush(self, fingerprint, window):
+        """
+        Adds the pending local occurrences of a window to the shared
+        counter.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+           - `window`: _LocalWindow to flush
+        """
+        self._lock.acquire()
+        try:
+            pending, window.pending = window.pending, 0
+            window.flushed_at = time.time()
+        finally:
+            self._lock.release()
+        if not pending:
+            return
+        key, count_key, first_key, last_key = self._keys(fingerprint)
+        try:
+            self.cache.incr(count_key, pending)
+        except ValueError:
+            if not self.cache.add(count_key, pending, self.stats_timeout):
+                try:
+                    self.cache.incr(count_key, pending)
+                except ValueError:
+                    pass
+        self.cache.set(last_key, window.last_seen, self.stats_timeout)
+
+    def flush(self):
+        """
+        Flushes the pending occurrences of every local window.
+        """
+        for fingerprint, window in self.local.items():
+            self._flush(fingerprint, window)
+
+    def sweep(self, now=None):
+        """
+        Flushes local counts older than flush_interval, then drops the
+        expired windows and closes those this process opened. Returns the
+        number of windows closed.
+
+        :Parameters:
+           - `now`: unix timestamp to sweep at, defaults to now
+        """
+        if now is None:
+            now = time.time()
+        for fingerprint, window in self.local.items():
+            if (window.pending and
+                    now - window.flushed_at >= self.flush_interval):
+                self._flush(fingerprint, window)
+        closed = 0
+        for fingerprint, window in self.local.expire(now):
+            self._flush(fingerprint, window)
+            if window.owner and self._close(fingerprint) is not None:
+                closed += 1
+        return closed
+
+    def _run(self):
+        """
+        Sweeper thread loop.
+        """
+        while not self._stopped.isSet():
+            self._stopped.wait(self.flush_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Error capture duplicate sweep failed')
+
+    def start(self):
+        """
+        Starts the sweeper thread. record starts it when first used.
+        """
+        self._lock.acquire()
+        try:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='error-capture-duplicates')
+            self._thread.daemon = True
+        finally:
+            self._lock.release()
+        self._thread.start()
+        atexit.register(self.stop, 5)
+
+    def stop(self, timeout=None):
+        """
+        Stops the sweeper thread and flushes what is left locally.
+
+        :Parameters:
+           - `timeout`: most seconds to wait for the sweeper
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
@@ -0,0 +1,443 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Error events shared by all handlers.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import binascii
+import os
+import socket
+import time
+import traceback
+
+from django.utils.datastructures import MultiValueDict
+from django.utils.encoding import force_text
+
+from error_capture_middleware.capture import get_capture_policy
+
+
+# The host name doesn't change so only ask for it once
+_hostname = None
+
+# Crockford's base32, used for event ids
+ID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+def get_hostname():
+    """
+    Returns the host name of this server.
+    """
+    global _hostname
+    if _hostname is None:
+        _hostname = socket.gethostname()
+    return _hostname
+
+
+def new_event_id(timestamp=None):
+    """
+    Returns a new ULID: 48 bits of milliseconds followed by 80 random bits
+    as 26 characters of Crockford's base32, so ids sort by time.
+
+    :Parameters:
+       - `timestamp`: unix timestamp of the id, defaults to now
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    # os.urandom so forked workers don't share a random sequence
+    value = (int(timestamp * 1000) << 80 |
+        int(binascii.hexlify(os.urandom(10)), 16))
+    chars = []
+    for i in xrange(26):
+        chars.append(ID_ALPHABET[value & 31])
+        value >>= 5
+    chars.reverse()
+    return ''.join(chars)
+
+
+class lazy_field(object):
+    """
+    Read only ErrorEvent field computed on first access and cached in the
+    event.
+    """
+
+    def __init__(self, func):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `func`: method computing the value
+        """
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        """
+        Returns the cached value, computing it if needed.
+        """
+        if instance is None:
+            return self
+        cache = instance._cache
+        try:
+            return cache[self.name]
+        except KeyError:
+            value = cache[self.name] = self.func(instance)
+            return value
+
+
+class DetachedException(Exception):
+    """
+    Stands in for the original exception of a detached event.
+    """
+
+    def __init__(self, type_name, message):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `type_name`: class name of the original exception
+           - `message`: message of the original exception
+        """
+        Exception.__init__(self, message)
+        self.type_name = type_name
+
+
+class DetachedRequest(object):
+    """
+    Stands in for the original request of a detached event.
+    """
+
+    def __init__(self, event):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `event`: detached ErrorEvent
+        """
+        self.META = event.meta
+        self.GET = event.get
+        self.POST = event.post
+        self.user_id = event.user_id
+
+    @property
+    def user(self):
+        """
+        The user who caused the exception or None.
+        """
+        if self.user_id is None:
+            return None
+        from django.contrib.auth import get_user_model
+        try:
+            return get_user_model().objects.get(pk=self.user_id)
+        except Exception:
+            return None
+
+
+class ErrorEvent(object):
+    """
+    Immutable snapshot of one captured exception, created once by the
+    middleware and passed to every handler. Expensive fields are computed
+    on first access and then shared.
+
+    Events restored with from_dict are detached: they carry no request,
+    exception or traceback objects, only the serialized fields.
+    """
+
+    __slots__ = ['id', 'request', 'exception', 'exc_info', 'fingerprint',
+        'occurrences', 'timestamp', 'sample_weight', 'policy', '_cache']
+
+    # Fields included in to_dict
+    serialized_fields = ('exception_type', 'exception_message', 'traceback',
+        'frames', 'frame_locals', 'hostname', 'user_id')
+
+    def __init__(self, request, exception, exc_info, fingerprint=None,
+                 occurrences=None, timestamp=None, event_id=None,
+                 policy=None, sample_weight=1):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `request`: request causing the exception
+           - `exception`: actual exception raised
+           - `exc_info`: info from sys.exc_info
+           - `fingerprint`: fingerprint of the exception
+           - `occurrences`: Occurrences of the previous duplicate window
+           - `timestamp`: unix timestamp of the exception, defaults to now
+           - `event_id`: id of the event, defaults to a new ULID
+           - `policy`: CapturePolicy deciding what is kept of the request.
+             Defaults to the shared one.
+           - `sample_weight`: number of occurrences this one stands for
+        """
+        timestamp = timestamp or time.time()
+        set_field = object.__setattr__
+        set_field(self, 'id', event_id or new_event_id(timestamp))
+        set_field(self, 'request', request)
+        set_field(self, 'exception', exception)
+        set_field(self, 'exc_info', exc_info)
+        set_field(self, 'fingerprint', fingerprint)
+        set_field(self, 'occurrences', occurrences)
+        set_field(self, 'timestamp', timestamp)
+        set_field(self, 'sample_weight', sample_weight)
+        set_field(self, 'policy', policy or get_capture_policy())
+        set_field(self, '_cache', {})
+
+    def __setattr__(self, name, value):
+        """
+        Events can not be changed.
+        """
+        raise AttributeError('ErrorEvent is immutable')
+
+    @property
+    def detached(self):
+        """
+        True if the event was restored without its original objects.
+        """
+        return self.request is None
+
+    @lazy_field
+    def exception_type(self):
+        """
+        Class name of the exception.
+        """
+        return self.exception.__class__.__name__
+
+    @lazy_field
+    def exception_message(self):
+        """
+        Message of the exception.
+        """
+        return force_text(self.exception, errors='replace')
+
+    @lazy_field
+    def traceback(self):
+        """
+        Formatted traceback lines, capped by the policy.
+        """
+        return self.policy.cap_traceback(
+            traceback.format_exception(*self.exc_info))
+
+    @lazy_field
+    def frames(self):
+        """
+        (filename, line number, function, source line) of every frame.
+        """
+        return [list(x) for x in traceback.extract_tb(self.exc_info[2])]
+
+    @lazy_field
+    def locals_snapshot(self):
+        """
+        Shallow copies of the locals of the innermost frames, taken when
+        the policy asks for frame locals.
+        """
+        return self.policy.snapshot_locals(
+            self.exc_info and self.exc_info[2])
+
+    @lazy_field
+    def frame_locals(self):
+        """
+        Frames with capped reprs of their local variables. The reprs are
+        only made when this is first used and the snapshot is dropped
+        afterwards.
+        """
+        frames = self.policy.repr_locals(self.locals_snapshot)
+        self._cache.pop('locals_snapshot', None)
+        return frames
+
+    @lazy_field
+    def payload(self):
+        """
+        (META, GET, POST) captured from the request by the policy.
+        """
+        return self.policy.capture(
+            self.request, sum([len(x) for x in self.traceback]))
+
+    @lazy_field
+    def meta(self):
+        """
+        Captured request META.
+        """
+        return self.payload[0]
+
+    @lazy_field
+    def get(self):
+        """
+        Captured request GET.
+        """
+        return self.payload[1]
+
+    @lazy_field
+    def post(self):
+        """
+        Captured request POST.
+        """
+        return self.payload[2]
+
+    @lazy_field
+    def hostname(self):
+        """
+        Name of the server the exception happened on.
+        """
+        return get_hostname()
+
+    @lazy_field
+    def user_id(self):
+        """
+        Primary key of the user causing the exception or None.
+        """
+        return getattr(getattr(self.request, 'user', None), 'pk', None)
+
+    @lazy_field
+    def context_data(self):
+        """
+        Dictionary of template variables describing the exception.
+        """
+        data = {'traceback': self.traceback,
+            'event_id': self.id,
+            'sample_weight': self.sample_weight,
+            'occurrences': self.occurrences,
+            'fingerprint': self.fingerprint}
+        data.update(self.meta)
+        data["GET"] = self.get
+        data["POST"] = self.post
+        data["SERVER_HOSTNAME"] = self.hostname
+        # Templates call it, so the reprs are only made if they are used
+        data["frame_locals"] = self.get_frame_locals
+        return data
+
+    def get_frame_locals(self):
+        """
+        Returns frame_locals.
+        """
+        return self.frame_locals
+
+    def snapshot(self):
+        """
+        Copies the locals of the innermost frames the policy keeps, which
+        the code still running could change. Everything else is left for
+        the handler or worker which first uses it.
+        """
+        if self.exc_info is not None and self.exc_info[2] is not None:
+            self.locals_snapshot
+
+    def release(self):
+        """
+        Works out everything needed from the traceback object and drops it,
+        so the frames and everything they reference are not kept alive
+        while handlers run in the background.
+        """
+        if self.exc_info is None or self.exc_info[2] is None:
+            return
+        self.traceback
+        self.frames
+        if 'frame_locals' not in self._cache:
+            self.locals_snapshot
+        object.__setattr__(self, 'exc_info', self.exc_info[:2] + (None, ))
+
+    def __reduce__(self):
+        """
+        Pickles events as their compact, detached form.
+        """
+        return (_restore_event, (self.to_dict(), ))
+
+    def to_dict(self):
+        """
+        Returns a compact, JSON safe dictionary of the event. The request
+        data is what the policy captured.
+        """
+        data = dict([(x, getattr(self, x)) for x in self.serialized_fields])
+        occurrences = self.occurrences
+        if occurrences is not None and not isinstance(occurrences, dict):
+            occurrences = {
+                'fingerprint': occurrences.fingerprint,
+                'count': occurrences.count,
+                'first_seen': occurrences.first_seen,
+                'last_seen': occurrences.last_seen,
+            }
+        data.update({
+            'META': self.meta,
+            'GET': dict(self.get.lists()),
+            'POST': dict(self.post.lists()),
+            'occurrences': occurrences,
+            'fingerprint': self.fingerprint,
+            'timestamp': self.timestamp,
+            'id': self.id,
+            'sample_weight': self.sample_weight,
+        })
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Restores a detached event from to_dict output.
+
+        :Parameters:
+           - `data`: dictionary from to_dict
+        """
+        event = cls(None, None, None, data['fingerprint'],
+            data['occurrences'], data['timestamp'], data.get('id'),
+            sample_weight=data.get('sample_weight', 1))
+        cache = event._cache
+        for name in cls.serialized_fields:
+            cache[name] = data.get(name)
+        cache['meta'] = data['META']
+        cache['get'] = MultiValueDict(data['GET'])
+        cache['post'] = MultiValueDict(data['POST'])
+        return event
+
+    def get_request(self):
+        """
+        Returns the request, or a stand in for detached events.
+        """
+        if self.request is None:
+            return DetachedRequest(self)
+        return self.request
+
+    def get_exception(self):
+        """
+        Returns the exception, or a stand in for detached events.
+        """
+        if self.exception is None:
+            return DetachedException(
+                self.exception_type, self.exception_message)
+        return self.exception
+
+
+def _restore_event(data):
+    """
+    Unpickles an ErrorEvent.
+
+    :Parameters:
+       - `data`: dictionary from ErrorEvent.to_dict
+    """
+    return ErrorEvent.from_dict(data)
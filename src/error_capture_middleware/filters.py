@@ -0,0 +1,128 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Exception filtering.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import inspect
+import re
+
+from django.conf import settings
+
+
+class ExceptionFilter(object):
+    """
+    Compiled class and traceback content blacklists. Class checks walk the
+    MRO so subclasses of blacklisted classes match too, and the result is
+    memoized per exception type. Content patterns without flags or groups
+    are joined into a single regular expression, the others are kept as
+    they are so their flags and group references still work.
+    """
+
+    def __init__(self, classes=None, patterns=None):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `classes`: classes to blacklist. Defaults to
+             ERROR_CAPTURE_TRACE_CLASS_BLACKLIST.
+           - `patterns`: strings or compiled regular expressions to
+             blacklist. Defaults to ERROR_CAPTURE_TRACE_CONTENT_BLACKLIST.
+        """
+        if classes is None:
+            classes = getattr(
+                settings, 'ERROR_CAPTURE_TRACE_CLASS_BLACKLIST', None) or ()
+        if patterns is None:
+            patterns = getattr(
+                settings, 'ERROR_CAPTURE_TRACE_CONTENT_BLACKLIST', None) or ()
+        self.classes = frozenset(classes)
+        self.content_rxs = []
+        joined = []
+        for pattern in patterns:
+            compiled = re.compile(pattern)
+            if compiled.flags or compiled.groups:
+                self.content_rxs.append(compiled)
+            else:
+                joined.append('(?:%s)' % compiled.pattern)
+        if joined:
+            self.content_rxs.insert(0, re.compile('|'.join(joined)))
+        self._class_results = {}
+
+    @property
+    def needs_content(self):
+        """
+        True if checking requires the formatted traceback.
+        """
+        return bool(self.content_rxs)
+
+    def class_blacklisted(self, exc_type):
+        """
+        Checks if an exception type or any of its parents is blacklisted.
+
+        :Parameters:
+           - `exc_type`: type of the exception
+        """
+        try:
+            return self._class_results[exc_type]
+        except KeyError:
+            result = bool(self.classes.intersection(inspect.getmro(exc_type)))
+            self._class_results[exc_type] = result
+            return result
+
+    def content_blacklisted(self, trace_content):
+        """
+        Checks if the traceback content matches a blacklisted pattern.
+
+        :Parameters:
+           - `trace_content`: formatted traceback
+        """
+        for content_rx in self.content_rxs:
+            if content_rx.search(trace_content) is not None:
+                return True
+        return False
+
+    def is_blacklisted(self, exception, trace_content=None):
+        """
+        Checks an exception against both blacklists. The content
+        blacklist is skipped if no trace content is given.
+
+        :Parameters:
+           - `exception`: actual exception being raised
+           - `trace_content`: formatted traceback
+        """
+        if self.classes and self.class_blacklisted(exception.__class__):
+            return True
+        if trace_content is not None:
+            return self.content_blacklisted(trace_content)
+        return False
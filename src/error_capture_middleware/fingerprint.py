@@ -0,0 +1,137 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Exception fingerprinting used to find duplicate exceptions.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+try:
+    from hashlib import sha1
+except ImportError, e:
+    from sha import new as sha1
+
+import inspect
+import traceback
+
+from django.conf import settings
+
+from error_capture_middleware.registry import import_object
+
+
+def normalize_line(line):
+    """
+    Normalizes a line of source so whitespace changes don't matter.
+
+    :Parameters:
+       - `line`: source line or None if it isn't available
+    """
+    if not line:
+        return ''
+    return ' '.join(line.split())
+
+
+def default_fingerprint(exception, tb):
+    """
+    Fingerprints an exception by its class and the file, function and
+    normalized source line of every frame. The message and line numbers
+    are left out so the same bug with different details (ids, addresses,
+    timestamps) gets the same fingerprint.
+
+    :Parameters:
+       - `exception`: actual exception raised
+       - `tb`: traceback object
+    """
+    exc_type = exception.__class__
+    parts = [exc_type.__module__, exc_type.__name__]
+    for filename, lineno, name, line in traceback.extract_tb(tb):
+        parts.extend((filename, name, normalize_line(line)))
+    return sha1('\0'.join(parts)).hexdigest()
+
+
+class Fingerprinter(object):
+    """
+    Picks and runs the fingerprint function for an exception. Functions can
+    be registered per exception class and are looked up along the MRO, with
+    the result memoized per exception type.
+    """
+
+    def __init__(self, fingerprinters=None, default=default_fingerprint):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `fingerprinters`: mapping of exception classes to fingerprint
+             functions. Either may be a dotted path. Defaults to
+             ERROR_CAPTURE_FINGERPRINTERS.
+           - `default`: fingerprint function used when nothing else matches
+        """
+        if fingerprinters is None:
+            fingerprinters = getattr(
+                settings, 'ERROR_CAPTURE_FINGERPRINTERS', None) or {}
+        self.fingerprinters = {}
+        for exc_type, func in fingerprinters.items():
+            if isinstance(exc_type, basestring):
+                exc_type = import_object(exc_type)
+            if isinstance(func, basestring):
+                func = import_object(func)
+            self.fingerprinters[exc_type] = func
+        self.default = default
+        self._resolved = {}
+
+    def get_fingerprinter(self, exc_type):
+        """
+        Returns the fingerprint function for an exception type.
+
+        :Parameters:
+           - `exc_type`: type of the exception
+        """
+        try:
+            return self._resolved[exc_type]
+        except KeyError:
+            func = self.default
+            for cls in inspect.getmro(exc_type):
+                if cls in self.fingerprinters:
+                    func = self.fingerprinters[cls]
+                    break
+            self._resolved[exc_type] = func
+            return func
+
+    def __call__(self, exception, tb):
+        """
+        Fingerprints an exception.
+
+        :Parameters:
+           - `exception`: actual exception raised
+           - `tb`: traceback object
+        """
+        return self.get_fingerprinter(exception.__class__)(exception, tb)
@@ -37,13 +37,128 @@ __docformat__ = 'restructuredtext'
 
 #from bugzilla import Bugzilla
 
+import socket
+import threading
+import xmlrpclib
+
 from django.conf import settings
-from django.template import loader
 
-from error_capture_middleware import ErrorCaptureHandler
+from error_capture_middleware import RemoteIssueHandler
+from error_capture_middleware.transport import set_connection_timeout
+
+
+#: Fault codes Bugzilla answers with when the login is missing or expired
+AUTH_FAULTS = (410, 32000)
+
+_local = threading.local()
+
 
+def set_client_timeout(client, timeout):
+    """
+    Applies a socket timeout to the XML-RPC transport of a Bugzilla client
+    so a stalled server can't hold a worker. python-bugzilla keeps the
+    transport in _transport, either a plain xmlrpclib one or one sending
+    through requests. Returns False if the client has neither.
+
+    :Parameters:
+       - `client`: Bugzilla client
+       - `timeout`: seconds to wait on the socket
+    """
+    transport = getattr(client, '_transport', None)
+    defaults = getattr(transport, 'request_defaults', None)
+    if isinstance(defaults, dict):
+        defaults['timeout'] = timeout
+        return True
+    if isinstance(transport, xmlrpclib.Transport):
+        return set_connection_timeout(transport, 'make_connection', timeout)
+    return False
 
-class BugzillaHandler(ErrorCaptureHandler):
+
+class BugzillaSession(object):
+    """
+    Logged in Bugzilla client which is kept for the life of a worker. The
+    client keeps its HTTP connection and login token between bugs and only
+    logs in again when Bugzilla rejects the token.
+    """
+
+    def __init__(self, factory, url, username, password, timeout=None):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `factory`: Bugzilla client class
+           - `url`: Bugzilla XML-RPC url
+           - `username`: user to log in as
+           - `password`: password of the user
+           - `timeout`: socket timeout of the client in seconds
+        """
+        self.factory = factory
+        self.url = url
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.client = None
+        self.logins = 0
+
+    def login(self):
+        """
+        Logs the client in, creating it first if needed.
+        """
+        if self.client is None:
+            self.client = self.factory(url=self.url)
+            if self.timeout is not None:
+                set_client_timeout(self.client, self.timeout)
+        self.client.login(self.username, self.password)
+        self.logins += 1
+
+    def call(self, name, *args, **kwargs):
+        """
+        Calls a client method, logging in again once if the token was
+        rejected.
+
+        :Parameters:
+           - `name`: name of the client method
+           - `args`: arguments for the method
+           - `kwargs`: keyword arguments for the method
+        """
+        try:
+            if self.client is None:
+                self.login()
+            try:
+                return getattr(self.client, name)(*args, **kwargs)
+            except xmlrpclib.Fault, e:
+                if e.faultCode not in AUTH_FAULTS:
+                    raise
+            self.login()
+            return getattr(self.client, name)(*args, **kwargs)
+        except (socket.error, xmlrpclib.ProtocolError):
+            # Start over with a new client next time
+            self.client = None
+            raise
+
+
+def get_session(factory, timeout=None):
+    """
+    Returns the BugzillaSession of the current worker thread for the
+    configured Bugzilla.
+
+    :Parameters:
+       - `factory`: Bugzilla client class
+       - `timeout`: socket timeout of the client in seconds
+    """
+    key = (factory, settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_SERVICE,
+        settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_USERNAME,
+        settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_PASSWORD, timeout)
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+    session = sessions.get(key)
+    if session is None:
+        session = sessions[key] = BugzillaSession(*key)
+    return session
+
+
+class BugzillaHandler(RemoteIssueHandler):
     """
     Bugzilla handler.
     """
@@ -63,6 +178,26 @@ class BugzillaHandler(ErrorCaptureHandler):
         'ERROR_CAPTURE_GOOGLE_BUGZILLA_PRIORITY',
     ]
 
+    templates = {
+        'title': 'django_error_capture_middleware/bugzilla/title.txt',
+        'body': 'django_error_capture_middleware/bugzilla/body.txt',
+        'comment': 'django_error_capture_middleware/bugzilla/comment.txt',
+    }
+
+    def comment_issue(self, issue, count, last_seen):
+        """
+        Comments the repeats on the bug.
+
+        :Parameters:
+           - `issue`: RemoteIssue being commented on
+           - `count`: number of repeats since the last comment
+           - `last_seen`: datetime of the last repeat
+        """
+        session = get_session(self.Bugzilla, self.call_timeout())
+        session.call('update_bugs', [int(issue.remote_id)],
+            {'comment': {'comment': self.render_comment(
+                issue, count, last_seen)}})
+
     def handle(self, request, exception, tb):
         """
         Pushes the traceback to a github ticket system.
@@ -72,20 +207,17 @@ class BugzillaHandler(ErrorCaptureHandler):
            - `exception`: actual exception raised
            - `tb`: traceback string
         """
+        # Repeats are commented on the existing bug
+        if self.repeat_issue():
+            return
 
         def get_data(queue):
-            # Create a client and login
-            bz = self.Bugzilla(
-                url=settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_SERVICE)
-            bz.login(settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_USERNAME,
-                settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_PASSWORD)
             # Setup the templates
-            title_tpl = loader.get_template(
-                'django_error_capture_middleware/bugzilla/title.txt')
-            body_tpl = loader.get_template(
-                'django_error_capture_middleware/bugzilla/body.txt')
-            # Add the issue
-            bug = bz.createbug(
+            title_tpl = self.get_template('title')
+            body_tpl = self.get_template('body')
+            # Add the issue with the logged in client of this worker
+            session = get_session(self.Bugzilla, self.call_timeout())
+            bug = session.call('createbug',
                 product=settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_PRODUCT,
                 component=settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_COMPONENT,
                 version=settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_VERSION,
@@ -96,9 +228,11 @@ class BugzillaHandler(ErrorCaptureHandler):
                 op_sys=settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_OS,
                 bug_file_loc=settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_LOC,
                 priority=settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_PRIORITY)
-            # pull the data we want out and throw it in the queue
-            queue.put_nowait(bug.bug_id)
+            # pull the data we want out and report it
+            self.remote_ticket(queue, bug.bug_id)
 
         # Execute the background call.
         queue, process = self.background_call(get_data)
-        self.context['id'] = self.get_data(queue)
+        ticket = self.get_data(queue)
+        if ticket is not None:
+            self.context['id'] = ticket[0]
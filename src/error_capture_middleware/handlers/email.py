@@ -35,22 +35,524 @@ Super simple ticket handler that uses the admin interface.
 __docformat__ = 'restructuredtext'
 
 
+import atexit
+import logging
+import os
+import smtplib
+import socket
+import threading
+import time
+
 from django.conf import settings
-from django.template import loader
+from django.core.mail import EmailMessage, get_connection
+from django.template import Context
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
 
 from error_capture_middleware import ErrorCaptureHandler
+from error_capture_middleware.registry import get_template_cache
+
+
+logger = logging.getLogger('error_capture_middleware')
+
+#: Errors from a connection the server dropped
+DROPPED_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+def render_subject(template, context):
+    """
+    Renders a subject template with the EMAIL_SUBJECT_PREFIX.
+
+    :Parameters:
+       - `template`: compiled subject template
+       - `context`: context to render with
+    """
+    # The render function appends a \n character at the end. Subjects
+    # can't have newlines.
+    subject = template.render(context).replace('\n', '')
+    return getattr(settings, 'EMAIL_SUBJECT_PREFIX', '') + subject
+
+
+class ConnectionPool(object):
+    """
+    Small pool of long lived mail connections which are reused across
+    events. Connections idle for a while are checked with a NOOP before
+    being reused and a send failing on a dropped connection is retried
+    once on a new one.
+    """
+
+    def __init__(self, size=2, max_idle=60, check_interval=10, backend=None):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `size`: most idle connections kept open
+           - `max_idle`: seconds an idle connection is kept open
+           - `check_interval`: seconds idle before a connection is checked
+           - `backend`: email backend path, EMAIL_BACKEND if None
+        """
+        self.size = size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.backend = backend
+        self.opened = 0
+        self.reused = 0
+        self.reconnects = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def reuse_rate(self):
+        """
+        Returns the fraction of sends which reused an open connection.
+        """
+        total = self.opened + self.reused
+        if not total:
+            return 0.0
+        return float(self.reused) / total
+
+    def stats(self):
+        """
+        Returns a dict of the pool counters.
+        """
+        return {'opened': self.opened, 'reused': self.reused,
+            'reconnects': self.reconnects, 'idle': len(self._idle),
+            'reuse_rate': self.reuse_rate()}
+
+    def is_alive(self, connection):
+        """
+        Returns True if an SMTP connection still answers a NOOP. Backends
+        without a socket are always alive.
+
+        :Parameters:
+           - `connection`: email backend instance
+        """
+        smtp = getattr(connection, 'connection', None)
+        if smtp is None or not hasattr(smtp, 'noop'):
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def open(self):
+        """
+        Opens a new connection.
+        """
+        connection = get_connection(self.backend, fail_silently=False)
+        connection.open()
+        self.opened += 1
+        return connection
+
+    def discard(self, connection):
+        """
+        Closes a connection which is not put back.
+
+        :Parameters:
+           - `connection`: email backend instance
+        """
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """
+        Returns an open connection, reusing an idle one when it is healthy.
+        """
+        now = time.time()
+        while True:
+            self._lock.acquire()
+            try:
+                if self._pid != os.getpid():
+                    # Forked, the sockets belong to the parent
+                    self._idle, self._pid = [], os.getpid()
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            finally:
+                self._lock.release()
+            idle = now - last_used
+            if idle > self.max_idle or (idle > self.check_interval and
+                    not self.is_alive(connection)):
+                self.discard(connection)
+                continue
+            self.reused += 1
+            return connection
+        return self.open()
+
+    def release(self, connection):
+        """
+        Puts a connection back for reuse or closes it if the pool is full.
+
+        :Parameters:
+           - `connection`: email backend instance
+        """
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append((connection, time.time()))
+                return
+        finally:
+            self._lock.release()
+        self.discard(connection)
+
+    def send(self, func, fail_silently=False):
+        """
+        Calls func with a pooled connection and returns its result. If the
+        connection turns out to be dropped func is retried once on a new
+        one.
+
+        :Parameters:
+           - `func`: callable taking the connection
+           - `fail_silently`: True to log a failure instead of raising it
+        """
+        try:
+            connection = self.acquire()
+            try:
+                try:
+                    result = func(connection)
+                except DROPPED_ERRORS:
+                    self.discard(connection)
+                    self.reconnects += 1
+                    connection = self.open()
+                    result = func(connection)
+            except Exception:
+                self.discard(connection)
+                raise
+        except Exception:
+            if not fail_silently:
+                raise
+            logger.exception('Error capture email could not be sent')
+            return None
+        self.release(connection)
+        return result
+
+    def close(self):
+        """
+        Closes the idle connections and logs the reuse rate.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for connection, last_used in idle:
+            self.discard(connection)
+        logger.debug('Error capture email connections: %(opened)s opened, '
+            '%(reused)s reused (%(reuse_rate).0f%%), %(reconnects)s '
+            'reconnects' % dict(self.stats(),
+                reuse_rate=self.reuse_rate() * 100))
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """
+    Returns the shared ConnectionPool.
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool_lock.acquire()
+        try:
+            if _connection_pool is None:
+                pool = ConnectionPool(
+                    getattr(settings, 'ERROR_CAPTURE_EMAIL_POOL_SIZE', 2),
+                    getattr(settings, 'ERROR_CAPTURE_EMAIL_POOL_IDLE_SEC', 60))
+                atexit.register(pool.close)
+                _connection_pool = pool
+        finally:
+            _connection_pool_lock.release()
+    return _connection_pool
+
+
+def close_connection_pool():
+    """
+    Closes the shared pool. The next get_connection_pool call creates a
+    new one.
+    """
+    global _connection_pool
+    _connection_pool_lock.acquire()
+    try:
+        pool, _connection_pool = _connection_pool, None
+    finally:
+        _connection_pool_lock.release()
+    if pool is not None:
+        pool.close()
+
+
+class EmailDigest(object):
+    """
+    Buffers emails for a window and sends them grouped by fingerprint with
+    counts, over a single connection. By default one summary message is
+    sent per window with the top fingerprints in detail. With split, each
+    of the top fingerprints gets its own message instead.
+    """
+
+    def __init__(self, window=60, top=10, split=False):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `window`: seconds between digests
+           - `top`: most fingerprints shown in detail
+           - `split`: True to send a message per fingerprint
+        """
+        self.window = window
+        self.top = top
+        self.split = split
+        self._groups = {}
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def add(self, fingerprint, count=1, render=None):
+        """
+        Adds occurrences of a fingerprint. render is only called for the
+        first occurrence in a window and returns its (subject, body).
+        Returns True if the fingerprint is new in this window.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+           - `count`: number of occurrences
+           - `render`: callable returning (subject, body)
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            group = self._groups.get(fingerprint)
+            if group is not None:
+                group['count'] += count
+                group['last_seen'] = now
+                if group['subject'] is not None or render is None:
+                    return False
+        finally:
+            self._lock.release()
+        # Render outside of the lock, only the first one is kept
+        subject, body = None, None
+        if render is not None:
+            subject, body = render()
+        self._lock.acquire()
+        try:
+            group = self._groups.get(fingerprint)
+            if group is None:
+                self._groups[fingerprint] = {'fingerprint': fingerprint,
+                    'count': count, 'first_seen': now, 'last_seen': now,
+                    'subject': subject, 'body': body}
+                return True
+            if group['subject'] is None:
+                group['subject'], group['body'] = subject, body
+            return False
+        finally:
+            self._lock.release()
+
+    def messages(self, groups, started, ended):
+        """
+        Returns the EmailMessages for the groups of a window.
+
+        :Parameters:
+           - `groups`: group dicts
+           - `started`: unix timestamp the window started
+           - `ended`: unix timestamp the window ended
+        """
+        groups = sorted(groups, key=lambda x: x['count'], reverse=True)
+        top, others = groups[:self.top], groups[self.top:]
+        from_email = getattr(settings, 'SERVER_EMAIL', None)
+        to = settings.ERROR_CAPTURE_ADMINS
+        if self.split:
+            return [EmailMessage(
+                '%s (%s times)' % (x['subject'], x['count']), x['body'] or '',
+                from_email, to) for x in top if x['subject'] is not None]
+        templates = get_template_cache()
+        context = Context({
+            'groups': top,
+            'total': sum([x['count'] for x in groups]),
+            'other_count': sum([x['count'] for x in others]),
+            'other_groups': len(others),
+            'window': int(ended - started),
+        })
+        subject = render_subject(templates.get(
+            EmailHandler.templates['digest_subject']), context)
+        body = templates.get(
+            EmailHandler.templates['digest_body']).render(context)
+        return [EmailMessage(subject, body, from_email, to)]
+
+    def flush(self):
+        """
+        Sends the digest of the buffered emails. Returns the number of
+        messages sent.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            groups, self._groups = self._groups, {}
+            started, self._started = self._started, now
+        finally:
+            self._lock.release()
+        if not groups:
+            return 0
+        messages = self.messages(groups.values(), started, now)
+        if not messages:
+            return 0
+        # One pooled connection for all of the messages
+        return get_connection_pool().send(
+            lambda connection: connection.send_messages(messages),
+            settings.ERROR_CAPTURE_EMAIL_FAIL_SILENTLY) or 0
+
+    def _run(self):
+        """
+        Digest thread loop.
+        """
+        while True:
+            self._stopped.wait(self.window)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error capture email digest failed')
+            # Checked after flushing so a stop always sends the buffer
+            if self._stopped.isSet():
+                return
+
+    def start(self):
+        """
+        Starts the digest thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='error-capture-email-digest')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the digest thread after sending what is buffered.
+
+        :Parameters:
+           - `timeout`: most seconds to wait for the digest thread
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+_digest = None
+_digest_lock = threading.Lock()
+
+
+def get_digest():
+    """
+    Returns the shared EmailDigest with its thread running or None if
+    ERROR_CAPTURE_EMAIL_DIGEST_SEC is not set.
+    """
+    global _digest
+    window = getattr(settings, 'ERROR_CAPTURE_EMAIL_DIGEST_SEC', None)
+    if not window:
+        return None
+    if _digest is None:
+        _digest_lock.acquire()
+        try:
+            if _digest is None:
+                digest = EmailDigest(window,
+                    getattr(settings, 'ERROR_CAPTURE_EMAIL_DIGEST_TOP', 10),
+                    getattr(settings, 'ERROR_CAPTURE_EMAIL_DIGEST_SPLIT',
+                        False))
+                digest.start()
+                atexit.register(digest.stop, 5)
+                _digest = digest
+        finally:
+            _digest_lock.release()
+    return _digest
+
+
+def stop_digest(timeout=None):
+    """
+    Stops the shared digest, sending what is buffered. The next get_digest
+    call creates a new one.
+
+    :Parameters:
+       - `timeout`: most seconds to wait for the digest thread
+    """
+    global _digest
+    _digest_lock.acquire()
+    try:
+        digest, _digest = _digest, None
+    finally:
+        _digest_lock.release()
+    if digest is not None:
+        digest.stop(timeout)
+
+
+def _setting_changed(setting, **kwargs):
+    """
+    Replaces the shared digest or connection pool when one of their
+    settings changes.
+
+    :Parameters:
+       - `setting`: name of the setting which changed
+       - `kwargs`: other signal arguments
+    """
+    if setting.startswith('ERROR_CAPTURE_EMAIL_DIGEST'):
+        stop_digest()
+    elif (setting.startswith('ERROR_CAPTURE_EMAIL_POOL') or
+            setting.startswith('EMAIL_')):
+        close_connection_pool()
+
+
+setting_changed.connect(_setting_changed)
 
 
 class EmailHandler(ErrorCaptureHandler):
     """
-    Replacement email handler.
+    Replacement email handler. With ERROR_CAPTURE_EMAIL_DIGEST_SEC set
+    emails are sent as digests instead of one per event.
     """
 
+    # Static so it isn't bound to the handler when used through self
     from django.core.mail import send_mail
+    send_mail = staticmethod(send_mail)
 
     required_settings = ['ERROR_CAPTURE_ADMINS',
         'ERROR_CAPTURE_EMAIL_FAIL_SILENTLY']
 
+    templates = {
+        'subject': 'django_error_capture_middleware/email/subject.txt',
+        'body': 'django_error_capture_middleware/email/body.txt',
+        'digest_subject':
+            'django_error_capture_middleware/email/digest_subject.txt',
+        'digest_body': 'django_error_capture_middleware/email/digest_body.txt',
+    }
+
+    # Suppressed occurrences are counted in digests
+    counts_occurrences = True
+
+    @classmethod
+    def count_occurrence(cls, fingerprint):
+        """
+        Counts a suppressed occurrence in the digest.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+        """
+        digest = get_digest()
+        if digest is not None:
+            digest.add(fingerprint)
+
+    def render_message(self, context):
+        """
+        Returns the (subject, body) of the email for an event.
+
+        :Parameters:
+           - `context`: context to render with
+        """
+        return (render_subject(self.get_template('subject'), context),
+            self.get_template('body').render(context))
+
     def handle(self, request, exception, tb):
         """
         Turns the resulting traceback into something emailed back to admins.
@@ -60,32 +562,28 @@ class EmailHandler(ErrorCaptureHandler):
            - `exception`: actual exception raised
            - `tb`: traceback string
         """
+        digest = get_digest()
+        if digest is not None:
+            # Only this occurrence, the ones sampled out were counted by
+            # count_occurrence already
+            fingerprint = (self.context.get('fingerprint') or
+                self.context.get('event_id'))
+            digest.add(fingerprint, 1,
+                lambda: self.render_message(self.context))
+            return
 
         def get_data(context, queue, send_mail):
-            subject_tpl = loader.get_template(
-                'django_error_capture_middleware/email/subject.txt')
-            body_tpl = loader.get_template(
-                'django_error_capture_middleware/email/body.txt')
-            # The render function appends a \n character at the end. Subjects
-            # can't have newlines.
-            subject = subject_tpl.render(context).replace('\n', '')
-            body = body_tpl.render(context)
-
-            try:
-                subject = settings.EMAIL_SUBJECT_PREFIX + subject
-            except:
-                pass
+            subject, body = self.render_message(context)
 
             try:
                 from_email = settings.SERVER_EMAIL
             except AttributeError, e:
                 from_email = None
 
-            datatuple = (subject, body, from_email,
-                    settings.ERROR_CAPTURE_ADMINS)
-
-            send_mail(subject, body, from_email, settings.ERROR_CAPTURE_ADMINS,
-                fail_silently=settings.ERROR_CAPTURE_EMAIL_FAIL_SILENTLY)
+            get_connection_pool().send(lambda connection: send_mail(
+                subject, body, from_email, settings.ERROR_CAPTURE_ADMINS,
+                connection=connection),
+                settings.ERROR_CAPTURE_EMAIL_FAIL_SILENTLY)
 
         queue, process = self.background_call(get_data,
             kwargs={'context': self.context, 'send_mail': self.send_mail})
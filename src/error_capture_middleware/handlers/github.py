@@ -35,65 +35,166 @@ Super simple ticket handler that uses the admin interface.
 __docformat__ = 'restructuredtext'
 
 
-import yaml
+try:
+    import simplejson as json
+except ImportError:
+    try:
+        import json
+    except ImportError:
+        from django.utils import simplejson as json
+
+from urllib import urlencode
 
 from django.conf import settings
-from django.template import loader
 
-from error_capture_middleware import ErrorCaptureHandler
+from error_capture_middleware import RemoteIssueHandler
+from error_capture_middleware.transport import (CONNECT_TIMEOUT,
+    READ_TIMEOUT, get_http_pool)
+
 
+#: Default GitHub API root
+API_URL = 'https://api.github.com'
 
 # TODO maybe we can add some nice methods to help take care of some what
 # will be used in other backends ... need to find out what they will be
 
 
-class GitHubHandler(ErrorCaptureHandler):
+class GitHubHandler(RemoteIssueHandler):
     """
-    GitHub handler.
+    GitHub handler. Issues are created through the JSON API over kept
+    alive connections, or through the old YAML API when
+    ERROR_CAPTURE_GITHUB_LEGACY_API is set.
     """
 
-    import urllib
+    import urllib2
 
     required_settings = ['ERROR_CAPTURE_GITHUB_REPO',
         'ERROR_CAPTURE_GITHUB_TOKEN', 'ERROR_CAPTURE_GITHUB_LOGIN']
 
-    def handle(self, request, exception, tb):
+    templates = {
+        'title': 'django_error_capture_middleware/github/title.txt',
+        'body': 'django_error_capture_middleware/github/body.txt',
+        'comment': 'django_error_capture_middleware/github/comment.txt',
+    }
+
+    def api_request(self, path, data):
         """
-        Pushes the traceback to a github ticket system.
+        Posts JSON to the API and returns the decoded reply. Anything but
+        a 201 raises IOError.
 
         :Parameters:
-           - `request`: request causing the exception
-           - `exception`: actual exception raised
-           - `tb`: traceback string
+           - `path`: path below the repository
+           - `data`: data to send as JSON
+        """
+        api = getattr(settings, 'ERROR_CAPTURE_GITHUB_API', API_URL)
+        url = '%s/repos/%s/%s' % (
+            api.rstrip('/'), settings.ERROR_CAPTURE_GITHUB_REPO, path)
+        status, headers, data = get_http_pool().request('POST', url,
+            json.dumps(data), {
+                'Authorization': 'token ' + settings.ERROR_CAPTURE_GITHUB_TOKEN,
+                'Content-Type': 'application/json',
+                'Accept': 'application/json',
+                'User-Agent': 'error-capture-middleware',
+            },
+            getattr(settings, 'ERROR_CAPTURE_GITHUB_CONNECT_TIMEOUT',
+                CONNECT_TIMEOUT),
+            getattr(settings, 'ERROR_CAPTURE_GITHUB_READ_TIMEOUT',
+                READ_TIMEOUT))
+        if status != 201:
+            raise IOError('GitHub answered %s: %s' % (status, data[:200]))
+        return json.loads(data)
+
+    def create_issue(self, title, body):
         """
+        Creates an issue through the JSON API and returns its
+        (number, url).
+
+        :Parameters:
+           - `title`: title of the issue
+           - `body`: body of the issue
+        """
+        issue = self.api_request('issues', {'title': title, 'body': body})
+        return issue['number'], issue['html_url']
+
+    def create_legacy_issue(self, title, body, urllib2):
+        """
+        Creates an issue through the old YAML API and returns its
+        (number, url).
+
+        :Parameters:
+           - `title`: title of the issue
+           - `body`: body of the issue
+           - `urllib2`: urllib2 module to use as the transport
+        """
+        # Only needed by the old API
+        import yaml
+
         url = ("http://github.com/api/v2/yaml/issues/open/" +
             settings.ERROR_CAPTURE_GITHUB_REPO)
-        issue_url = ('http://github.com/' +
-            settings.ERROR_CAPTURE_GITHUB_REPO + '/issues#issue/')
-        # Make the data nice for github
-        title_tpl = loader.get_template(
-            'django_error_capture_middleware/github/title.txt')
-        body_tpl = loader.get_template(
-            'django_error_capture_middleware/github/body.txt')
         params = {
             'login': settings.ERROR_CAPTURE_GITHUB_LOGIN,
             'token': settings.ERROR_CAPTURE_GITHUB_TOKEN,
-            'title': title_tpl.render(self.context),
-            'body': body_tpl.render(self.context),
+            'title': title,
+            'body': body,
         }
+        result = urllib2.urlopen(
+            url, urlencode(params), self.call_timeout()).read()
+        # Remove !timestamp, it isn't valid YAML
+        id = yaml.safe_load(
+            result.replace('!timestamp', ''))['issue']['number']
+        return id, ('http://github.com/' +
+            settings.ERROR_CAPTURE_GITHUB_REPO + '/issues#issue/' + str(id))
+
+    def comment_issue(self, issue, count, last_seen):
+        """
+        Comments the repeats on the issue.
+
+        :Parameters:
+           - `issue`: RemoteIssue being commented on
+           - `count`: number of repeats since the last comment
+           - `last_seen`: datetime of the last repeat
+        """
+        body = self.render_comment(issue, count, last_seen)
+        if getattr(settings, 'ERROR_CAPTURE_GITHUB_LEGACY_API', False):
+            self.urllib2.urlopen('http://github.com/api/v2/yaml/issues/'
+                'comment/%s/%s' % (settings.ERROR_CAPTURE_GITHUB_REPO,
+                issue.remote_id), urlencode({
+                    'login': settings.ERROR_CAPTURE_GITHUB_LOGIN,
+                    'token': settings.ERROR_CAPTURE_GITHUB_TOKEN,
+                    'comment': body}), self.call_timeout()).read()
+        else:
+            self.api_request('issues/%s/comments' % issue.remote_id,
+                {'body': body})
+
+    def handle(self, request, exception, tb):
+        """
+        Pushes the traceback to a github ticket system.
+
+        :Parameters:
+           - `request`: request causing the exception
+           - `exception`: actual exception raised
+           - `tb`: traceback string
+        """
+        # Repeats are commented on the existing issue
+        if self.repeat_issue():
+            return
+
+        # Make the data nice for github
+        title = self.get_template('title').render(self.context)
+        body = self.get_template('body').render(self.context)
 
         # Worker function
-        # NOTE: urllib is passed in since it's acting as a transport and
+        # NOTE: urllib2 is passed in since it's acting as a transport and
         # needs to be available in class space to test
 
-        def get_data(queue, urllib):
-            result = urllib.urlopen(url, urllib.urlencode(params)).read()
-            # Remove !timestamp, it isn't valid YAML
-            id = yaml.load(
-                result.replace('!timestamp', ''))['issue']['number']
-            queue.put_nowait(id)
+        def get_data(queue, urllib2):
+            if getattr(settings, 'ERROR_CAPTURE_GITHUB_LEGACY_API', False):
+                id, url = self.create_legacy_issue(title, body, urllib2)
+            else:
+                id, url = self.create_issue(title, body)
+            self.remote_ticket(queue, id, url)
         queue, process = self.background_call(
-            get_data, kwargs={'urllib': self.urllib})
-        id = self.get_data(queue)
-        self.context['bug_url'] = issue_url + str(id)
-        self.context['id'] = id
+            get_data, kwargs={'urllib2': self.urllib2})
+        ticket = self.get_data(queue)
+        if ticket is not None:
+            self.context['id'], self.context['bug_url'] = ticket
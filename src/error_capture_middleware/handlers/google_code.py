@@ -35,13 +35,107 @@ Super simple ticket handler that uses the admin interface.
 __docformat__ = 'restructuredtext'
 
 
+import threading
+import time
+
 from django.conf import settings
-from django.template import loader
 
-from error_capture_middleware import ErrorCaptureHandler
+from error_capture_middleware import RemoteIssueHandler
+from error_capture_middleware.transport import set_connection_timeout
+
+
+#: Seconds a ClientLogin token is used before logging in again
+TOKEN_LIFETIME = 86400
+
+_local = threading.local()
+
+
+class GoogleCodeSession(object):
+    """
+    Authenticated project hosting client which is kept for the life of a
+    worker. It only logs in again when the token is older than
+    TOKEN_LIFETIME or a request is answered with a 401.
+    """
+
+    def __init__(self, factory, login, password, lifetime=TOKEN_LIFETIME,
+            timeout=None):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `factory`: project hosting client class
+           - `login`: Google account to log in as
+           - `password`: password of the account
+           - `lifetime`: seconds a token is used
+           - `timeout`: socket timeout of the client in seconds
+        """
+        self.factory = factory
+        self.login_name = login
+        self.password = password
+        self.lifetime = lifetime
+        self.timeout = timeout
+        self.client = None
+        self.logged_in = None
+        self.logins = 0
+
+    def login(self):
+        """
+        Logs the client in, creating it first if needed.
+        """
+        if self.client is None:
+            self.client = self.factory()
+            # gdata makes its connections in the http_client
+            if self.timeout is not None:
+                set_connection_timeout(getattr(self.client,
+                    'http_client', None), '_get_connection', self.timeout)
+        self.client.client_login(self.login_name, self.password,
+            source='error-capture-middleware', service='code')
+        self.logged_in = time.time()
+        self.logins += 1
+
+    def call(self, name, *args, **kwargs):
+        """
+        Calls a client method, logging in first if the token expired and
+        once more if it is rejected.
+
+        :Parameters:
+           - `name`: name of the client method
+           - `args`: arguments for the method
+           - `kwargs`: keyword arguments for the method
+        """
+        if (self.client is None or
+                time.time() - self.logged_in > self.lifetime):
+            self.login()
+        try:
+            return getattr(self.client, name)(*args, **kwargs)
+        except Exception, e:
+            if getattr(e, 'status', None) != 401:
+                raise
+        self.login()
+        return getattr(self.client, name)(*args, **kwargs)
 
 
-class GoogleCodeHandler(ErrorCaptureHandler):
+def get_session(factory, timeout=None):
+    """
+    Returns the GoogleCodeSession of the current worker thread for the
+    configured account.
+
+    :Parameters:
+       - `factory`: project hosting client class
+       - `timeout`: socket timeout of the client in seconds
+    """
+    key = (factory, settings.ERROR_CAPTURE_GOOGLE_CODE_LOGIN,
+        settings.ERROR_CAPTURE_GOOGLE_CODE_PASSWORD, TOKEN_LIFETIME, timeout)
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+    session = sessions.get(key)
+    if session is None:
+        session = sessions[key] = GoogleCodeSession(*key)
+    return session
+
+
+class GoogleCodeHandler(RemoteIssueHandler):
     """
     Google Code handler.
     """
@@ -55,6 +149,29 @@ class GoogleCodeHandler(ErrorCaptureHandler):
         'ERROR_CAPTURE_GOOGLE_CODE_TYPE',
     ]
 
+    templates = {
+        'title': 'django_error_capture_middleware/googlecode/title.txt',
+        'body': 'django_error_capture_middleware/googlecode/body.txt',
+        'comment': 'django_error_capture_middleware/googlecode/comment.txt',
+    }
+
+    def comment_issue(self, issue, count, last_seen):
+        """
+        Comments the repeats on the issue.
+
+        :Parameters:
+           - `issue`: RemoteIssue being commented on
+           - `count`: number of repeats since the last comment
+           - `last_seen`: datetime of the last repeat
+        """
+        session = get_session(
+            self.gdata.projecthosting.client.ProjectHostingClient,
+            self.call_timeout())
+        session.call('update_issue',
+            settings.ERROR_CAPTURE_GOOGLE_CODE_PROJECT, issue.remote_id,
+            settings.ERROR_CAPTURE_GOOGLE_CODE_LOGIN,
+            comment=self.render_comment(issue, count, last_seen))
+
     def handle(self, request, exception, tb):
         """
         Pushes the traceback to a github ticket system.
@@ -64,39 +181,31 @@ class GoogleCodeHandler(ErrorCaptureHandler):
            - `exception`: actual exception raised
            - `tb`: traceback string
         """
+        # Repeats are commented on the existing issue
+        if self.repeat_issue():
+            return
 
         def get_data(queue):
-            # Create a client and login
-            client = self.gdata.projecthosting.client.ProjectHostingClient()
-            client.client_login(
-                settings.ERROR_CAPTURE_GOOGLE_CODE_LOGIN,
-                settings.ERROR_CAPTURE_GOOGLE_CODE_PASSWORD,
-                source='error-capture-middleware',
-                service='code',
-            )
-            # Setup the templates
-            title_tpl = loader.get_template(
-                'django_error_capture_middleware/googlecode/title.txt')
-            body_tpl = loader.get_template(
-                'django_error_capture_middleware/googlecode/body.txt')
-            # Add the issue
-            result = client.add_issue(
-                settings.ERROR_CAPTURE_GOOGLE_CODE_PROJECT,
-                title_tpl.render(self.context),
-                body_tpl.render(self.context),
+            # Render before using the client so a new login doesn't
+            # render again
+            title = self.get_template('title').render(self.context)
+            body = self.get_template('body').render(self.context)
+            # Add the issue with the logged in client of this worker
+            session = get_session(
+                self.gdata.projecthosting.client.ProjectHostingClient,
+                self.call_timeout())
+            result = session.call('add_issue',
+                settings.ERROR_CAPTURE_GOOGLE_CODE_PROJECT, title, body,
                 settings.ERROR_CAPTURE_GOOGLE_CODE_LOGIN, 'open',
                 labels=[settings.ERROR_CAPTURE_GOOGLE_CODE_TYPE])
-            # pull the data we want out and throw it in the queue
+            # pull the data we want out and report it
             issue_url = result.find_html_link()
             id = issue_url.split('=')[-1]
-            queue.put_nowait([id, issue_url])
+            self.remote_ticket(queue, id, issue_url)
 
         # Execute the background call.
         queue, process = self.background_call(get_data)
-        try:
-            # Get the results
-            self.context['id'], self.context['bug_url'] = self.get_data(queue)
-        except TypeError:
-            # If we get None we can't split ... sadly it seems that
-            # it's very rare to get a fast enough response back.
-            pass
+        # Only there if it came back within the response budget
+        ticket = self.get_data(queue)
+        if ticket is not None:
+            self.context['id'], self.context['bug_url'] = ticket
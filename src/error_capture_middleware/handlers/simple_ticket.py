@@ -38,14 +38,28 @@ __docformat__ = 'restructuredtext'
 from django.contrib.auth.models import User
 
 from error_capture_middleware import ErrorCaptureHandler
+from error_capture_middleware.aggregate import get_flusher
 from error_capture_middleware.models import Error
 
 
 class SimpleTicketHandler(ErrorCaptureHandler):
     """
-    Default handler of errors.
+    Default handler of errors. Repeats of an unresolved error are counted
+    on the existing ticket instead of creating a new one.
     """
 
+    counts_occurrences = True
+
+    @classmethod
+    def count_occurrence(cls, fingerprint):
+        """
+        Counts a suppressed occurrence on the ticket in the next flush.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+        """
+        get_flusher().add(fingerprint)
+
     def handle(self, request, exception, tb):
         """
         Pushes the traceback into a simple ticket system.
@@ -55,9 +69,18 @@ class SimpleTicketHandler(ErrorCaptureHandler):
            - `exception`: actual exception raised
            - `tb`: traceback string
         """
+        fingerprint = self.context.get('fingerprint') or ''
+        if fingerprint:
+            existing = Error.objects.filter(fingerprint=fingerprint,
+                resolved=False).order_by('-id').values_list('id', flat=True)[:1]
+            if existing:
+                get_flusher().add(fingerprint)
+                self.context['id'] = existing[0]
+                return
         user = None
         if isinstance(request.user, User):
             user = request.user
-        error = Error(user=user, traceback="\n".join(tb))
+        error = Error(user=user, traceback="\n".join(tb),
+            fingerprint=fingerprint)
         error.save()
         self.context['id'] = error.id
@@ -0,0 +1,318 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Forwards errors to an HTTP collector in batches.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+try:
+    import simplejson as json
+except ImportError:
+    try:
+        import json
+    except ImportError:
+        from django.utils import simplejson as json
+
+import atexit
+import gzip
+import logging
+import threading
+import time
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from django.conf import settings
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+from error_capture_middleware import ErrorCaptureHandler
+from error_capture_middleware.transport import (CONNECT_TIMEOUT,
+    READ_TIMEOUT, get_http_pool)
+
+
+logger = logging.getLogger('error_capture_middleware')
+
+
+class WebhookBatcher(object):
+    """
+    Buffers events and posts them to a url as gzip compressed JSON arrays
+    over a kept alive connection. A batch is sent once batch_size events
+    are buffered or every interval seconds, whichever comes first. Failed
+    batches are retried with exponential backoff.
+    """
+
+    def __init__(self, url, batch_size=100, interval=5, retries=3,
+            backoff=0.5, headers=None, max_buffer=10000):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `url`: url the batches are posted to
+           - `batch_size`: most events in a batch
+           - `interval`: most seconds an event waits for its batch
+           - `retries`: times a failed batch is sent again
+           - `backoff`: seconds before the first retry, doubled each time
+           - `headers`: extra request headers, like authentication
+           - `max_buffer`: most events buffered, newer ones are dropped
+        """
+        self.url = url
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+            'User-Agent': 'error-capture-middleware',
+        }
+        self.headers.update(headers or {})
+        self.max_buffer = max_buffer
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._events = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def add(self, data):
+        """
+        Buffers an event. Returns False if the buffer is full and the
+        event was dropped.
+
+        :Parameters:
+           - `data`: JSON safe event data
+        """
+        self._lock.acquire()
+        try:
+            if len(self._events) >= self.max_buffer:
+                self.dropped += 1
+                return False
+            self._events.append(data)
+            full = len(self._events) >= self.batch_size
+        finally:
+            self._lock.release()
+        if full:
+            self._wake.set()
+        return True
+
+    def encode(self, batch):
+        """
+        Returns a batch as a gzip compressed JSON array.
+
+        :Parameters:
+           - `batch`: list of event data
+        """
+        buf = StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6)
+        try:
+            gzip_file.write(json.dumps(batch, separators=(',', ':')))
+        finally:
+            gzip_file.close()
+        return buf.getvalue()
+
+    def post(self, batch):
+        """
+        Posts a batch, retrying server errors and connection failures.
+        Returns True if the collector accepted it.
+
+        :Parameters:
+           - `batch`: list of event data
+        """
+        body = self.encode(batch)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            try:
+                status, headers, data = get_http_pool().request(
+                    'POST', self.url, body, self.headers, CONNECT_TIMEOUT,
+                    READ_TIMEOUT)
+            except Exception, e:
+                error = e
+                continue
+            if status < 300:
+                return True
+            error = 'HTTP %s' % status
+            # Other client errors won't go away by sending it again
+            if status < 500 and status != 429:
+                break
+        logger.error('Dropped a batch of %s events for %s: %s' % (
+            len(batch), self.url, error))
+        return False
+
+    def flush(self):
+        """
+        Sends everything buffered in batches. Returns the number of events
+        the collector accepted.
+        """
+        sent = 0
+        while True:
+            self._lock.acquire()
+            try:
+                batch = self._events[:self.batch_size]
+                self._events = self._events[self.batch_size:]
+            finally:
+                self._lock.release()
+            if not batch:
+                return sent
+            if self.post(batch):
+                sent += len(batch)
+                self.sent += len(batch)
+            else:
+                self.failed += len(batch)
+
+    def _run(self):
+        """
+        Batcher thread loop.
+        """
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error capture webhook flush failed')
+            # Checked after flushing so a stop always sends the buffer
+            if self._stopped.isSet():
+                return
+
+    def start(self):
+        """
+        Starts the batcher thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='error-capture-webhook')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the batcher thread after sending what is buffered.
+
+        :Parameters:
+           - `timeout`: most seconds to wait for the batcher thread
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    """
+    Returns the shared WebhookBatcher with its thread running.
+    """
+    global _batcher
+    if _batcher is None:
+        _batcher_lock.acquire()
+        try:
+            if _batcher is None:
+                batcher = WebhookBatcher(settings.ERROR_CAPTURE_WEBHOOK_URL,
+                    getattr(settings, 'ERROR_CAPTURE_WEBHOOK_BATCH_SIZE', 100),
+                    getattr(settings, 'ERROR_CAPTURE_WEBHOOK_BATCH_SEC', 5),
+                    getattr(settings, 'ERROR_CAPTURE_WEBHOOK_RETRIES', 3),
+                    headers=getattr(
+                        settings, 'ERROR_CAPTURE_WEBHOOK_HEADERS', None))
+                batcher.start()
+                atexit.register(batcher.stop, 5)
+                _batcher = batcher
+        finally:
+            _batcher_lock.release()
+    return _batcher
+
+
+def stop_batcher(timeout=None):
+    """
+    Stops the shared batcher, sending what is buffered. The next
+    get_batcher call creates a new one.
+
+    :Parameters:
+       - `timeout`: most seconds to wait for the batcher thread
+    """
+    global _batcher
+    _batcher_lock.acquire()
+    try:
+        batcher, _batcher = _batcher, None
+    finally:
+        _batcher_lock.release()
+    if batcher is not None:
+        batcher.stop(timeout)
+
+
+def _setting_changed(setting, **kwargs):
+    """
+    Replaces the shared batcher when one of its settings changes.
+
+    :Parameters:
+       - `setting`: name of the setting which changed
+       - `kwargs`: other signal arguments
+    """
+    if setting.startswith('ERROR_CAPTURE_WEBHOOK'):
+        stop_batcher()
+
+
+setting_changed.connect(_setting_changed)
+
+
+class WebhookHandler(ErrorCaptureHandler):
+    """
+    Posts events to ERROR_CAPTURE_WEBHOOK_URL in batches.
+    """
+
+    required_settings = ['ERROR_CAPTURE_WEBHOOK_URL']
+
+    def handle(self, request, exception, tb):
+        """
+        Buffers the event for the next batch. __call__ always sets the
+        event.
+
+        :Parameters:
+           - `request`: request causing the exception
+           - `exception`: actual exception raised
+           - `tb`: traceback string
+        """
+        get_batcher().add(self.event.to_dict())
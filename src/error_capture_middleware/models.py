@@ -37,6 +37,7 @@ __docformat__ = 'restructuredtext'
 
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from django.conf import settings
 
@@ -51,6 +52,10 @@ class Error(models.Model):
         settings.AUTH_USER_MODEL, null=True, blank=True, related_name='owner')
     traceback = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    fingerprint = models.CharField(max_length=255, blank=True, db_index=True)
+    occurrences = models.PositiveIntegerField(default=1)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
 
     def __unicode__(self):
         """
@@ -62,3 +67,43 @@ class Error(models.Model):
         permissions = (
             ("view_error", "Can view errors"),
         )
+
+
+class RemoteLink(models.Model):
+    """
+    A ticket a handler created in a remote system for an event.
+    """
+    event_id = models.CharField(max_length=26, db_index=True)
+    handler = models.CharField(max_length=255)
+    remote_id = models.CharField(max_length=255)
+    url = models.CharField(max_length=255, blank=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        """
+        Unicode representation of this object.
+        """
+        return u"%s %s" % (self.event_id, self.remote_id)
+
+
+class RemoteIssue(models.Model):
+    """
+    The remote issue a handler created for a fingerprint. Repeats of the
+    fingerprint are commented on it instead of creating new issues.
+    """
+    handler = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=255)
+    remote_id = models.CharField(max_length=255)
+    url = models.CharField(max_length=255, blank=True)
+    occurrences = models.PositiveIntegerField(default=1)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        """
+        Unicode representation of this object.
+        """
+        return u"%s %s" % (self.handler, self.remote_id)
+
+    class Meta(object):
+        unique_together = (('handler', 'fingerprint'), )
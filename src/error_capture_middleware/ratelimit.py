@@ -0,0 +1,231 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Rate limiting of captured exceptions.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import threading
+import time
+
+from django.conf import settings
+
+from error_capture_middleware.dedupe import TTLCache, get_cache
+
+
+class TokenBucket(object):
+    """
+    Classic token bucket holding up to capacity tokens and refilling at
+    rate tokens per second. Not thread safe on its own.
+    """
+
+    __slots__ = ['rate', 'capacity', 'tokens', 'updated']
+
+    def __init__(self, rate, capacity, now=None):
+        """
+        Creates a full bucket.
+
+        :Parameters:
+           - `rate`: tokens added per second
+           - `capacity`: most tokens the bucket holds
+           - `now`: unix timestamp to treat as the current time
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now or time.time()
+
+    def consume(self, now=None):
+        """
+        Takes a token if one is available and returns True, otherwise
+        returns False.
+
+        :Parameters:
+           - `now`: unix timestamp to treat as the current time
+        """
+        if now is None:
+            now = time.time()
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter(object):
+    """
+    Global and per key limits on how many exceptions are processed. Limits
+    are given as (count, seconds). Buckets are kept in process, or when a
+    cache alias is given, as per period counters in the shared cache so
+    all workers share them. Limited exceptions are only counted.
+    """
+
+    key_prefix = 'error-capture-rate-'
+
+    def __init__(self, global_limit=None, key_limit=None, cache_alias=None,
+                 key_by='fingerprint', max_keys=1000):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `global_limit`: (count, seconds) for all exceptions or None
+           - `key_limit`: (count, seconds) for each key or None
+           - `cache_alias`: Django cache to share the limits through or
+             None to keep them in process
+           - `key_by`: 'fingerprint' or 'type' of the exception
+           - `max_keys`: most per key buckets to keep in process
+        """
+        self.global_limit = global_limit
+        self.key_limit = key_limit
+        self.key_by = key_by
+        self.cache = None
+        if cache_alias:
+            self.cache = get_cache(cache_alias)
+        self.limited = 0
+        self._lock = threading.Lock()
+        self._global_bucket = None
+        if global_limit:
+            self._global_bucket = self._new_bucket(global_limit)
+        self._buckets = TTLCache(max_keys)
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates an instance from the ERROR_CAPTURE_RATE_LIMIT settings.
+        """
+        return cls(
+            getattr(settings, 'ERROR_CAPTURE_RATE_LIMIT', None),
+            getattr(settings, 'ERROR_CAPTURE_RATE_LIMIT_PER_KEY', None),
+            getattr(settings, 'ERROR_CAPTURE_RATE_LIMIT_CACHE', None),
+            getattr(settings, 'ERROR_CAPTURE_RATE_LIMIT_BY', 'fingerprint'))
+
+    @property
+    def enabled(self):
+        """
+        True if any limit is set.
+        """
+        return bool(self.global_limit or self.key_limit)
+
+    def key_for(self, exception, fingerprint):
+        """
+        Returns the per key limit key for an exception.
+
+        :Parameters:
+           - `exception`: actual exception raised
+           - `fingerprint`: fingerprint of the exception
+        """
+        if self.key_by == 'type':
+            exc_type = exception.__class__
+            return '%s.%s' % (exc_type.__module__, exc_type.__name__)
+        return fingerprint
+
+    def _new_bucket(self, limit, now=None):
+        """
+        Returns a full TokenBucket for a (count, seconds) limit.
+
+        :Parameters:
+           - `limit`: (count, seconds)
+           - `now`: unix timestamp to treat as the current time
+        """
+        count, seconds = limit
+        return TokenBucket(float(count) / seconds, count, now)
+
+    def _allow_shared(self, name, limit, now):
+        """
+        Counts a hit against a shared per period counter.
+
+        :Parameters:
+           - `name`: name of the limit
+           - `limit`: (count, seconds)
+           - `now`: unix timestamp to treat as the current time
+        """
+        count, seconds = limit
+        key = '%s%s-%d' % (self.key_prefix, name, now // seconds)
+        self.cache.add(key, 0, int(seconds) * 2)
+        try:
+            return self.cache.incr(key) <= count
+        except ValueError:
+            # Evicted between add and incr, let it through
+            return True
+
+    def _allow_local(self, key, now):
+        """
+        Takes a token from the global and key buckets.
+
+        :Parameters:
+           - `key`: key of the exception or None
+           - `now`: unix timestamp to treat as the current time
+        """
+        self._lock.acquire()
+        try:
+            # Check the key first so a noisy key doesn't use up global
+            # tokens
+            if self.key_limit and key is not None:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._new_bucket(self.key_limit, now)
+                # A bucket left alone this long is full again anyway
+                self._buckets.set(key, bucket, now + self.key_limit[1])
+                if not bucket.consume(now):
+                    return False
+            return (self._global_bucket is None or
+                self._global_bucket.consume(now))
+        finally:
+            self._lock.release()
+
+    def allow(self, key=None, now=None):
+        """
+        Returns True if an exception with key is within the limits,
+        otherwise counts it and returns False.
+
+        :Parameters:
+           - `key`: fingerprint or type name of the exception
+           - `now`: unix timestamp to treat as the current time
+        """
+        if not self.enabled:
+            return True
+        if now is None:
+            now = time.time()
+        if self.cache is not None:
+            allowed = ((not self.key_limit or key is None or
+                    self._allow_shared(key, self.key_limit, now)) and
+                (not self.global_limit or self._allow_shared(
+                    'global', self.global_limit, now)))
+        else:
+            allowed = self._allow_local(key, now)
+        if not allowed:
+            self.limited += 1
+        return allowed
@@ -0,0 +1,252 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Handler registry.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import re
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.template import (Context, TemplateDoesNotExist,
+    TemplateSyntaxError, loader)
+from django.utils.encoding import force_text
+from django.utils.html import escape
+
+
+def import_object(path):
+    """
+    Resolves a dotted path into the object it names. Problems are raised as
+    ImproperlyConfigured so they show up when the middleware loads rather
+    than on the first exception.
+
+    :Parameters:
+       - `path`: dotted path to the object
+    """
+    module, _, name = path.rpartition('.')
+    try:
+        return getattr(__import__(module, fromlist=[name]), name)
+    except (ImportError, AttributeError, ValueError), ex:
+        raise ImproperlyConfigured('Unable to load %s: %s' % (path, ex))
+
+
+def import_handler(path):
+    """
+    Resolves a dotted handler path into the handler class and checks its
+    required settings.
+
+    :Parameters:
+       - `path`: dotted path to the handler class
+    """
+    handler_cls = import_object(path)
+    handler_cls.check_settings()
+    return handler_cls
+
+
+class TemplateCache(object):
+    """
+    Compiled templates by name. Templates are loaded and compiled once and
+    rendered from the compiled objects afterwards.
+    """
+
+    def __init__(self):
+        """
+        Creates an instance of this class.
+        """
+        self._templates = {}
+        self._static = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Returns the compiled template, loading it if needed.
+
+        :Parameters:
+           - `name`: template name
+        """
+        try:
+            return self._templates[name]
+        except KeyError:
+            template = loader.get_template(name)
+            self._lock.acquire()
+            try:
+                self._templates[name] = template
+            finally:
+                self._lock.release()
+            return template
+
+    def compile(self, names):
+        """
+        Loads and compiles templates up front, raising ImproperlyConfigured
+        if one is missing or broken.
+
+        :Parameters:
+           - `names`: template names
+        """
+        for name in names:
+            try:
+                self.get(name)
+            except (TemplateDoesNotExist, TemplateSyntaxError), ex:
+                raise ImproperlyConfigured(
+                    'Unable to load error capture template %s: %s' % (
+                        name, ex))
+
+    def prerender(self, name):
+        """
+        Renders a template once into a StaticPage, raising
+        ImproperlyConfigured if it is missing or broken.
+
+        :Parameters:
+           - `name`: template name
+        """
+        self.compile((name, ))
+        page = StaticPage(self.get(name))
+        self._static[name] = page
+        return page
+
+    def get_static(self, name):
+        """
+        Returns the StaticPage for a template or None if it was not
+        prerendered.
+
+        :Parameters:
+           - `name`: template name
+        """
+        return self._static.get(name)
+
+    def __contains__(self, name):
+        """
+        True if the template is compiled.
+        """
+        return name in self._templates
+
+
+class StaticPage(object):
+    """
+    A template rendered once into bytes with a placeholder for the event id.
+    Responses only substitute the id so nothing is rendered per error.
+    """
+
+    placeholder = '__error_capture_id__'
+    # Ids are almost always safe so escape is skipped unless needed
+    special = re.compile(u'[&<>"\']')
+
+    def __init__(self, template, charset=None):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `template`: compiled template, rendered with event_id set to
+             the placeholder
+           - `charset`: encoding of the page. Defaults to DEFAULT_CHARSET.
+        """
+        self.charset = charset or settings.DEFAULT_CHARSET
+        content = template.render(Context({'event_id': self.placeholder}))
+        self.parts = content.encode(self.charset).split(self.placeholder)
+
+    def render(self, error_id):
+        """
+        Returns the page bytes with the event id filled in.
+
+        :Parameters:
+           - `error_id`: id shown to the user
+        """
+        error_id = force_text(error_id)
+        if self.special.search(error_id):
+            error_id = escape(error_id)
+        return error_id.encode(self.charset).join(self.parts)
+
+
+# Used by handlers, replaced whenever a HandlerRegistry is built
+_template_cache = TemplateCache()
+
+
+def get_template_cache():
+    """
+    Returns the TemplateCache of the current handler registry.
+    """
+    return _template_cache
+
+
+class HandlerRegistry(object):
+    """
+    Resolved handler pipeline. Built once when the middleware starts and
+    rebuilt when the settings change.
+    """
+
+    def __init__(self, handler_paths=None):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `handler_paths`: dotted handler paths. Defaults to
+             ERROR_CAPTURE_HANDLERS.
+        """
+        if handler_paths is None:
+            handler_paths = settings.ERROR_CAPTURE_HANDLERS
+        self.handlers = tuple([import_handler(x) for x in handler_paths])
+        # Handlers which want to hear about occurrences not dispatched
+        self.counting = tuple([x for x in self.handlers
+            if x.counts_occurrences])
+        self.templates = TemplateCache()
+        for handler_cls in self.handlers:
+            self.templates.compile(handler_cls.templates.values())
+        if self.handlers:
+            error_template = self.handlers[-1].error_template
+        else:
+            error_template = '500.html'
+        self.static_page = None
+        if getattr(settings, 'ERROR_CAPTURE_STATIC_500', False):
+            self.static_page = self.templates.prerender(error_template)
+        else:
+            # Only needed outside of DEBUG so it may not exist
+            try:
+                self.templates.get(error_template)
+            except TemplateDoesNotExist:
+                pass
+        global _template_cache
+        _template_cache = self.templates
+
+    def __iter__(self):
+        """
+        Iterates over the handler classes in order.
+        """
+        return iter(self.handlers)
+
+    def __len__(self):
+        """
+        Number of handlers in the pipeline.
+        """
+        return len(self.handlers)
@@ -0,0 +1,162 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Statistical sampling of captured exceptions.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from error_capture_middleware.dedupe import TTLCache
+
+
+class Sampler(object):
+    """
+    Decides which occurrences are captured. The first occurrence of a
+    fingerprint always is, then a decaying fraction of the following ones:
+    1/2 of the next 2, 1/4 of the next 4 and so on. When the event rate goes
+    over a threshold every repeat is sampled at a lower rate as well. Each
+    captured occurrence gets a sample weight, the number of occurrences it
+    stands for, so counts can be extrapolated. Kept in process.
+    """
+
+    def __init__(self, decay=False, min_rate=0.001, window=3600,
+                 load_threshold=None, load_rate=0.1, load_period=10,
+                 max_keys=1000, random=random.random):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `decay`: True to sample repeats of a fingerprint at a decaying
+             rate
+           - `min_rate`: lowest rate the decay goes down to
+           - `window`: seconds a fingerprint has to be quiet before it
+             counts as new again
+           - `load_threshold`: events per second over which repeats are
+             also sampled at load_rate, or None
+           - `load_rate`: rate applied under load
+           - `load_period`: seconds the event rate is averaged over
+           - `max_keys`: most fingerprints to remember
+           - `random`: callable returning a float in [0, 1)
+        """
+        self.decay = decay
+        self.min_rate = min_rate
+        self.window = window
+        self.load_threshold = load_threshold
+        self.load_rate = load_rate
+        self.load_period = load_period
+        self.random = random
+        self.load = 0.0
+        self.dropped = 0
+        self._load_updated = time.time()
+        self._seen = TTLCache(max_keys)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Creates an instance from the ERROR_CAPTURE_SAMPLE settings.
+        """
+        return cls(
+            getattr(settings, 'ERROR_CAPTURE_SAMPLE_DECAY', False),
+            getattr(settings, 'ERROR_CAPTURE_SAMPLE_MIN_RATE', 0.001),
+            getattr(settings, 'ERROR_CAPTURE_SAMPLE_WINDOW', 3600),
+            getattr(settings, 'ERROR_CAPTURE_SAMPLE_LOAD_THRESHOLD', None),
+            getattr(settings, 'ERROR_CAPTURE_SAMPLE_LOAD_RATE', 0.1))
+
+    @property
+    def enabled(self):
+        """
+        True if anything is sampled.
+        """
+        return bool(self.decay or self.load_threshold)
+
+    def _update_load(self, now):
+        """
+        Adds an event to the exponentially decaying event rate and returns
+        it in events per second.
+
+        :Parameters:
+           - `now`: unix timestamp to treat as the current time
+        """
+        elapsed = now - self._load_updated
+        if elapsed > 0:
+            self.load *= math.exp(-elapsed / self.load_period)
+            self._load_updated = now
+        self.load += 1.0 / self.load_period
+        return self.load
+
+    def rate_for(self, seen):
+        """
+        Returns the decayed sample rate of the nth occurrence.
+
+        :Parameters:
+           - `seen`: occurrences of the fingerprint including this one
+        """
+        return max(self.min_rate, 1.0 / (1 << (seen.bit_length() - 1)))
+
+    def sample(self, fingerprint, now=None):
+        """
+        Returns the sample weight of an occurrence or 0 if it is dropped.
+
+        :Parameters:
+           - `fingerprint`: fingerprint of the exception
+           - `now`: unix timestamp to treat as the current time
+        """
+        if not self.enabled:
+            return 1
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            load = self._update_load(now)
+            seen = (self._seen.get(fingerprint) or 0) + 1
+            self._seen.set(fingerprint, seen, now + self.window)
+        finally:
+            self._lock.release()
+        if seen == 1:
+            return 1
+        rate = 1.0
+        if self.decay:
+            rate = self.rate_for(seen)
+        if self.load_threshold and load > self.load_threshold:
+            rate *= self.load_rate
+        if rate < 1 and self.random() >= rate:
+            self.dropped += 1
+            return 0
+        return 1 / rate
@@ -0,0 +1,331 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Durable local spool for handler deliveries.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+from error_capture_middleware.event import ErrorEvent
+from error_capture_middleware.registry import import_object
+
+
+logger = logging.getLogger('error_capture_middleware')
+
+
+class Spool(object):
+    """
+    SQLite backed spool of handler deliveries. The request thread writes
+    the event for every background handler in one local transaction and a
+    drainer thread delivers them, retrying failures with exponential
+    backoff. Rows stay in the file until delivered so they survive
+    restarts.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS deliveries ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'handler TEXT NOT NULL, '
+        'payload TEXT NOT NULL, '
+        'attempts INTEGER NOT NULL DEFAULT 0, '
+        'next_attempt REAL NOT NULL, '
+        'created REAL NOT NULL)')
+    # Seconds a claimed delivery is hidden from other drainers
+    lease = 300
+
+    def __init__(self, path, max_attempts=10, backoff=2, max_backoff=3600,
+                 poll_interval=1, put_timeout=0.05):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `path`: SQLite file to spool to
+           - `max_attempts`: attempts before a delivery is dropped
+           - `backoff`: seconds to wait after the first failure, doubled
+             for every further failure
+           - `max_backoff`: most seconds to wait between attempts
+           - `poll_interval`: seconds between checks for due deliveries
+           - `put_timeout`: most seconds put waits for a locked file, it
+             runs on the request thread
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.put_timeout = put_timeout
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._handlers = {}
+        conn = self.connection
+        conn.execute(self.schema)
+        conn.execute('CREATE INDEX IF NOT EXISTS deliveries_next '
+            'ON deliveries (next_attempt)')
+        conn.commit()
+
+    def _connection(self, name, timeout):
+        """
+        Returns a SQLite connection of the current thread.
+
+        :Parameters:
+           - `name`: name of the connection in the thread
+           - `timeout`: seconds to wait for a locked file
+        """
+        conn = getattr(self._local, name, None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            setattr(self._local, name, conn)
+        return conn
+
+    @property
+    def connection(self):
+        """
+        SQLite connection for the current thread.
+        """
+        return self._connection('connection', 5)
+
+    def put(self, handlers, event):
+        """
+        Spools an event for each handler class. This runs on the request
+        thread so it only waits put_timeout for a locked file, callers
+        must handle the error.
+
+        :Parameters:
+           - `handlers`: handler classes to deliver to
+           - `event`: ErrorEvent to deliver
+        """
+        now = time.time()
+        payload = json.dumps(event.to_dict())
+        conn = self._connection('put_connection', self.put_timeout)
+        try:
+            conn.executemany('INSERT INTO deliveries '
+                '(handler, payload, next_attempt, created) '
+                'VALUES (?, ?, ?, ?)',
+                [('%s.%s' % (x.__module__, x.__name__), payload, now, now)
+                    for x in handlers])
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        self._wakeup.set()
+
+    def __len__(self):
+        """
+        Number of deliveries waiting in the spool.
+        """
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM deliveries').fetchone()[0]
+
+    def _claim(self, now, limit):
+        """
+        Claims up to limit due deliveries and returns them.
+
+        :Parameters:
+           - `now`: current unix timestamp
+           - `limit`: most deliveries to claim
+        """
+        conn = self.connection
+        rows = conn.execute('SELECT id, handler, payload, attempts, '
+            'next_attempt FROM deliveries WHERE next_attempt <= ? '
+            'ORDER BY next_attempt LIMIT ?', (now, limit)).fetchall()
+        claimed = []
+        for row_id, handler, payload, attempts, next_attempt in rows:
+            # Another process may have claimed it in the meantime
+            updated = conn.execute('UPDATE deliveries SET attempts = ?, '
+                'next_attempt = ? WHERE id = ? AND next_attempt = ?',
+                (attempts + 1, now + self.lease, row_id, next_attempt))
+            if updated.rowcount:
+                claimed.append((row_id, handler, payload, attempts + 1))
+        conn.commit()
+        return claimed
+
+    def _get_handler(self, path):
+        """
+        Returns the handler class for a dotted path.
+
+        :Parameters:
+           - `path`: dotted path to the handler class
+        """
+        try:
+            return self._handlers[path]
+        except KeyError:
+            handler_cls = self._handlers[path] = import_object(path)
+            return handler_cls
+
+    def drain(self, now=None, limit=20):
+        """
+        Delivers due deliveries. Returns the number delivered.
+
+        :Parameters:
+           - `now`: unix timestamp to treat as the current time
+           - `limit`: most deliveries to attempt
+        """
+        if now is None:
+            now = time.time()
+        delivered = 0
+        conn = self.connection
+        for row_id, handler, payload, attempts in self._claim(now, limit):
+            try:
+                self._get_handler(handler)().deliver(
+                    ErrorEvent.from_dict(json.loads(payload)))
+            except Exception:
+                if attempts >= self.max_attempts:
+                    logger.exception('Dropping error capture delivery %s to '
+                        '%s after %s attempts' % (row_id, handler, attempts))
+                    conn.execute(
+                        'DELETE FROM deliveries WHERE id = ?', (row_id, ))
+                else:
+                    logger.warning('Error capture delivery %s to %s failed, '
+                        'retrying' % (row_id, handler), exc_info=True)
+                    delay = min(self.backoff * 2 ** (attempts - 1),
+                        self.max_backoff)
+                    conn.execute('UPDATE deliveries SET next_attempt = ? '
+                        'WHERE id = ?', (now + delay, row_id))
+            else:
+                delivered += 1
+                conn.execute('DELETE FROM deliveries WHERE id = ?', (row_id, ))
+            conn.commit()
+        return delivered
+
+    def _run(self):
+        """
+        Drainer thread loop.
+        """
+        while not self._stopped.isSet():
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('Error capture spool drain failed')
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        """
+        Starts the drainer thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='error-capture-spool')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops the drainer thread. Undelivered events stay in the spool.
+
+        :Parameters:
+           - `timeout`: most seconds to wait for the drainer
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    """
+    Returns the shared Spool with its drainer running, or None if
+    ERROR_CAPTURE_SPOOL_PATH is not set.
+    """
+    global _spool
+    path = getattr(settings, 'ERROR_CAPTURE_SPOOL_PATH', None)
+    if not path:
+        return None
+    if _spool is None:
+        _spool_lock.acquire()
+        try:
+            if _spool is None:
+                spool = Spool(path,
+                    getattr(settings, 'ERROR_CAPTURE_SPOOL_MAX_ATTEMPTS', 10),
+                    getattr(settings, 'ERROR_CAPTURE_SPOOL_BACKOFF', 2))
+                spool.start()
+                _spool = spool
+        finally:
+            _spool_lock.release()
+    return _spool
+
+
+def stop_spool(timeout=None):
+    """
+    Stops the shared Spool. The next get_spool call creates a new one.
+
+    :Parameters:
+       - `timeout`: most seconds to wait for the drainer
+    """
+    global _spool
+    _spool_lock.acquire()
+    try:
+        spool, _spool = _spool, None
+    finally:
+        _spool_lock.release()
+    if spool is not None:
+        spool.stop(timeout)
+
+
+def _setting_changed(setting, **kwargs):
+    """
+    Replaces the shared spool when one of its settings changes.
+
+    :Parameters:
+       - `setting`: name of the setting which changed
+       - `kwargs`: other signal arguments
+    """
+    if setting.startswith('ERROR_CAPTURE_SPOOL'):
+        stop_spool()
+
+
+setting_changed.connect(_setting_changed)
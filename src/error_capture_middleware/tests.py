@@ -35,10 +35,28 @@ Unittests.
 __docformat__ = 'restructuredtext'
 
 
+import gzip
+import httplib
+import os
 import re
+import shutil
+import smtplib
+import socket
+import sqlite3
+import tempfile
 import time
 import sys
 import traceback
+import xmlrpclib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SocketServer import ThreadingMixIn
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
 
 try:
     from cStringIO import StringIO
@@ -47,16 +65,111 @@ except ImportError:
 
 from django.conf import settings
 from django import http
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase, client
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils.functional import SimpleLazyObject
+from django.utils.safestring import mark_safe
 
 from minimock import Mock
 
 from error_capture_middleware import (ErrorCaptureMiddleware,
     ErrorCaptureHandler, threading, thread_cls, Queue, queue_mod)
+from error_capture_middleware.aggregate import (OccurrenceFlusher,
+    get_commenter)
+from error_capture_middleware.breaker import (CircuitBreaker, CircuitOpen,
+    get_breaker)
+from error_capture_middleware.capture import CapturePolicy, LimitedRepr
+from error_capture_middleware.event import ErrorEvent
+from error_capture_middleware.dedupe import DuplicateCache, TTLCache
+from error_capture_middleware.filters import ExceptionFilter
+from error_capture_middleware.fingerprint import (Fingerprinter,
+    default_fingerprint)
+from error_capture_middleware.models import Error, RemoteIssue, RemoteLink
+from error_capture_middleware.ratelimit import RateLimiter, TokenBucket
+from error_capture_middleware.registry import (HandlerRegistry,
+    get_template_cache)
+from error_capture_middleware.sampling import Sampler
+from error_capture_middleware.spool import Spool
+from error_capture_middleware.transport import HTTPPool, get_http_pool
+from error_capture_middleware import workers
+from error_capture_middleware.workers import (ProcessPool, WorkerPool,
+    get_dispatcher)
 
 from django_error_capture_middleware.handlers import (
-    bz, email, github, simple_ticket, google_code)
+    bz, email, github, simple_ticket, google_code, webhook)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """
+    Keep-alive request handler answering with the server's respond
+    callable.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_POST(self):
+        """
+        Records the request and sends the response.
+        """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.path, self.headers, body))
+        status, data = self.server.respond(self.path, body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        # Like a server timing out an idle connection, without telling
+        self.close_connection = self.server.close_after_response
+
+    def log_message(self, *args):
+        """
+        Keeps the test output clean.
+        """
+        pass
+
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server standing in for a remote service.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, respond):
+        """
+        Creates an instance of this class and starts serving.
+
+        :Parameters:
+           - `respond`: callable taking (path, body) returning (status, data)
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubRequestHandler)
+        self.respond = respond
+        self.requests = []
+        self.connections = 0
+        self.close_after_response = False
+        self.url = 'http://127.0.0.1:%s' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever, args=(0.05, ))
+        thread.daemon = True
+        thread.start()
+
+    def process_request(self, request, client_address):
+        """
+        Counts the connections.
+        """
+        self.connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def stop(self):
+        """
+        Stops serving.
+        """
+        self.shutdown()
+        self.server_close()
 
 
 class Jelly(object):
@@ -130,19 +243,1051 @@ class ErrorCaptureMiddlewareTestCase(TestCasePlus):
         self.assertRaises(http.Http404, self.instance.process_exception,
             None, http.Http404())
 
-        # Test class blacklist
-        exc = self._raise_and_get_exception()
-        settings.ERROR_CAPTURE_TRACE_CLASS_BLACKLIST = (type(Exception), )
-        self.assertRaises(
-            Exception, self.instance.process_exception, None, exc)
-        settings.ERROR_CAPTURE_TRACE_CLASS_BLACKLIST = tuple()
+        def process(exception):
+            try:
+                raise exception
+            except Exception, ex:
+                return self.instance.process_exception(None, ex)
+
+        # Test class blacklist, which also covers subclasses
+        with override_settings(ERROR_CAPTURE_TRACE_CLASS_BLACKLIST=(
+                LookupError, )):
+            self.assertRaises(KeyError, process, KeyError('test'))
+
+        # Test content blacklist, which is used with a class blacklist
+        with override_settings(
+                ERROR_CAPTURE_TRACE_CLASS_BLACKLIST=(TypeError, ),
+                ERROR_CAPTURE_TRACE_CONTENT_BLACKLIST=(
+                    re.compile('.*test.*'), )):
+            self.assertRaises(ValueError, process, ValueError('test'))
+
+    def test_lazy_event(self):
+        """
+        The request path leaves the event's fields to the handlers.
+        """
+        with override_settings(ERROR_CAPTURE_HANDLERS=(
+                'django_error_capture_middleware.tests.EventIdHandler', )):
+            try:
+                raise ValueError('lazy')
+            except ValueError, ex:
+                self.instance.process_exception(RequestFactory().get('/'), ex)
+            event = self.instance.registry.handlers[0].last_event
+            self.assertTrue(event.exc_info[2] is not None)
+            self.assertFalse('frames' in event._cache)
+            self.assertEquals(event.frames[-1][2], 'test_lazy_event')
+
+    def test_registry_rebuilt_on_setting_change(self):
+        """
+        The handler registry is rebuilt when the handlers setting changes.
+        """
+        registry = self.instance.registry
+        with override_settings(ERROR_CAPTURE_HANDLERS=()):
+            self.assertEquals(len(self.instance.registry), 0)
+        self.assertNotEquals(self.instance.registry, registry)
 
-        # Test content blacklist
-        settings.ERROR_CAPTURE_TRACE_CONTENT_BLACKLIST = (
-            re.compile('.*test.*'), )
-        self.assertRaises(
-            Exception, self.instance.process_exception, None, exc)
-        settings.ERROR_CAPTURE_TRACE_CONTENT_BLACKLIST = tuple()
+    def test_static_500(self):
+        """
+        With ERROR_CAPTURE_STATIC_500 the 500 page is rendered once and
+        only the event id is filled in, including for suppressed
+        occurrences.
+        """
+        with override_settings(ERROR_CAPTURE_STATIC_500=True,
+                ERROR_CAPTURE_HANDLERS=('django_error_capture_middleware.'
+                    'tests.EventIdHandler', ),
+                ERROR_CAPTURE_IGNORE_DUPE_SEC=60):
+            page = self.instance.registry.static_page
+            self.assertFalse(page.placeholder in page.render('<1>'))
+            self.assertTrue('&lt;1&gt;' in page.render('<1>'))
+            request = RequestFactory().get('/')
+            try:
+                raise ValueError('static')
+            except ValueError, ex:
+                first = self.instance.process_exception(request, ex)
+                second = self.instance.process_exception(request, ex)
+            self.assertEquals(first.status_code, 500)
+            handler_cls = self.instance.registry.handlers[0]
+            self.assertTrue(handler_cls.event_id in first.content)
+            self.assertEquals(second.status_code, 500)
+            fingerprint = self.instance.fingerprinter(ex, sys.exc_info()[2])
+            self.assertTrue(fingerprint in second.content)
+        self.assertEquals(self.instance.registry.static_page, None)
+
+
+class EventIdHandler(ErrorCaptureHandler):
+    """
+    Handler remembering the id of the last event.
+    """
+
+    event_id = None
+    last_event = None
+
+    def handle(self, request, exception, tb):
+        """
+        Remembers the event and its id.
+        """
+        self.__class__.event_id = self.event.id
+        self.__class__.last_event = self.event
+
+
+class HandlerRegistryTestCase(TestCasePlus):
+    """
+    Tests for the handler registry.
+    """
+
+    def test_resolves_classes(self):
+        """
+        Handler paths are resolved to their classes once.
+        """
+        registry = HandlerRegistry((
+            'django_error_capture_middleware.handlers.simple_ticket.'
+            'SimpleTicketHandler', ))
+        self.assertEquals(
+            list(registry), [simple_ticket.SimpleTicketHandler])
+
+    def test_bad_path(self):
+        """
+        Handlers which can not be loaded fail up front.
+        """
+        self.assertRaises(ImproperlyConfigured, HandlerRegistry,
+            ('error_capture_middleware.handlers.nothere.Handler', ))
+        self.assertRaises(ImproperlyConfigured, HandlerRegistry,
+            ('error_capture_middleware.handlers.simple_ticket.Nothere', ))
+
+    def test_compiles_templates(self):
+        """
+        Handler templates are compiled when the registry is built and
+        rendered without going back to the loader.
+        """
+        registry = HandlerRegistry((
+            'django_error_capture_middleware.handlers.email.EmailHandler', ))
+        self.assertTrue(get_template_cache() is registry.templates)
+        for name in email.EmailHandler.templates.values():
+            self.assertTrue(name in registry.templates)
+        from django.template import loader
+        get_template = loader.get_template
+        loader.get_template = Mock('get_template')
+        try:
+            handler = email.EmailHandler()
+            self.assertTrue(handler.get_template('subject') is not None)
+            self.assertTrue(handler.get_template('500.html') is not None)
+        finally:
+            loader.get_template = get_template
+
+    def test_missing_template(self):
+        """
+        Handlers with missing templates fail up front.
+        """
+        self.assertRaises(ImproperlyConfigured, HandlerRegistry,
+            ('error_capture_middleware.tests.MissingTemplateHandler', ))
+
+
+class MissingTemplateHandler(ErrorCaptureHandler):
+    """
+    Handler with a template which does not exist.
+    """
+
+    templates = {'body': 'django_error_capture_middleware/nothere.txt'}
+
+
+class ExceptionFilterTestCase(TestCasePlus):
+    """
+    Tests for the exception filter.
+    """
+
+    def test_class_blacklist(self):
+        """
+        Blacklisted classes and their subclasses match.
+        """
+        exc_filter = ExceptionFilter(classes=(LookupError, ), patterns=())
+        self.assertTrue(exc_filter.is_blacklisted(KeyError()))
+        self.assertTrue(exc_filter.is_blacklisted(LookupError()))
+        self.assertFalse(exc_filter.is_blacklisted(ValueError()))
+        self.assertFalse(exc_filter.needs_content)
+
+    def test_content_blacklist(self):
+        """
+        Any of the content patterns match.
+        """
+        exc_filter = ExceptionFilter(
+            classes=(), patterns=('first', re.compile('sec.nd')))
+        self.assertTrue(exc_filter.needs_content)
+        self.assertTrue(exc_filter.is_blacklisted(ValueError(), 'a second'))
+        self.assertTrue(exc_filter.is_blacklisted(ValueError(), 'first'))
+        self.assertFalse(exc_filter.is_blacklisted(ValueError(), 'third'))
+        self.assertFalse(exc_filter.is_blacklisted(ValueError()))
+
+    def test_content_flags_and_groups(self):
+        """
+        Flags of compiled patterns and group references keep working.
+        """
+        exc_filter = ExceptionFilter(classes=(), patterns=(
+            re.compile('secret', re.I), r'(?P<word>\w+) (?P=word)',
+            r'(\d)\1', 'plain'))
+        self.assertEquals(len(exc_filter.content_rxs), 4)
+        for content in ('SECRET', 'again again', 'x 11', 'plain'):
+            self.assertTrue(exc_filter.content_blacklisted(content))
+        for content in ('secre', 'again there', 'x 12'):
+            self.assertFalse(exc_filter.content_blacklisted(content))
+
+
+def custom_fingerprint(exception, tb):
+    """
+    Fingerprint function used by FingerprinterTestCase.
+    """
+    return 'custom'
+
+
+class FingerprinterTestCase(TestCasePlus):
+    """
+    Tests for exception fingerprinting.
+    """
+
+    def _raise(self, data, exception=ValueError):
+        """
+        Raises an exception from one spot and returns it with its
+        traceback object.
+        """
+        try:
+            raise exception(data)
+        except Exception, ex:
+            return ex, sys.exc_info()[2]
+
+    def test_default_fingerprint(self):
+        """
+        The message doesn't change the fingerprint but the class does.
+        """
+        first = default_fingerprint(*self._raise('id 1'))
+        self.assertEquals(first, default_fingerprint(*self._raise('id 2')))
+        self.assertNotEquals(
+            first, default_fingerprint(*self._raise('id 1', TypeError)))
+
+    def test_per_class_fingerprint(self):
+        """
+        Fingerprint functions can be registered per exception class.
+        """
+        fingerprinter = Fingerprinter({
+            LookupError: 'error_capture_middleware.tests.custom_fingerprint'})
+        self.assertEquals(
+            fingerprinter(*self._raise('test', KeyError)), 'custom')
+        self.assertEquals(fingerprinter(*self._raise('test')),
+            default_fingerprint(*self._raise('test')))
+
+
+class DuplicateCacheTestCase(TestCasePlus):
+    """
+    Tests for duplicate suppression.
+    """
+
+    def test_ttl_cache(self):
+        """
+        Entries expire and the least recently used is dropped.
+        """
+        local = TTLCache(2)
+        local.set('a', 1, time.time() + 60)
+        local.set('b', 2, time.time() + 60)
+        local.get('a')
+        local.set('c', 3, time.time() + 60)
+        self.assertEquals(local.get('a'), 1)
+        self.assertEquals(local.get('b'), None)
+        local.set('d', 4, time.time() - 1)
+        self.assertEquals(local.get('d'), None)
+
+    def test_record(self):
+        """
+        Only the first occurrence in a window is dispatched, across
+        instances sharing a cache.
+        """
+        dupes = DuplicateCache(60, 10, 'default')
+        self.assertEquals(dupes.record('test-record'), (True, None))
+        self.assertEquals(dupes.record('test-record'), (False, None))
+        # Another process only has the shared cache
+        other = DuplicateCache(60, 10, 'default')
+        self.assertEquals(other.record('test-record'), (False, None))
+        self.assertEquals(dupes.record('test-other'), (True, None))
+
+    def test_occurrences(self):
+        """
+        Suppressed occurrences are counted and handed back when the next
+        window opens.
+        """
+        dupes = DuplicateCache(60, 10, 'default')
+        other = DuplicateCache(60, 10, 'default')
+        dupes.record('test-count')
+        for i in range(3):
+            dupes.record('test-count')
+            other.record('test-count')
+        dupes.flush()
+        other.flush()
+        # Close the window
+        dupes.cache.delete(dupes._keys('test-count')[0])
+        dupes.local = TTLCache(10)
+        dispatch, previous = dupes.record('test-count')
+        self.assertTrue(dispatch)
+        self.assertEquals(previous.count, 7)
+        self.assertTrue(previous.first_seen <= previous.last_seen)
+
+    def test_close(self):
+        """
+        Expired windows are reported by the process which opened them
+        without waiting for the next occurrence, with the counts other
+        processes held locally.
+        """
+        closed = []
+        dupes = DuplicateCache(60, 10, 'default', on_close=closed.append)
+        other = DuplicateCache(60, 10, 'default')
+        self.addCleanup(dupes.stop)
+        self.addCleanup(other.stop)
+        dupes.record('test-close')
+        dupes.record('test-close')
+        for i in range(2):
+            other.record('test-close')
+        later = time.time() + 61
+        # Other processes only flush their counts
+        self.assertEquals(other.sweep(later), 0)
+        dupes.cache.delete(dupes._keys('test-close')[0])
+        self.assertEquals(dupes.sweep(later), 1)
+        self.assertEquals(closed[0].count, 4)
+        self.assertEquals(len(dupes.local), 0)
+        # Already reported, so the next window doesn't hand them back
+        self.assertEquals(dupes.record('test-close'), (True, None))
+
+    def test_sweeper(self):
+        """
+        The sweeper thread closes windows once they expire.
+        """
+        closed = []
+        dupes = DuplicateCache(1, 10, 'default', flush_interval=0.05,
+            on_close=closed.append)
+        self.addCleanup(dupes.stop)
+        dupes.record('test-sweeper')
+        dupes.record('test-sweeper')
+        deadline = time.time() + 3
+        while not closed and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEquals([x.count for x in closed], [2])
+
+    def test_disabled(self):
+        """
+        A timeout of 0 turns off suppression.
+        """
+        dupes = DuplicateCache(0, 10, 'default')
+        self.assertEquals(dupes.record('test-disabled'), (True, None))
+        self.assertEquals(dupes.record('test-disabled'), (True, None))
+
+
+class WorkerPoolTestCase(TestCasePlus):
+    """
+    Tests for the background worker pool.
+    """
+
+    def test_submit(self):
+        """
+        Work is run by the workers and they exit on shutdown.
+        """
+        pool = WorkerPool(2, 10)
+        results = Queue.Queue()
+        self.assertTrue(pool.submit(results.put, 'done'))
+        self.assertEquals(results.get(timeout=1), 'done')
+        pool.shutdown(timeout=1)
+        self.assertFalse(pool.submit(results.put, 'late'))
+        self.assertFalse([x for x in pool._threads if x.isAlive()])
+
+    def test_shutdown_timeout(self):
+        """
+        The timeout bounds shutdown even when the workers are stuck and
+        the queue is full.
+        """
+        release = threading.Event()
+        for kwargs in ({'timeout': 0.2}, {'wait': False}):
+            pool = WorkerPool(1, 1)
+            pool.submit(release.wait)
+            time.sleep(0.05)
+            pool.submit(release.wait)
+            start = time.time()
+            pool.shutdown(**kwargs)
+            self.assertTrue(time.time() - start < 1)
+        release.set()
+        # The stops handed over reach the workers once they are free
+        pool._threads[0].join(1)
+        self.assertFalse(pool._threads[0].isAlive())
+
+    def test_overflow(self):
+        """
+        A full queue is handled as the overflow policy says.
+        """
+        results = []
+        # Without workers the queue is never read
+        pool = WorkerPool(0, 1, 'drop-newest')
+        self.assertTrue(pool.submit(results.append, 1))
+        self.assertFalse(pool.submit(results.append, 2))
+        self.assertEquals(pool._queue.get_nowait()[1], (1, ))
+        self.assertEquals(pool.dropped, 1)
+
+        pool = WorkerPool(0, 1, 'drop-oldest')
+        pool.submit(results.append, 1)
+        self.assertTrue(pool.submit(results.append, 2))
+        self.assertEquals(pool._queue.get_nowait()[1], (2, ))
+        self.assertEquals(pool.dropped, 1)
+
+        pool = WorkerPool(0, 1, 'inline')
+        pool.submit(results.append, 1)
+        self.assertTrue(pool.submit(results.append, 2))
+        self.assertEquals(results, [2])
+
+        self.assertRaises(ImproperlyConfigured, WorkerPool, 0, 1, 'bad')
+
+
+class RateLimiterTestCase(TestCasePlus):
+    """
+    Tests for rate limiting.
+    """
+
+    def test_token_bucket(self):
+        """
+        Buckets empty and refill at their rate.
+        """
+        bucket = TokenBucket(1, 2, now=100)
+        self.assertTrue(bucket.consume(100))
+        self.assertTrue(bucket.consume(100))
+        self.assertFalse(bucket.consume(100))
+        self.assertTrue(bucket.consume(101))
+        self.assertFalse(bucket.consume(101))
+
+    def test_local_limits(self):
+        """
+        Keys are limited on their own and together.
+        """
+        now = time.time()
+        limiter = RateLimiter((3, 60), (2, 60))
+        self.assertTrue(limiter.allow('a', now=now))
+        self.assertTrue(limiter.allow('a', now=now))
+        self.assertFalse(limiter.allow('a', now=now))
+        self.assertTrue(limiter.allow('b', now=now))
+        # The global limit is used up
+        self.assertFalse(limiter.allow('c', now=now))
+        self.assertEquals(limiter.limited, 2)
+        self.assertTrue(RateLimiter().allow('a'))
+
+    def test_shared_limits(self):
+        """
+        Limits shared through the cache hold across instances.
+        """
+        # Start of a period so the test doesn't cross into the next
+        now = time.time() // 60 * 60
+        first = RateLimiter(None, (2, 60), 'default')
+        second = RateLimiter(None, (2, 60), 'default')
+        self.assertTrue(first.allow('shared', now=now))
+        self.assertTrue(second.allow('shared', now=now))
+        self.assertFalse(first.allow('shared', now=now))
+        self.assertTrue(first.allow('shared', now=now + 60))
+
+    def test_key_for(self):
+        """
+        Keys are the fingerprint or the exception type.
+        """
+        self.assertEquals(
+            RateLimiter().key_for(ValueError(), 'abc'), 'abc')
+        self.assertEquals(RateLimiter(key_by='type').key_for(
+            ValueError(), 'abc'), 'exceptions.ValueError')
+
+
+class CircuitBreakerTestCase(TestCasePlus):
+    """
+    Tests for circuit breakers.
+    """
+
+    def _fail(self, breaker, now):
+        """
+        Records a failed call.
+        """
+        breaker.finish(breaker.start(now), False, now)
+
+    def test_open_and_probe(self):
+        """
+        The breaker opens after the failures, lets one probe through after
+        the reset time and closes if it works.
+        """
+        breaker = CircuitBreaker(failures=2, reset=10, timeout=5)
+        now = time.time()
+        self._fail(breaker, now)
+        self.assertFalse(breaker.is_open(now))
+        self._fail(breaker, now)
+        self.assertTrue(breaker.is_open(now))
+        self.assertRaises(CircuitOpen, breaker.start, now)
+        self.assertEquals(breaker.refused, 1)
+        # Probe
+        self.assertFalse(breaker.is_open(now + 10))
+        token = breaker.start(now + 10)
+        self.assertTrue(breaker.is_open(now + 10))
+        self.assertRaises(CircuitOpen, breaker.start, now + 10)
+        breaker.finish(token, True, now + 11)
+        self.assertEquals(breaker.state, 'closed')
+        self.assertFalse(breaker.is_open(now + 11))
+
+    def test_failed_probe(self):
+        """
+        A failed probe opens the breaker again.
+        """
+        breaker = CircuitBreaker(failures=1, reset=10, timeout=5)
+        now = time.time()
+        self._fail(breaker, now)
+        self._fail(breaker, now + 10)
+        self.assertTrue(breaker.is_open(now + 19))
+        self.assertFalse(breaker.is_open(now + 20))
+
+    def test_timeout(self):
+        """
+        Calls running past the timeout count as failures, including ones
+        which never finish.
+        """
+        breaker = CircuitBreaker(failures=2, reset=10, timeout=5)
+        now = time.time()
+        breaker.finish(breaker.start(now), True, now + 6)
+        self.assertEquals(breaker.failed, 1)
+        token = breaker.start(now)
+        self.assertTrue(breaker.is_open(now + 6))
+        # Finishing late doesn't count twice
+        breaker.finish(token, False, now + 7)
+        self.assertEquals(breaker.failed, 2)
+
+    def test_handler(self):
+        """
+        Background calls of a handler go through its breaker and the
+        response is still made while it is open.
+        """
+        with override_settings(ERROR_CAPTURE_BREAKER_FAILURES=1):
+            handler = ErrorCaptureHandler()
+            handler.foreground = True
+
+            def fail(queue):
+                raise IOError('down')
+
+            self.assertRaises(IOError, handler.background_call, fail)
+            self.assertTrue(get_breaker(ErrorCaptureHandler).is_open())
+            self.assertRaises(
+                CircuitOpen, handler.background_call, lambda queue: None)
+            handler = FailingHandler()
+            ex, tb = self._raise_and_get_exception()
+            result = handler(Jelly(user=None, META={}, GET={}, POST={}), ex,
+                sys.exc_info())
+            self.assertEquals(result.status_code, 500)
+            self.assertEquals(FailingHandler.calls, 1)
+
+
+class FailingHandler(ErrorCaptureHandler):
+    """
+    Handler whose background work fails.
+    """
+
+    breaker_failures = 1
+    calls = 0
+
+    def handle(self, request, exception, tb):
+        """
+        Starts failing background work.
+        """
+
+        def fail(queue):
+            FailingHandler.calls += 1
+            raise IOError('down')
+
+        self.foreground = True
+        try:
+            self.background_call(fail)
+        except IOError:
+            pass
+        self.background_call(fail)
+
+
+class SamplerTestCase(TestCasePlus):
+    """
+    Tests for the sampler.
+    """
+
+    def test_disabled(self):
+        """
+        Everything is captured with a weight of 1 by default.
+        """
+        sampler = Sampler()
+        self.assertFalse(sampler.enabled)
+        self.assertEquals([sampler.sample('a') for x in range(5)], [1] * 5)
+
+    def test_decay(self):
+        """
+        The first occurrence is always captured, then a decaying fraction
+        of the others with the matching weight.
+        """
+        sampler = Sampler(decay=True, random=lambda: 0.3)
+        self.assertEquals([sampler.rate_for(x) for x in (1, 2, 3, 4, 8)],
+            [1, 0.5, 0.5, 0.25, 0.125])
+        weights = [sampler.sample('a') for x in range(8)]
+        self.assertEquals(weights, [1, 2, 2, 0, 0, 0, 0, 0])
+        self.assertEquals(sampler.dropped, 5)
+        # Other fingerprints start over
+        self.assertEquals(sampler.sample('b'), 1)
+        # So do quiet ones
+        sampler = Sampler(decay=True, window=0.05, random=lambda: 0.9)
+        self.assertEquals(sampler.sample('a'), 1)
+        self.assertEquals(sampler.sample('a'), 0)
+        time.sleep(0.1)
+        self.assertEquals(sampler.sample('a'), 1)
+
+    def test_load(self):
+        """
+        Over the load threshold repeats are sampled at the load rate.
+        """
+        sampler = Sampler(load_threshold=1, load_rate=0.5, load_period=1,
+            random=lambda: 0.3)
+        now = time.time()
+        self.assertEquals(sampler.sample('a', now), 1)
+        self.assertEquals(sampler.sample('a', now), 2)
+        self.assertEquals(sampler.sample('b', now), 1)
+        sampler.random = lambda: 0.7
+        self.assertEquals(sampler.sample('a', now), 0)
+        # Back under the threshold
+        self.assertEquals(sampler.sample('a', now + 60), 1)
+
+
+class OccurrenceFlusherTestCase(TestCasePlus):
+    """
+    Tests for batched occurrence counting.
+    """
+
+    def test_flush(self):
+        """
+        Collected counts are added to the unresolved errors.
+        """
+        error = Error.objects.create(traceback='tb', fingerprint='abc')
+        resolved = Error.objects.create(
+            traceback='tb', fingerprint='abc', resolved=True)
+        flusher = OccurrenceFlusher()
+        flusher.add('abc')
+        flusher.add('abc', 2)
+        flusher.add('other')
+        self.assertEquals(flusher.flush(), 2)
+        self.assertEquals(flusher.flush(), 0)
+        self.assertEquals(Error.objects.get(id=error.id).occurrences, 4)
+        self.assertEquals(Error.objects.get(id=resolved.id).occurrences, 1)
+
+
+class FlakyHandler(ErrorCaptureHandler):
+    """
+    Handler which fails until told otherwise. Used by SpoolTestCase.
+    """
+
+    fail = True
+    handled = []
+
+    def handle(self, request, exception, tb):
+        """
+        Records the exception or fails.
+        """
+        if FlakyHandler.fail:
+            raise IOError('remote is down')
+        FlakyHandler.handled.append(
+            (exception.type_name, unicode(exception), request.GET['q']))
+
+
+class SpoolTestCase(TestCasePlus):
+    """
+    Tests for the delivery spool.
+    """
+
+    def setUp(self):
+        """
+        Creates a spool in a temporary directory.
+        """
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'spool.db')
+        self.spool = Spool(self.path, max_attempts=3, backoff=10)
+        FlakyHandler.fail = True
+        FlakyHandler.handled = []
+
+    def tearDown(self):
+        """
+        Removes the temporary directory.
+        """
+        shutil.rmtree(self.tempdir)
+
+    def _event(self):
+        """
+        Returns an event to spool.
+        """
+        request = Jelly(user=None, META={'wsgi.input': StringIO()},
+            GET={'q': 'x'}, POST={})
+        try:
+            raise ValueError('test')
+        except ValueError, ex:
+            return ErrorEvent(request, ex, sys.exc_info())
+
+    def test_retry_with_backoff(self):
+        """
+        Failed deliveries are retried later and removed when delivered,
+        also by a new spool on the same file.
+        """
+        self.spool.put([FlakyHandler], self._event())
+        now = time.time()
+        self.assertEquals(self.spool.drain(now), 0)
+        self.assertEquals(len(self.spool), 1)
+        # Backing off
+        self.assertEquals(self.spool.drain(now + 5), 0)
+        FlakyHandler.fail = False
+        restarted = Spool(self.path)
+        self.assertEquals(restarted.drain(now + 11), 1)
+        self.assertEquals(FlakyHandler.handled, [('ValueError', 'test', 'x')])
+        self.assertEquals(len(restarted), 0)
+
+    def test_locked(self):
+        """
+        A locked spool fails fast and the middleware dispatches as usual.
+        """
+        handler = 'django_error_capture_middleware.tests.EventIdHandler'
+        with override_settings(ERROR_CAPTURE_SPOOL_PATH=self.path,
+                ERROR_CAPTURE_HANDLERS=(handler, handler)):
+            middleware = ErrorCaptureMiddleware()
+            lock = sqlite3.connect(self.path)
+            lock.execute('BEGIN EXCLUSIVE')
+            try:
+                start = time.time()
+                self.assertRaises(sqlite3.OperationalError,
+                    self.spool.put, [FlakyHandler], self._event())
+                try:
+                    raise ValueError('locked')
+                except ValueError, ex:
+                    response = middleware.process_exception(
+                        RequestFactory().get('/'), ex)
+                self.assertEquals(response.status_code, 500)
+                self.assertTrue(time.time() - start < 1)
+            finally:
+                lock.rollback()
+                lock.close()
+
+    def test_max_attempts(self):
+        """
+        Deliveries are dropped after max_attempts failures.
+        """
+        self.spool.put([FlakyHandler], self._event())
+        now = time.time()
+        for i in range(3):
+            self.spool.drain(now + 1000 * i)
+        self.assertEquals(len(self.spool), 0)
+
+
+class ErrorEventTestCase(TestCasePlus):
+    """
+    Tests for error events.
+    """
+
+    def _event(self):
+        """
+        Returns an event for a raised exception.
+        """
+        request = Jelly(user=Jelly(pk=3), META={'HTTP_HOST': 'example.com',
+            'wsgi.input': StringIO()}, GET={'q': 'x'}, POST={})
+        try:
+            raise ValueError('test')
+        except ValueError, ex:
+            return ErrorEvent(request, ex, sys.exc_info(), 'abc')
+
+    def test_lazy_fields(self):
+        """
+        Fields are computed once and the event can't be changed.
+        """
+        event = self._event()
+        self.assertFalse('traceback' in event._cache)
+        self.assertTrue(event.traceback is event.traceback)
+        self.assertTrue('ValueError: test' in event.traceback[-1])
+        self.assertEquals(event.context_data['HTTP_HOST'], 'example.com')
+        self.assertRaises(AttributeError, setattr, event, 'fingerprint', '')
+
+    def test_event_id(self):
+        """
+        Events get a ULID which sorts by time and is kept when detached.
+        """
+        first = ErrorEvent(None, None, None, timestamp=1000)
+        second = ErrorEvent(None, None, None, timestamp=1000.001)
+        self.assertEquals(len(first.id), 26)
+        self.assertTrue(first.id < second.id)
+        self.assertNotEquals(first.id,
+            ErrorEvent(None, None, None, timestamp=1000).id)
+        event = self._event()
+        self.assertEquals(event.context_data['event_id'], event.id)
+        self.assertEquals(ErrorEvent.from_dict(event.to_dict()).id, event.id)
+
+    def test_sample_weight(self):
+        """
+        The sample weight is in the context and kept when detached.
+        """
+        event = ErrorEvent(None, None, None, sample_weight=4)
+        self.assertEquals(ErrorEvent.from_dict(
+            self._event().to_dict()).sample_weight, 1)
+        self.assertEquals(event.sample_weight, 4)
+
+    def test_release(self):
+        """
+        Released events keep what they need from the traceback but not the
+        frames, and reprs of locals are only made when used.
+        """
+        try:
+            raise ValueError('test')
+        except ValueError, ex:
+            event = ErrorEvent(None, ex, sys.exc_info(),
+                policy=CapturePolicy(frame_locals=1))
+        event.release()
+        self.assertEquals(event.exc_info[2], None)
+        self.assertTrue('ValueError: test' in event.traceback[-1])
+        self.assertFalse('frame_locals' in event._cache)
+        self.assertTrue('self' in dict(event.frame_locals[0]['locals']))
+        self.assertFalse('locals_snapshot' in event._cache)
+        detached = ErrorEvent.from_dict(event.to_dict())
+        self.assertEquals(detached.frame_locals, event.frame_locals)
+
+    def test_snapshot(self):
+        """
+        A snapshot only copies the frame locals, the rest stays lazy.
+        """
+        try:
+            raise ValueError('test')
+        except ValueError, ex:
+            event = ErrorEvent(None, ex, sys.exc_info(),
+                policy=CapturePolicy(frame_locals=1))
+        event.snapshot()
+        self.assertTrue('locals_snapshot' in event._cache)
+        self.assertFalse('traceback' in event._cache)
+        self.assertFalse('frames' in event._cache)
+        self.assertTrue(event.exc_info[2] is not None)
+        self.assertEquals(event.frames[-1][2], 'test_snapshot')
+
+    def test_detached(self):
+        """
+        Events survive a round trip through to_dict.
+        """
+        event = ErrorEvent.from_dict(self._event().to_dict())
+        self.assertTrue(event.detached)
+        self.assertEquals(event.fingerprint, 'abc')
+        self.assertEquals(event.user_id, 3)
+        self.assertEquals(event.get['q'], 'x')
+        self.assertFalse('wsgi.input' in event.meta)
+        self.assertEquals(event.get_exception().type_name, 'ValueError')
+        self.assertEquals(unicode(event.get_exception()), 'test')
+        self.assertEquals(event.get_request().META['HTTP_HOST'],
+            'example.com')
+
+    def test_shared_context(self):
+        """
+        Handlers share the event data without changing it.
+        """
+        event = self._event()
+        first = ErrorCaptureHandler()
+        first.use_event(event)
+        first.context['id'] = 1
+        second = ErrorCaptureHandler()
+        second.use_event(event)
+        self.assertEquals(second.context['fingerprint'], 'abc')
+        self.assertFalse('id' in second.context)
+
+
+class CapturePolicyTestCase(TestCasePlus):
+    """
+    Tests for the capture policy.
+    """
+
+    def test_meta(self):
+        """
+        Only whitelisted, simple META values are kept.
+        """
+        policy = CapturePolicy(meta_whitelist=('HTTP_*', 'PATH_INFO'),
+            meta_blacklist=('HTTP_COOKIE', ))
+        request = RequestFactory().get('/path', HTTP_HOST='example.com',
+            HTTP_COOKIE='secret=1')
+        meta, get, post = policy.capture(request)
+        self.assertEquals(meta, {'PATH_INFO': '/path',
+            'HTTP_HOST': 'example.com'})
+
+    def test_caps(self):
+        """
+        Values are capped in bytes and in number.
+        """
+        policy = CapturePolicy(max_value_bytes=5, max_values=2)
+        self.assertEquals(policy.cap('abcdefgh'), 'abcde')
+        # Characters are not split
+        self.assertEquals(policy.cap(u'\xe9\xe9\xe9'), u'\xe9\xe9')
+        request = RequestFactory().get('/', {'q': ['1', '2', '3']})
+        self.assertEquals(policy.capture(request)[1].getlist('q'), ['1', '2'])
+
+    def test_ceiling(self):
+        """
+        Values stop being added at the event ceiling.
+        """
+        policy = CapturePolicy(meta_whitelist=(), max_event_bytes=20)
+        request = RequestFactory().get('/', {'a': 'x' * 10, 'b': 'y' * 10})
+        self.assertEquals(len(policy.capture(request)[1]), 1)
+        self.assertEquals(len(policy.capture(request, 20)[1]), 0)
+        lines = ['Traceback\n'] + ['frame %d\n' % x for x in range(10)]
+        capped = CapturePolicy(max_event_bytes=40).cap_traceback(lines)
+        self.assertEquals(capped, ['Traceback\n',
+            '  ... 9 lines omitted ...\n', 'frame 9\n'])
+
+    def test_unread_body(self):
+        """
+        Bodies which were not read are left alone, read ones are parsed.
+        """
+        policy = CapturePolicy()
+        request = RequestFactory().post('/', {'name': 'value'})
+        self.assertEquals(len(policy.capture(request)[2]), 0)
+        self.assertFalse(hasattr(request, '_post'))
+        request = RequestFactory().post('/', 'name=value',
+            content_type='application/x-www-form-urlencoded')
+        request.body
+        self.assertEquals(policy.capture(request)[2]['name'], 'value')
+
+    def test_frame_locals(self):
+        """
+        Locals of the innermost frames are copied and shown with capped
+        reprs within the time budget.
+        """
+
+        def fail(request, text):
+            number = 1
+            raise ValueError(text)
+
+        request = RequestFactory().post('/form', {'name': 'value'})
+        policy = CapturePolicy(frame_locals=1, max_repr_length=20)
+        try:
+            fail(request, 'x' * 100)
+        except ValueError:
+            snapshot = policy.snapshot_locals(sys.exc_info()[2])
+        self.assertEquals(len(snapshot), 1)
+        self.assertEquals(snapshot[0][2], 'fail')
+        frames = policy.repr_locals(snapshot)
+        self.assertEquals(frames[0]['function'], 'fail')
+        values = dict(frames[0]['locals'])
+        self.assertEquals(values['number'], '1')
+        self.assertTrue(len(values['text']) <= 20)
+        self.assertEquals(values['request'], "<WSGIRequest /form>")
+        self.assertFalse(hasattr(request, '_post'))
+        frames = CapturePolicy(frame_locals=1,
+            frame_locals_budget=-1).repr_locals(snapshot)
+        self.assertEquals(frames[0]['locals'],
+            [['...', 'time budget used up']])
+        self.assertEquals(CapturePolicy().snapshot_locals(
+            sys.exc_info()[2]), [])
+
+    def test_safe_repr(self):
+        """
+        Only cheap builtin reprs are used, other objects never run their
+        __repr__ or hit the database.
+        """
+        calls = []
+
+        class Loud(object):
+
+            def __repr__(self):
+                calls.append(1)
+                return 'loud'
+
+            def method(self):
+                pass
+
+        class LoudNumber(int):
+
+            def __repr__(self):
+                calls.append(1)
+                return 'loud'
+
+        lazy = SimpleLazyObject(lambda: calls.append(1))
+        limited = LimitedRepr(200, 3)
+        with self.assertNumQueries(0):
+            self.assertEquals(limited.repr(Error.objects.all()),
+                '<QuerySet of Error>')
+            self.assertEquals(limited.repr(Error.objects),
+                '<Manager of Error>')
+            self.assertEquals(limited.repr(Error(pk=3)), '<Error pk=3>')
+        self.assertTrue('.Loud object at 0x' in limited.repr(Loud()))
+        self.assertTrue('SimpleLazyObject object at 0x' in limited.repr(lazy))
+        self.assertEquals(limited.repr(Loud().method),
+            '<bound method Loud.method>')
+        self.assertEquals(limited.repr(Loud.method),
+            '<unbound method Loud.method>')
+        self.assertEquals(limited.repr(LoudNumber(5)), '5')
+        self.assertEquals(limited.repr(Loud), "<class '%s.Loud'>" % __name__)
+        self.assertEquals(limited.repr(mark_safe('safe')), "'safe'")
+        self.assertEquals(len(LimitedRepr(20, 3).repr(mark_safe('x' * 100))),
+            20)
+        self.assertEquals(calls, [])
+        self.assertTrue(limited.repr(ValueError('x', [Loud()])).startswith(
+            "ValueError('x', [<"))
+        self.assertEquals(limited.repr(http.QueryDict('a=1')), "{u'a': u'1'}")
+        self.assertEquals(limited.repr([1, 'a', None, 2.5]),
+            "[1, 'a', None, 2.5]")
+
+
+class FileHandler(ErrorCaptureHandler):
+    """
+    Handler writing the fingerprint to the file named by the
+    PATH_INFO header. Used by ProcessPoolTestCase.
+    """
+
+    def handle(self, request, exception, tb):
+        """
+        Writes the fingerprint and exception type.
+        """
+        out = open(request.META['PATH_INFO'], 'w')
+        out.write('%s %s' % (
+            self.context['fingerprint'], exception.type_name))
+        out.close()
+
+
+class ProcessPoolTestCase(TestCasePlus):
+    """
+    Tests for the pre-forked process pool.
+    """
+
+    def test_dispatch(self):
+        """
+        Events are delivered to handlers in a worker process.
+        """
+        import pickle
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'out')
+        request = Jelly(user=None, META={'PATH_INFO': path}, GET={}, POST={})
+        try:
+            raise ValueError('test')
+        except ValueError, ex:
+            event = ErrorEvent(request, ex, sys.exc_info(), 'abc')
+        # Events pickle as their detached form
+        self.assertEquals(
+            pickle.loads(pickle.dumps(event)).exception_type, 'ValueError')
+        pool = ProcessPool(1, 10)
+        try:
+            self.assertTrue(
+                pool.dispatch(FileHandler, request, ex, None, event))
+            self.assertRaises(TypeError, pool.submit, len, 'abc')
+            for i in range(50):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            pool.shutdown(timeout=5)
+            self.assertEquals(open(path).read(), 'abc ValueError')
+        finally:
+            shutil.rmtree(tempdir)
+
+
+    def test_forked_at_startup(self):
+        """
+        The middleware forks the worker processes when it is configured,
+        not on the first captured exception.
+        """
+        with override_settings(ERROR_CAPTURE_WORKER_TYPE='process'):
+            middleware = ErrorCaptureMiddleware()
+            pool = workers._process_pool
+            self.assertTrue(isinstance(pool, ProcessPool))
+            self.assertTrue(get_dispatcher() is pool)
+            self.assertTrue([x for x in pool._threads if x.is_alive()])
+        # Leaving the override shut the pool down
+        for process in pool._threads:
+            process.join(5)
+        self.assertFalse([x for x in pool._threads if x.is_alive()])
 
 
 class _ParentTicketHandlerMixIn(object):
@@ -203,7 +1348,7 @@ class _ParentTicketHandlerMixIn(object):
         queue, prc = self.instance.background_call(simple)
         self.assertTrue(isinstance(queue, queue_mod.Queue))
         if settings.ERROR_CAPTURE_ENABLE_MULTPROCESS:
-            self.assertTrue(isinstance(prc, thread_cls))
+            self.assertTrue(isinstance(prc, WorkerPool))
         self.assertEquals(queue.get(), 'simple')
 
     def test_background_call(self):
@@ -218,7 +1363,7 @@ class _ParentTicketHandlerMixIn(object):
             less_simple, ('data', ), {'to': 'to'})
         self.assertTrue(isinstance(queue, queue_mod.Queue))
         if settings.ERROR_CAPTURE_ENABLE_MULTPROCESS:
-            self.assertTrue(isinstance(prc, thread_cls))
+            self.assertTrue(isinstance(prc, WorkerPool))
         self.assertEquals(queue.get(), "data to append")
 
         queue, prc = self.instance.background_call(
@@ -265,6 +1410,44 @@ class ErrorCaptureHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
             self.dummy_request, ex, sys.exc_info())
         settings.DEBUG = False
 
+    def test_response_budget(self):
+        """
+        get_data waits for background calls until the budget is used up.
+        """
+
+        def slow(delay, queue):
+            time.sleep(delay)
+            queue.put_nowait('slow')
+
+        self.instance.deadline = time.time() + 0.5
+        queue, prc = self.instance.background_call(slow, (0.05, ))
+        self.assertEquals(self.instance.get_data(queue), 'slow')
+        self.instance.deadline = time.time() + 0.05
+        queue, prc = self.instance.background_call(slow, (0.5, ))
+        start = time.time()
+        self.assertEquals(self.instance.get_data(queue), None)
+        self.assertTrue(time.time() - start < 0.4)
+
+    def test_remote_ticket(self):
+        """
+        Remote tickets are returned to the response and linked to the
+        event.
+        """
+        ex, tb = self._raise_and_get_exception()
+        self.instance.use_event(
+            ErrorEvent(self.dummy_request, ex, sys.exc_info()))
+        self.instance.foreground = True
+
+        def create(queue):
+            self.instance.remote_ticket(queue, '12', 'http://example.com/12')
+
+        queue, result = self.instance.background_call(create)
+        self.assertEquals(
+            self.instance.get_data(queue), ('12', 'http://example.com/12'))
+        link = RemoteLink.objects.get(event_id=self.instance.event.id)
+        self.assertEquals(link.remote_id, '12')
+        self.assertEquals(link.handler, 'ErrorCaptureHandler')
+
 
 class SimpleTicketHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
     """
@@ -273,6 +1456,18 @@ class SimpleTicketHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
 
     test_cls = simple_ticket.SimpleTicketHandler
 
+    def test_repeat(self):
+        """
+        Repeats of an unresolved error reuse its ticket.
+        """
+        ex, tb = self._raise_and_get_exception()
+        self.instance.context['fingerprint'] = 'repeat'
+        self.instance.handle(self.dummy_request, ex, tb)
+        first = self.instance.context['id']
+        self.instance.handle(self.dummy_request, ex, tb)
+        self.assertEquals(self.instance.context['id'], first)
+        self.assertEquals(Error.objects.filter(fingerprint='repeat').count(), 1)
+
 
 class EmailHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
     """
@@ -295,6 +1490,252 @@ class EmailHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
         super(EmailHandlerTestCase, self).setUp()
         self.instance.send_mail = send_mail
 
+    def test_send(self):
+        """
+        Without a digest every event is mailed to the admins.
+        """
+        settings.ERROR_CAPTURE_ADMINS = ('user@localhost', )
+        mail.outbox = []
+        handler = email.EmailHandler()
+        handler.foreground = True
+        try:
+            raise ValueError('mailed')
+        except ValueError, ex:
+            response = handler(self.dummy_request, ex, sys.exc_info())
+        self.assertEquals(response.status_code, 500)
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(mail.outbox[0].to, ['user@localhost'])
+        self.assertTrue('ValueError' in mail.outbox[0].body)
+
+
+class EmailDigestTestCase(TestCasePlus):
+    """
+    Tests for email digests.
+    """
+
+    def setUp(self):
+        """
+        Sets up the admins and clears the outbox.
+        """
+        settings.ERROR_CAPTURE_ADMINS = ('user@localhost', )
+        mail.outbox = []
+        HandlerRegistry(('django_error_capture_middleware.handlers.email.'
+            'EmailHandler', ))
+
+    def test_summary(self):
+        """
+        Events are grouped by fingerprint and sent in one message.
+        """
+        digest = email.EmailDigest(top=1)
+        renders = []
+
+        def render():
+            renders.append(1)
+            return 'Error at /a', 'Traceback a'
+
+        self.assertTrue(digest.add('a', 1, render))
+        self.assertFalse(digest.add('a', 2, render))
+        digest.add('b', 1, lambda: ('Error at /b', 'Traceback b'))
+        self.assertEquals(len(renders), 1)
+        self.assertEquals(digest.flush(), 1)
+        self.assertEquals(len(mail.outbox), 1)
+        message = mail.outbox[0]
+        self.assertTrue('4 errors' in message.subject)
+        self.assertTrue('3 x Error at /a' in message.body)
+        self.assertTrue('1 x 1 other error' in message.body)
+        self.assertTrue('Traceback a' in message.body)
+        self.assertFalse('Traceback b' in message.body)
+        self.assertEquals(digest.flush(), 0)
+
+    def test_split(self):
+        """
+        With split every top fingerprint gets a message over the same
+        connection.
+        """
+        digest = email.EmailDigest(split=True)
+        digest.add('a', 1, lambda: ('Error at /a', 'Traceback a'))
+        digest.add('a')
+        digest.add('b', 1, lambda: ('Error at /b', 'Traceback b'))
+        self.assertEquals(digest.flush(), 2)
+        self.assertEquals(sorted([x.subject for x in mail.outbox]),
+            ['Error at /a (2 times)', 'Error at /b (1 times)'])
+
+    def test_handler(self):
+        """
+        In digest mode the handler buffers instead of sending.
+        """
+        with override_settings(ERROR_CAPTURE_EMAIL_DIGEST_SEC=3600):
+            handler = email.EmailHandler()
+            handler.context['fingerprint'] = 'abc'
+            ex, tb = self._raise_and_get_exception()
+            handler.handle(Jelly(user=None, META={}), ex, tb)
+            email.EmailHandler.count_occurrence('abc')
+            self.assertEquals(mail.outbox, [])
+        # Sent when the digest is stopped
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertTrue('2 errors' in mail.outbox[0].subject)
+
+    def test_sampled_count(self):
+        """
+        Occurrences sampled out are only counted once, so the digest
+        counts every real occurrence.
+        """
+        with override_settings(ERROR_CAPTURE_EMAIL_DIGEST_SEC=3600,
+                ERROR_CAPTURE_HANDLERS=('django_error_capture_middleware.'
+                    'handlers.email.EmailHandler', )):
+            middleware = ErrorCaptureMiddleware()
+            middleware.sampler = Sampler(decay=True, random=lambda: 0.3)
+            request = RequestFactory().get('/')
+            for x in range(50):
+                try:
+                    raise ValueError('sampled')
+                except ValueError, ex:
+                    middleware.process_exception(request, ex)
+            self.assertTrue(middleware.sampler.dropped > 0)
+            groups = email.get_digest()._groups.values()
+            self.assertEquals([x['count'] for x in groups], [50])
+
+
+class ConnectionPoolTestCase(TestCasePlus):
+    """
+    Tests for pooled email connections.
+    """
+
+    def setUp(self):
+        """
+        Clears the outbox.
+        """
+        mail.outbox = []
+
+    def send(self, connection):
+        """
+        Sends a message over a connection.
+
+        :Parameters:
+           - `connection`: email backend instance
+        """
+        return connection.send_messages([mail.EmailMessage(
+            'subject', 'body', 'from@localhost', ['to@localhost'])])
+
+    def test_reuse(self):
+        """
+        Connections are reused across sends.
+        """
+        pool = email.ConnectionPool(size=1)
+        self.assertEquals(pool.send(self.send), 1)
+        self.assertEquals(pool.send(self.send), 1)
+        self.assertEquals(len(mail.outbox), 2)
+        self.assertEquals(pool.opened, 1)
+        self.assertEquals(pool.reused, 1)
+        self.assertEquals(pool.reuse_rate(), 0.5)
+        pool.close()
+        self.assertEquals(pool.stats()['idle'], 0)
+
+    def test_health_check(self):
+        """
+        Idle connections which fail a NOOP are replaced.
+        """
+        pool = email.ConnectionPool(size=1, check_interval=0)
+        pool.send(self.send)
+
+        def noop():
+            raise smtplib.SMTPServerDisconnected('gone')
+
+        pool._idle[0][0].connection = Jelly(noop=noop)
+        time.sleep(0.01)
+        self.assertEquals(pool.send(self.send), 1)
+        self.assertEquals(pool.opened, 2)
+        self.assertEquals(pool.reused, 0)
+
+    def test_reconnect(self):
+        """
+        A send on a dropped connection is retried on a new one.
+        """
+        pool = email.ConnectionPool(size=1)
+        calls = []
+
+        def dropping(connection):
+            calls.append(connection)
+            if len(calls) == 1:
+                raise smtplib.SMTPServerDisconnected('gone')
+            return self.send(connection)
+
+        self.assertEquals(pool.send(dropping), 1)
+        self.assertEquals(pool.reconnects, 1)
+        self.assertEquals(len(mail.outbox), 1)
+
+        def failing(connection):
+            raise smtplib.SMTPRecipientsRefused({})
+
+        self.assertRaises(smtplib.SMTPRecipientsRefused, pool.send, failing)
+        self.assertEquals(pool.send(failing, fail_silently=True), None)
+        self.assertEquals(pool.reconnects, 1)
+
+
+class HTTPPoolTestCase(TestCasePlus):
+    """
+    Tests for pooled HTTP connections.
+    """
+
+    def setUp(self):
+        """
+        Starts the stub server.
+        """
+        self.server = StubHTTPServer(lambda path, body: (200, body))
+
+    def tearDown(self):
+        """
+        Stops the stub server.
+        """
+        self.server.stop()
+
+    def test_reuse(self):
+        """
+        Connections are kept alive and reused.
+        """
+        pool = HTTPPool()
+        for x in range(3):
+            self.assertEquals(pool.request('POST', self.server.url + '/a',
+                'body %s' % x)[::2], (200, 'body %s' % x))
+        self.assertEquals(self.server.connections, 1)
+        self.assertEquals((pool.opened, pool.reused), (1, 2))
+        self.assertEquals(pool.reuse_rate(), 2.0 / 3)
+        pool.close()
+
+    def test_dropped(self):
+        """
+        A request on a connection the server closed is sent again on a
+        new one.
+        """
+        pool = HTTPPool()
+        self.server.close_after_response = True
+        pool.request('POST', self.server.url, 'a')
+        self.server.close_after_response = False
+        time.sleep(0.05)
+        self.assertEquals(pool.request('POST', self.server.url, 'b')[0], 200)
+        self.assertEquals(self.server.connections, 2)
+        self.assertEquals([x[2] for x in self.server.requests], ['a', 'b'])
+        pool.close()
+
+    def test_timeout_not_retried(self):
+        """
+        A request which timed out is not sent again, the server may still
+        act on it.
+        """
+        pool = HTTPPool()
+        pool.request('POST', self.server.url, 'a')
+
+        def slow(path, body):
+            time.sleep(0.3)
+            return 200, body
+
+        self.server.respond = slow
+        self.assertRaises(socket.timeout, pool.request, 'POST',
+            self.server.url, 'b', read_timeout=0.1)
+        time.sleep(0.3)
+        self.assertEquals([x[2] for x in self.server.requests], ['a', 'b'])
+        pool.close()
+
 
 class GitHubHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
     """
@@ -309,14 +1750,124 @@ class GitHubHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
         """
         # Setup the mock
         response = StringIO('issue:\n    number: 123')
-        urllib = Mock('urllib', tracker=None)
-        urllib.urlopen = Mock('urllib.urlopen', returns=response, tracker=None)
+        urllib2 = Mock('urllib2', tracker=None)
+        urllib2.urlopen = Mock(
+            'urllib2.urlopen', returns=response, tracker=None)
+
+        self.server = StubHTTPServer(lambda path, body: (201,
+            '{"number": 123, "html_url": "http://example.com/123"}'))
 
         settings.ERROR_CAPTURE_GITHUB_REPO = 'fake_repo'
         settings.ERROR_CAPTURE_GITHUB_TOKEN = 'fake_token'
         settings.ERROR_CAPTURE_GITHUB_LOGIN = 'fake_login'
+        settings.ERROR_CAPTURE_GITHUB_API = self.server.url
         super(GitHubHandlerTestCase, self).setUp()
-        self.instance.urllib = urllib
+        self.instance.urllib2 = urllib2
+
+    def tearDown(self):
+        """
+        Stops the stub server.
+        """
+        super(GitHubHandlerTestCase, self).tearDown()
+        self.server.stop()
+        del settings.ERROR_CAPTURE_GITHUB_API
+
+    def test_create_issue(self):
+        """
+        Issues are posted as JSON over a kept alive connection.
+        """
+        pool = get_http_pool()
+        reused = pool.reused
+        for x in range(2):
+            self.assertEquals(self.instance.create_issue('title', 'body'),
+                (123, 'http://example.com/123'))
+        self.assertEquals(self.server.connections, 1)
+        self.assertEquals(pool.reused, reused + 1)
+        path, headers, body = self.server.requests[0]
+        self.assertEquals(path, '/repos/fake_repo/issues')
+        self.assertEquals(headers['Authorization'], 'token fake_token')
+        self.assertTrue('"title": "title"' in body)
+
+    def test_error(self):
+        """
+        Anything but a created issue raises.
+        """
+        self.server.respond = lambda path, body: (401, '{}')
+        self.assertRaises(
+            IOError, self.instance.create_issue, 'title', 'body')
+
+    def test_repeat(self):
+        """
+        Repeats of a fingerprint are batched into a comment on its issue.
+        """
+        ex, tb = self._raise_and_get_exception()
+        for x in range(2):
+            handler = self.test_cls()
+            handler.foreground = True
+            handler.context['fingerprint'] = 'repeat'
+            handler.handle(self.dummy_request, ex, tb)
+        self.test_cls.count_occurrence('repeat')
+        self.assertEquals(len(self.server.requests), 1)
+        self.assertEquals(handler.context['id'], '123')
+        self.assertEquals(get_commenter().flush(), 1)
+        path, headers, body = self.server.requests[1]
+        self.assertEquals(path, '/repos/fake_repo/issues/123/comments')
+        self.assertTrue('Seen 2 more times, 3 in total' in body)
+        issue = RemoteIssue.objects.get(fingerprint='repeat')
+        self.assertEquals(issue.handler, 'GitHubHandler')
+        self.assertEquals(issue.occurrences, 3)
+        self.assertEquals(get_commenter().flush(), 0)
+
+    def test_repeats_before_index(self):
+        """
+        Repeats counted before the issue is indexed are kept for the next
+        flush.
+        """
+        self.test_cls.count_occurrence('unindexed')
+        self.test_cls.count_occurrence('unindexed')
+        self.assertEquals(get_commenter().flush(), 0)
+        RemoteIssue.objects.create(handler='GitHubHandler',
+            fingerprint='unindexed', remote_id='123')
+        self.assertEquals(get_commenter().flush(), 1)
+        self.assertTrue('Seen 2 more times, 3 in total' in
+            self.server.requests[0][2])
+
+    def test_sampled_repeats(self):
+        """
+        Occurrences sampled out are only counted once, so the comment
+        counts every real occurrence.
+        """
+        RemoteIssue.objects.create(handler='GitHubHandler',
+            fingerprint='sampled', remote_id='123')
+        with override_settings(ERROR_CAPTURE_HANDLERS=(
+                'django_error_capture_middleware.handlers.github.'
+                'GitHubHandler', )):
+            middleware = ErrorCaptureMiddleware()
+            middleware.fingerprinter = lambda exception, tb: 'sampled'
+            middleware.sampler = Sampler(decay=True, random=lambda: 0.3)
+            request = RequestFactory().get('/')
+            for x in range(50):
+                try:
+                    raise ValueError('sampled')
+                except ValueError, ex:
+                    middleware.process_exception(request, ex)
+            self.assertTrue(middleware.sampler.dropped > 0)
+        self.assertEquals(get_commenter().flush(), 1)
+        self.assertTrue('Seen 50 more times, 51 in total' in
+            self.server.requests[0][2])
+        self.assertEquals(RemoteIssue.objects.get(
+            fingerprint='sampled').occurrences, 51)
+
+    def test_legacy(self):
+        """
+        The YAML API is still used when configured.
+        """
+        ex, tb = self._raise_and_get_exception()
+        self.instance.foreground = True
+        with override_settings(ERROR_CAPTURE_GITHUB_LEGACY_API=True):
+            self.instance.handle(self.dummy_request, ex, tb)
+        self.assertEquals(self.instance.context['id'], 123)
+        self.assertEquals(self.server.requests, [])
 
 
 class GoogleCodeHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
@@ -351,6 +1902,123 @@ class GoogleCodeHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
             gdata_client)
 
 
+class Unauthorized(Exception):
+    """
+    Request error answered with a 401.
+    """
+
+    status = 401
+
+
+class StandInProjectHostingClient(object):
+    """
+    Project hosting client counting logins with a token which can expire.
+    """
+
+    def __init__(self):
+        """
+        Creates an instance of this class.
+        """
+        self.logins = 0
+        self.issues = 0
+        self.expired = False
+
+    def client_login(self, login, password, source, service):
+        """
+        Counts the login and issues a new token.
+        """
+        self.logins += 1
+        self.expired = False
+
+    def add_issue(self, project, title, body, author, status, labels):
+        """
+        Adds an issue if the token is still valid.
+        """
+        if self.expired:
+            raise Unauthorized('Token expired')
+        self.issues += 1
+        return Jelly(find_html_link=lambda: 'http://example.dom/?id=%s' % (
+            self.issues))
+
+
+class GoogleCodeSessionTestCase(TestCasePlus):
+    """
+    Tests for reusing Google Code logins.
+    """
+
+    def add_issue(self, session):
+        """
+        Adds an issue through a session.
+
+        :Parameters:
+           - `session`: GoogleCodeSession to use
+        """
+        return session.call('add_issue', 'project', 'title', 'body',
+            'author', 'open', labels=['Defect'])
+
+    def test_login_reuse(self):
+        """
+        Logins are reused and repeated on a 401.
+        """
+        session = google_code.GoogleCodeSession(
+            StandInProjectHostingClient, 'login', 'password')
+        for x in range(3):
+            self.add_issue(session)
+        self.assertEquals(session.client.logins, 1)
+        self.assertEquals(session.client.issues, 3)
+        session.client.expired = True
+        self.assertEquals(self.add_issue(session).find_html_link(),
+            'http://example.dom/?id=4')
+        self.assertEquals(session.client.logins, 2)
+
+    def test_lifetime(self):
+        """
+        Tokens older than the lifetime are renewed before the call.
+        """
+        session = google_code.GoogleCodeSession(
+            StandInProjectHostingClient, 'login', 'password', lifetime=0)
+        self.add_issue(session)
+        time.sleep(0.01)
+        self.add_issue(session)
+        self.assertEquals(session.client.logins, 2)
+        self.assertEquals(session.logins, 2)
+
+    def test_timeout(self):
+        """
+        Connections of the gdata http_client get the socket timeout.
+        """
+
+        class Client(StandInProjectHostingClient):
+
+            def __init__(self):
+                super(Client, self).__init__()
+                self.http_client = Jelly(_get_connection=lambda uri,
+                    headers=None: httplib.HTTPConnection('example.com'))
+
+        session = google_code.GoogleCodeSession(
+            Client, 'login', 'password', timeout=0.5)
+        self.add_issue(session)
+        connection = session.client.http_client._get_connection(
+            'http://example.com/')
+        self.assertEquals(connection.timeout, 0.5)
+
+    def test_session_per_thread(self):
+        """
+        Each worker thread keeps its own session.
+        """
+        settings.ERROR_CAPTURE_GOOGLE_CODE_LOGIN = 'fake_login'
+        settings.ERROR_CAPTURE_GOOGLE_CODE_PASSWORD = 'fake_password'
+        session = google_code.get_session(StandInProjectHostingClient)
+        self.assertTrue(
+            google_code.get_session(StandInProjectHostingClient) is session)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(
+            google_code.get_session(StandInProjectHostingClient)))
+        thread.start()
+        thread.join()
+        self.assertFalse(other[0] is session)
+
+
 class BugzillaHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
     """
     Tests for Google Code handler.
@@ -381,3 +2049,326 @@ class BugzillaHandlerTestCase(_ParentTicketHandlerMixIn, TestCasePlus):
         settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_PRIORITY = 'fake_priority'
         super(BugzillaHandlerTestCase, self).setUp()
         self.instance.Bugzilla = Bugzilla
+
+
+class StandInBugzilla(object):
+    """
+    Minimal Bugzilla client talking XML-RPC.
+    """
+
+    def __init__(self, url):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `url`: Bugzilla XML-RPC url
+        """
+        # Kept like python-bugzilla does
+        self._transport = xmlrpclib.Transport()
+        self.proxy = xmlrpclib.ServerProxy(url, transport=self._transport)
+        self.token = None
+
+    def login(self, user, password):
+        """
+        Logs in and keeps the token.
+
+        :Parameters:
+           - `user`: user to log in as
+           - `password`: password of the user
+        """
+        self.token = self.proxy.User.login(
+            {'login': user, 'password': password})['token']
+
+    def createbug(self, **kwargs):
+        """
+        Creates a bug with the token.
+
+        :Parameters:
+           - `kwargs`: bug fields
+        """
+        kwargs['Bugzilla_token'] = self.token
+        return Jelly(bug_id=self.proxy.Bug.create(kwargs)['id'])
+
+    def update_bugs(self, ids, updates):
+        """
+        Updates bugs with the token.
+
+        :Parameters:
+           - `ids`: bug ids
+           - `updates`: fields to update
+        """
+        updates = dict(updates, ids=ids, Bugzilla_token=self.token)
+        return self.proxy.Bug.update(updates)
+
+
+class BugzillaSessionTestCase(TestCasePlus):
+    """
+    Tests for reusing Bugzilla logins against a local XML-RPC server.
+    """
+
+    def setUp(self):
+        """
+        Starts the XML-RPC server.
+        """
+        self.logins = []
+        self.bugs = []
+        self.comments = []
+        self.tokens = set()
+        self.stall = threading.Event()
+        self.stall.set()
+        self.server = SimpleXMLRPCServer(
+            ('127.0.0.1', 0), logRequests=False, allow_none=True)
+        self.server.register_function(self.login, 'User.login')
+        self.server.register_function(self.create, 'Bug.create')
+        self.server.register_function(self.update, 'Bug.update')
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.05, ))
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+        settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_SERVICE = self.url
+        settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_USERNAME = 'fake_user'
+        settings.ERROR_CAPTURE_GOOGLE_BUGZILLA_PASSWORD = 'fake_password'
+        for name in bz.BugzillaHandler.required_settings[3:]:
+            setattr(settings, name, name.lower())
+
+    def tearDown(self):
+        """
+        Stops the XML-RPC server.
+        """
+        self.stall.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def login(self, params):
+        """
+        Stand in for User.login.
+
+        :Parameters:
+           - `params`: login parameters
+        """
+        self.logins.append(params['login'])
+        token = 'token-%s' % len(self.logins)
+        self.tokens.add(token)
+        return {'id': 1, 'token': token}
+
+    def create(self, params):
+        """
+        Stand in for Bug.create which needs a valid token.
+
+        :Parameters:
+           - `params`: bug fields
+        """
+        self.stall.wait(5)
+        if params.get('Bugzilla_token') not in self.tokens:
+            raise xmlrpclib.Fault(32000, 'The token is invalid')
+        self.bugs.append(params)
+        return {'id': len(self.bugs)}
+
+    def update(self, params):
+        """
+        Stand in for Bug.update which needs a valid token.
+
+        :Parameters:
+           - `params`: bug ids and fields
+        """
+        if params.get('Bugzilla_token') not in self.tokens:
+            raise xmlrpclib.Fault(32000, 'The token is invalid')
+        self.comments.append((params['ids'], params['comment']['comment']))
+        return {'bugs': []}
+
+    def test_login_reuse(self):
+        """
+        Logins are reused across bugs and repeated when rejected.
+        """
+        for x in range(3):
+            session = bz.get_session(StandInBugzilla)
+            bug = session.call('createbug', summary='bug %s' % x)
+        self.assertEquals(bug.bug_id, 3)
+        self.assertEquals(len(self.logins), 1)
+        self.assertEquals(session.logins, 1)
+        # An expired token makes it log in once more
+        self.tokens.clear()
+        bug = bz.get_session(StandInBugzilla).call('createbug', summary='x')
+        self.assertEquals(bug.bug_id, 4)
+        self.assertEquals(len(self.logins), 2)
+
+    def test_stalled(self):
+        """
+        A stalled Bugzilla times out and gives the worker back.
+        """
+        self.stall.clear()
+        # The client is gone by the time the server answers
+        self.server.handle_error = lambda request, address: None
+        session = bz.BugzillaSession(StandInBugzilla, self.url,
+            'fake_user', 'fake_password', 0.2)
+        results = Queue.Queue()
+
+        def create():
+            try:
+                session.call('createbug', summary='stalled')
+            except socket.timeout:
+                results.put('timeout')
+
+        pool = WorkerPool(1, 10)
+        start = time.time()
+        pool.submit(create)
+        pool.submit(results.put, 'free')
+        self.assertEquals(results.get(timeout=2), 'timeout')
+        self.assertEquals(results.get(timeout=1), 'free')
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(session.client is None)
+        pool.shutdown(timeout=1)
+
+    def test_handler_timeout(self):
+        """
+        The handler's timeout is used by the session of the worker.
+        """
+        self.assertEquals(bz.get_session(StandInBugzilla, 0.2).timeout, 0.2)
+
+        class Handler(bz.BugzillaHandler):
+            timeout = 0.3
+
+        self.assertEquals(Handler().call_timeout(), 0.3)
+        settings.ERROR_CAPTURE_HANDLER_TIMEOUT = 7
+        try:
+            self.assertEquals(bz.BugzillaHandler.call_timeout(), 7)
+        finally:
+            del settings.ERROR_CAPTURE_HANDLER_TIMEOUT
+
+    def test_handler(self):
+        """
+        The handler files bugs through the worker's session.
+        """
+        handler = bz.BugzillaHandler()
+        handler.Bugzilla = StandInBugzilla
+        handler.foreground = True
+        ex, tb = self._raise_and_get_exception()
+        for x in range(2):
+            handler.handle(Jelly(user=None, META={}), ex, tb)
+        self.assertEquals(len(self.bugs), 2)
+        self.assertEquals(len(self.logins), 1)
+        self.assertEquals(handler.context['id'], 2)
+
+    def test_repeat(self):
+        """
+        Repeats are commented on the existing bug through the session.
+        """
+        ex, tb = self._raise_and_get_exception()
+        for x in range(3):
+            handler = bz.BugzillaHandler()
+            handler.Bugzilla = StandInBugzilla
+            handler.foreground = True
+            handler.context['fingerprint'] = 'repeat'
+            handler.handle(Jelly(user=None, META={}), ex, tb)
+        self.assertEquals(len(self.bugs), 1)
+        # The commenter creates its own handler
+        original, bz.BugzillaHandler.Bugzilla = (
+            bz.BugzillaHandler.Bugzilla, StandInBugzilla)
+        try:
+            self.assertEquals(get_commenter().flush(), 1)
+        finally:
+            bz.BugzillaHandler.Bugzilla = original
+        self.assertEquals(len(self.comments), 1)
+        self.assertEquals(self.comments[0][0], [1])
+        self.assertTrue('Seen 2 more times' in self.comments[0][1])
+        self.assertEquals(len(self.logins), 1)
+
+
+class WebhookTestCase(TestCasePlus):
+    """
+    Tests for batched webhook delivery against a stub collector.
+    """
+
+    def setUp(self):
+        """
+        Starts the stub collector.
+        """
+        self.statuses = []
+        self.server = StubHTTPServer(self.respond)
+
+    def tearDown(self):
+        """
+        Stops the stub collector.
+        """
+        self.server.stop()
+
+    def respond(self, path, body):
+        """
+        Answers with the queued statuses, then 200.
+
+        :Parameters:
+           - `path`: requested path
+           - `body`: request body
+        """
+        if self.statuses:
+            return self.statuses.pop(0), '{}'
+        return 200, '{}'
+
+    def batches(self):
+        """
+        Returns the decoded batches the collector received.
+        """
+        return [json.loads(gzip.GzipFile(fileobj=StringIO(x[2])).read())
+            for x in self.server.requests]
+
+    def test_batches(self):
+        """
+        Events are posted as gzip compressed JSON arrays of batch_size
+        over one connection.
+        """
+        batcher = webhook.WebhookBatcher(self.server.url + '/events', 2)
+        for x in range(5):
+            self.assertTrue(batcher.add({'n': x}))
+        self.assertEquals(batcher.flush(), 5)
+        self.assertEquals(self.batches(),
+            [[{'n': 0}, {'n': 1}], [{'n': 2}, {'n': 3}], [{'n': 4}]])
+        path, headers, body = self.server.requests[0]
+        self.assertEquals(path, '/events')
+        self.assertEquals(headers['Content-Encoding'], 'gzip')
+        self.assertEquals(self.server.connections, 1)
+        self.assertEquals(batcher.sent, 5)
+
+    def test_retries(self):
+        """
+        Server errors are retried with backoff, client errors are not.
+        """
+        batcher = webhook.WebhookBatcher(
+            self.server.url, retries=2, backoff=0.01)
+        self.statuses = [503, 429]
+        batcher.add({'n': 1})
+        self.assertEquals(batcher.flush(), 1)
+        self.assertEquals(len(self.server.requests), 3)
+        self.statuses = [400]
+        batcher.add({'n': 2})
+        self.assertEquals(batcher.flush(), 0)
+        self.assertEquals(len(self.server.requests), 4)
+        self.assertEquals((batcher.sent, batcher.failed), (1, 1))
+
+    def test_max_buffer(self):
+        """
+        Events over the buffer limit are dropped.
+        """
+        batcher = webhook.WebhookBatcher(self.server.url, max_buffer=1)
+        self.assertTrue(batcher.add({}))
+        self.assertFalse(batcher.add({}))
+        self.assertEquals(batcher.dropped, 1)
+
+    def test_handler(self):
+        """
+        The handler buffers events which are sent when the batch is full
+        or the batcher stops.
+        """
+        with override_settings(ERROR_CAPTURE_WEBHOOK_URL=self.server.url,
+                ERROR_CAPTURE_WEBHOOK_BATCH_SEC=3600):
+            handler = webhook.WebhookHandler()
+            try:
+                raise ValueError('webhook')
+            except ValueError, ex:
+                handler.use_event(ErrorEvent(None, ex, sys.exc_info(), 'abc'))
+            handler.handle(None, ex, handler.event.traceback)
+            self.assertEquals(self.server.requests, [])
+        # Sent when the batcher is stopped
+        batch = self.batches()[0]
+        self.assertEquals(batch[0]['fingerprint'], 'abc')
+        self.assertTrue('ValueError: webhook' in batch[0]['traceback'][-1])
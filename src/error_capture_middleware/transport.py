@@ -0,0 +1,288 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Pooled keep-alive HTTP connections for handlers talking to remote services.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import atexit
+import errno
+import httplib
+import os
+import socket
+import threading
+import urlparse
+
+
+#: Seconds to wait for a connection by default
+CONNECT_TIMEOUT = 5
+
+#: Seconds to wait for a response by default
+READ_TIMEOUT = 10
+
+#: errno of a kept alive connection the server closed
+CLOSED_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+#: Status lines httplib reports when the server closed without answering
+CLOSED_STATUS_LINES = ('', "''",
+    'No status line received - the server has closed the connection')
+
+
+def closed_unanswered(error):
+    """
+    Returns True if error shows the server closed a kept alive connection
+    without answering, so the request can be sent again. Anything else,
+    timeouts in particular, may mean the server is still processing it.
+
+    :Parameters:
+       - `error`: exception raised by a request
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.CannotSendRequest):
+        return True
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line in CLOSED_STATUS_LINES
+    return (isinstance(error, socket.error) and
+        getattr(error, 'errno', None) in CLOSED_ERRNOS)
+
+
+def set_connection_timeout(obj, name, timeout):
+    """
+    Wraps the method of obj which returns httplib connections so they use
+    a socket timeout. Clients which don't take a timeout, like XML-RPC
+    transports, are made to give up on a stalled server this way. Returns
+    False if obj has no such method.
+
+    :Parameters:
+       - `obj`: object making the connections
+       - `name`: name of the method returning a connection
+       - `timeout`: seconds to wait on the socket
+    """
+    make_connection = getattr(obj, name, None)
+    if make_connection is None:
+        return False
+
+    def timed_connection(*args, **kwargs):
+        connection = make_connection(*args, **kwargs)
+        connection.timeout = timeout
+        if getattr(connection, 'sock', None) is not None:
+            connection.sock.settimeout(timeout)
+        return connection
+
+    setattr(obj, name, timed_connection)
+    return True
+
+
+class HTTPPool(object):
+    """
+    Keeps HTTP/1.1 connections open per host and reuses them across
+    requests. A request which fails on a reused connection because the
+    server closed it without answering is sent once more on a new
+    connection. Other failures are not retried since the server may have
+    acted on the request.
+    """
+
+    def __init__(self, size=4):
+        """
+        Creates an instance of this class.
+
+        :Parameters:
+           - `size`: most idle connections kept per host
+        """
+        self.size = size
+        self.opened = 0
+        self.reused = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def reuse_rate(self):
+        """
+        Returns the fraction of requests which reused an open connection.
+        """
+        total = self.opened + self.reused
+        if not total:
+            return 0.0
+        return float(self.reused) / total
+
+    def connect(self, key, timeout):
+        """
+        Opens a new connection.
+
+        :Parameters:
+           - `key`: (scheme, host, port) to connect to
+           - `timeout`: seconds to wait for the connection
+        """
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=timeout)
+        connection.connect()
+        # Requests are written at once, don't wait for the ack of the last
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.opened += 1
+        return connection
+
+    def acquire(self, key, timeout):
+        """
+        Returns (connection, reused) for a host, reusing an idle one if
+        there is one.
+
+        :Parameters:
+           - `key`: (scheme, host, port) to connect to
+           - `timeout`: seconds to wait for a new connection
+        """
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # Forked, the sockets belong to the parent
+                self._idle, self._pid = {}, os.getpid()
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+        return self.connect(key, timeout), False
+
+    def release(self, key, connection):
+        """
+        Puts a connection back for reuse or closes it if the host has
+        enough idle connections.
+
+        :Parameters:
+           - `key`: (scheme, host, port) of the connection
+           - `connection`: connection to put back
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def request(self, method, url, body=None, headers={},
+            connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        """
+        Makes a request and returns (status, headers, body).
+
+        :Parameters:
+           - `method`: HTTP method
+           - `url`: absolute url to request
+           - `body`: request body
+           - `headers`: request headers
+           - `connect_timeout`: seconds to wait for a new connection
+           - `read_timeout`: seconds to wait for the response
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        connection, reused = self.acquire(key, connect_timeout)
+        try:
+            try:
+                response = self._send(connection, read_timeout, method,
+                    path, body, headers)
+            except Exception, e:
+                # Only a reused connection can have been closed meanwhile
+                if not reused or not closed_unanswered(e):
+                    raise
+                connection.close()
+                connection = self.connect(key, connect_timeout)
+                response = self._send(connection, read_timeout, method,
+                    path, body, headers)
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(key, connection)
+        return response.status, dict(response.getheaders()), data
+
+    def _send(self, connection, read_timeout, method, path, body, headers):
+        """
+        Sends a request over a connection and returns the response.
+
+        :Parameters:
+           - `connection`: connection to use
+           - `read_timeout`: seconds to wait for the response
+           - `method`: HTTP method
+           - `path`: path and query to request
+           - `body`: request body
+           - `headers`: request headers
+        """
+        connection.request(method, path, body, headers)
+        connection.sock.settimeout(read_timeout)
+        return connection.getresponse()
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_http_pool():
+    """
+    Returns the shared HTTPPool.
+    """
+    global _pool
+    if _pool is None:
+        _pool_lock.acquire()
+        try:
+            if _pool is None:
+                pool = HTTPPool()
+                atexit.register(pool.close)
+                _pool = pool
+        finally:
+            _pool_lock.release()
+    return _pool
@@ -0,0 +1,414 @@
+# Copyright (c) 2009-2010, Steve 'Ashcrow' Milner
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#    * Neither the name of the project nor the names of its
+#      contributors may be used to endorse or promote products
+#      derived from this software without specific prior written
+#      permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Background workers for handler dispatch.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import atexit
+import logging
+import multiprocessing
+import Queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    from django.test.signals import setting_changed
+
+
+logger = logging.getLogger('error_capture_middleware')
+
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+INLINE = 'inline'
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, INLINE)
+
+# Put on the queue to stop a worker
+_STOP = None
+
+
+class WorkerPool(object):
+    """
+    Fixed number of long lived daemon threads reading work from a bounded
+    queue. When the queue is full the overflow policy decides what happens
+    to new work: drop-newest drops it, drop-oldest drops the oldest queued
+    work instead and inline runs it in the calling thread.
+    """
+
+    def __init__(self, workers=4, queue_size=100, overflow=DROP_NEWEST):
+        """
+        Creates an instance of this class and starts the workers.
+
+        :Parameters:
+           - `workers`: number of workers
+           - `queue_size`: most work items waiting at once
+           - `overflow`: one of OVERFLOW_POLICIES
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ImproperlyConfigured(
+                'Unknown error capture worker overflow policy %s, use one '
+                'of: %s' % (overflow, ', '.join(OVERFLOW_POLICIES)))
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        self._queue = self._make_queue(queue_size)
+        self._threads = []
+        for i in range(workers):
+            worker = self._make_worker(i)
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def _make_queue(self, queue_size):
+        """
+        Returns the queue work is passed through.
+
+        :Parameters:
+           - `queue_size`: most work items waiting at once
+        """
+        return Queue.Queue(queue_size)
+
+    def _make_worker(self, number):
+        """
+        Returns an unstarted worker.
+
+        :Parameters:
+           - `number`: number of the worker
+        """
+        return threading.Thread(
+            target=self._work, name='error-capture-worker-%s' % number)
+
+    def _work(self):
+        """
+        Worker loop.
+        """
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            try:
+                self._run(item)
+            except Exception:
+                logger.exception('Error capture background work failed')
+
+    def _run(self, item):
+        """
+        Runs a work item.
+
+        :Parameters:
+           - `item`: (func, args, kwargs)
+        """
+        func, args, kwargs = item
+        func(*args, **kwargs)
+
+    def _put(self, item):
+        """
+        Queues a work item applying the overflow policy. Returns False if
+        the work was dropped.
+
+        :Parameters:
+           - `item`: work item
+        """
+        if self.closed:
+            self.dropped += 1
+            return False
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            pass
+        if self.overflow == INLINE:
+            self._run(item)
+            return True
+        self.dropped += 1
+        if self.overflow == DROP_OLDEST:
+            try:
+                self._queue.get_nowait()
+                self._queue.put_nowait(item)
+                return True
+            except (Queue.Empty, Queue.Full):
+                pass
+        return False
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues func to be called with args and kwargs in a worker. Returns
+        False if the work was dropped.
+
+        :Parameters:
+           - `func`: callable to execute
+           - `args`: non-keyword arguments to pass to func
+           - `kwargs`: keyword arguments to pass to func
+        """
+        return self._put((func, args, kwargs))
+
+    def dispatch(self, handler_cls, request, exception, exc_info, event):
+        """
+        Queues a handler call for an event. Returns False if it was
+        dropped.
+
+        :Parameters:
+           - `handler_cls`: handler class to call
+           - `request`: request causing the exception
+           - `exception`: actual exception raised
+           - `exc_info`: info from sys.exc_info
+           - `event`: ErrorEvent being handled
+        """
+        # Handlers get the traceback from the event, which formats it in
+        # the worker when first used
+        return self.submit(handler_cls(), request, exception,
+            (exc_info[0], exc_info[1], None), event)
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stops accepting work and lets the workers exit once the queued work
+        is done. timeout bounds the whole shutdown, workers still busy then
+        are left behind, they are daemons so they don't hold up exit.
+
+        :Parameters:
+           - `wait`: if True wait for the workers to finish
+           - `timeout`: most seconds to wait
+        """
+        if self.closed:
+            return
+        self.closed = True
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        stops = len(self._threads)
+        while stops:
+            try:
+                if not wait:
+                    self._queue.put_nowait(_STOP)
+                elif deadline is None:
+                    self._queue.put(_STOP)
+                else:
+                    self._queue.put(
+                        _STOP, True, max(0, deadline - time.time()))
+            except Queue.Full:
+                break
+            stops -= 1
+        if stops and not wait:
+            # Hand the rest over instead of blocking the caller
+            stopper = threading.Thread(target=self._put_stops, args=(stops, ),
+                name='error-capture-worker-stopper')
+            stopper.daemon = True
+            stopper.start()
+        elif stops:
+            logger.warning('Error capture workers did not stop in %s '
+                'seconds' % timeout)
+        if wait:
+            for worker in self._threads:
+                if deadline is None:
+                    worker.join()
+                else:
+                    worker.join(max(0, deadline - time.time()))
+
+    def _put_stops(self, stops):
+        """
+        Queues stops for the workers, waiting for room in the queue.
+
+        :Parameters:
+           - `stops`: number of stops to queue
+        """
+        for i in range(stops):
+            self._queue.put(_STOP)
+
+
+class ProcessPool(WorkerPool):
+    """
+    Pre-forked worker processes fed through a bounded multiprocessing
+    queue, so rendering and remote calls don't compete with the web
+    worker for the GIL. Handlers get compact, detached events; requests,
+    exceptions and callables can not cross the pipe.
+    """
+
+    def _make_queue(self, queue_size):
+        """
+        Returns the queue work is passed through.
+
+        :Parameters:
+           - `queue_size`: most work items waiting at once
+        """
+        return multiprocessing.Queue(queue_size)
+
+    def _make_worker(self, number):
+        """
+        Returns an unstarted worker.
+
+        :Parameters:
+           - `number`: number of the worker
+        """
+        return multiprocessing.Process(
+            target=self._work_process, name='error-capture-worker-%s' % number)
+
+    def _work_process(self):
+        """
+        Worker process entry point.
+        """
+        # Forget the database connections inherited from the parent without
+        # closing them, closing would end the parent's sessions.
+        from django.db import connections
+        for conn in connections.all():
+            conn.connection = None
+        self._work()
+
+    def _run(self, item):
+        """
+        Delivers an event to a handler.
+
+        :Parameters:
+           - `item`: (handler path, ErrorEvent.to_dict output)
+        """
+        from error_capture_middleware.event import ErrorEvent
+        from error_capture_middleware.registry import import_object
+        handler_path, data = item
+        import_object(handler_path)().deliver(ErrorEvent.from_dict(data))
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Callables can not be sent to worker processes.
+        """
+        raise TypeError('ProcessPool only accepts handler events')
+
+    def dispatch(self, handler_cls, request, exception, exc_info, event):
+        """
+        Queues a handler call for an event. Returns False if it was
+        dropped.
+
+        :Parameters:
+           - `handler_cls`: handler class to call
+           - `request`: request causing the exception
+           - `exception`: actual exception raised
+           - `exc_info`: info from sys.exc_info
+           - `event`: ErrorEvent being handled
+        """
+        # Serialize here while the request is still usable
+        return self._put(('%s.%s' % (handler_cls.__module__,
+            handler_cls.__name__), event.to_dict()))
+
+
+_pool = None
+_process_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the shared WorkerPool, creating it from the settings on first
+    use.
+    """
+    global _pool
+    if _pool is None:
+        _pool_lock.acquire()
+        try:
+            if _pool is None:
+                _pool = WorkerPool(
+                    getattr(settings, 'ERROR_CAPTURE_WORKERS', 4),
+                    getattr(settings, 'ERROR_CAPTURE_WORKER_QUEUE_SIZE', 100),
+                    getattr(settings, 'ERROR_CAPTURE_WORKER_OVERFLOW',
+                        DROP_NEWEST))
+        finally:
+            _pool_lock.release()
+    return _pool
+
+
+def get_dispatcher():
+    """
+    Returns the pool handlers are dispatched to. This is a shared
+    ProcessPool when ERROR_CAPTURE_WORKER_TYPE is 'process' and the shared
+    WorkerPool otherwise. The middleware calls it when it is configured so
+    the processes are forked before any request is handled.
+    """
+    global _process_pool
+    if getattr(settings, 'ERROR_CAPTURE_WORKER_TYPE', 'thread') != 'process':
+        return get_pool()
+    if _process_pool is None:
+        _pool_lock.acquire()
+        try:
+            if _process_pool is None:
+                _process_pool = ProcessPool(
+                    getattr(settings, 'ERROR_CAPTURE_WORKERS', 4),
+                    getattr(settings, 'ERROR_CAPTURE_WORKER_QUEUE_SIZE', 100),
+                    getattr(settings, 'ERROR_CAPTURE_WORKER_OVERFLOW',
+                        DROP_NEWEST))
+        finally:
+            _pool_lock.release()
+    return _process_pool
+
+
+def shutdown_pool(wait=True, timeout=None):
+    """
+    Shuts down the shared pools. The next get_pool or get_dispatcher call
+    creates new ones.
+
+    :Parameters:
+       - `wait`: if True wait for the workers to finish
+       - `timeout`: most seconds to wait for all of the pools
+    """
+    global _pool, _process_pool
+    _pool_lock.acquire()
+    try:
+        pools = (_pool, _process_pool)
+        _pool = _process_pool = None
+    finally:
+        _pool_lock.release()
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    for pool in pools:
+        if pool is not None:
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            pool.shutdown(wait, timeout)
+
+
+def _setting_changed(setting, **kwargs):
+    """
+    Replaces the shared pool when one of its settings changes.
+
+    :Parameters:
+       - `setting`: name of the setting which changed
+       - `kwargs`: other signal arguments
+    """
+    if setting.startswith('ERROR_CAPTURE_WORKER'):
+        shutdown_pool(wait=False)
+
+
+setting_changed.connect(_setting_changed)
+atexit.register(shutdown_pool, timeout=5)